@@ -0,0 +1,138 @@
+import time
+
+import oauth_util_v2 as oauth_util
+from oauth_util_v2 import RestClient, TimedAuth
+from requests.auth import AuthBase
+from token_broker import DEFAULT_REFRESH_MARGIN
+from utils.configmanager import to_bool
+from utils.credcache import CredentialCache, DEFAULT_CACHE_DIR
+
+BACKEND_CERNER_OAUTH1 = "cerner_oauth1"
+BACKEND_STATIC = "static"
+BACKEND_NONE = "none"
+BACKENDS = (BACKEND_CERNER_OAUTH1, BACKEND_STATIC, BACKEND_NONE)
+
+
+class HeaderAuth(AuthBase):
+  """
+  Adds fixed headers to every request.
+  """
+  def __init__(self, headers):
+    self.headers = headers
+
+  def __call__(self, r):
+    r.headers.update(self.headers)
+    return r
+
+
+class StaticAuthClient(RestClient):
+  """
+  Sends the same credentials headers, e.g. a bearer token, with every request. Nothing is requested at startup.
+  """
+  def __init__(self, headers, http_options=None):
+    # type: (dict, HTTPOptions) -> None
+    RestClient.__init__(self, http_options)
+    self.headers = headers
+    self._auth = TimedAuth(self, HeaderAuth(headers))
+
+  def requests_auth(self):
+    return self._auth
+
+  def sign(self, method, url, headers):
+    start = time.perf_counter()
+    headers.update(self.headers)
+    self.sign_time += time.perf_counter() - start
+    self.signed += 1
+    return url, headers
+
+
+class NoAuthClient(RestClient):
+  """
+  Sends requests without any credentials, e.g. to a local stub.
+  """
+
+
+def parse_static_headers(section):
+  # type: (dict) -> dict
+  """
+  Reads the headers of the static backend from the [Auth] section:
+  "Token" becomes "Authorization: Bearer <Token>", and "Header" holds "Name: value" lines.
+
+  :return: Dictionary of header name to value
+  """
+  headers = {}
+  if section.get("Token"):
+    headers["Authorization"] = "Bearer %s" % section["Token"]
+  for line in section.get("Header", "").splitlines():
+    if not line.strip():
+      continue
+    name, separator, value = line.partition(":")
+    if not separator:
+      raise ValueError("Invalid [Auth] Header line, expected 'Name: value': %s" % line)
+    headers[name.strip()] = value.strip()
+  if not headers:
+    raise ValueError("The static auth backend needs a Token or a Header in the [Auth] section")
+  return headers
+
+
+def get_backend(config):
+  # type: (dict) -> str
+  """
+  :return: The [Auth] Backend of the settings, cerner_oauth1 by default
+  """
+  backend = config.get("Auth", {}).get("Backend", BACKEND_CERNER_OAUTH1).strip().lower()
+  if backend not in BACKENDS:
+    raise ValueError("Unknown auth backend %s, expected one of %s" % (backend, ", ".join(BACKENDS)))
+  return backend
+
+
+def get_default_user(config):
+  # type: (dict) -> (str, str)
+  """
+  :return: The (username, password) of the [OAuth] section, empty if there is none
+  """
+  oauth = config.get("OAuth", {})
+  return oauth.get("UserName", ""), oauth.get("Password", "")
+
+
+def client_factory(config, http_options=None):
+  # type: (dict, HTTPOptions) -> Callable
+  """
+  Builds the function that creates the client of a user with the backend of the settings.
+
+  :param config: The parsed settings file
+  :param http_options: The transport options
+
+  :return: Function of (username, password, token_broker=None) to RestClient.
+           Static and none backends ignore the user, and their clients are shared by every user.
+  """
+  backend = get_backend(config)
+  if backend == BACKEND_NONE:
+    client = NoAuthClient(http_options)
+    return lambda username, password, token_broker=None: client
+  if backend == BACKEND_STATIC:
+    client = StaticAuthClient(parse_static_headers(config["Auth"]), http_options)
+    return lambda username, password, token_broker=None: client
+
+  oauth = config["OAuth"]
+  host = oauth["Host"]
+  port = int(str(oauth["Port"]))
+  url_session = oauth["URL"]
+  use_http = to_bool(oauth["UseHTTP"])
+  consumer_key = oauth["consumer_key"]
+  consumer_secret = oauth["consumer_secret"]
+  domain = oauth["domain"]
+  refresh_margin = float(oauth.get("TokenRefreshMargin", DEFAULT_REFRESH_MARGIN))
+  credential_cache = CredentialCache(oauth.get("CacheDir", DEFAULT_CACHE_DIR))
+
+  def create_client(username, password, token_broker=None):
+    return oauth_util.CernerOAuthUtil(host, port, url_session, username, password,
+      use_http=use_http,
+      consumer_key=consumer_key,
+      consumer_secret=consumer_secret,
+      domain=domain,
+      http_options=http_options,
+      refresh_margin=refresh_margin,
+      credential_cache=credential_cache,
+      token_broker=token_broker)
+  return create_client
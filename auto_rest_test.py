@@ -2,6 +2,9 @@
 
 import http.client
 import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from http.client import HTTPResponse
 from urllib.parse import urlencode, quote
 
@@ -11,16 +14,76 @@ from prettytable import PrettyTable
 from requests import Response
 from requests_oauthlib import OAuth1
 
+from auth_backends import client_factory, get_default_user
 from utils.configmanager import ConfigManager
-from utils.parsingmanager import parse_options
+from utils.parsingmanager import parse_auto_test_options
+from utils.phasetiming import PHASES
+from utils.resultsink import open_sink
 from utils.stringutil import cut_msg
+from utils.testcasereader import iter_test_cases
+
+
+def run_test_case(client, testCase):
+    # type: (oauth_util.RestClient, dict) -> (Response, float)
+    """
+    Sends the request of a test case
+
+    :param client: The authenticated client, shared by every test case
+    :param testCase: The test case
+
+    :return result: The response
+    :return duration: Seconds the request took
+    """
+    req_url = testCase["url"]
+    req_method = testCase["method"] if "method" in testCase else "GET"
+    start = time.perf_counter()
+    if "data" in testCase:
+        result = client.req_oauth(req_url, method=req_method, data=testCase["data"])
+    else:
+        result = client.req_oauth(req_url, method=req_method)
+    return result, time.perf_counter() - start
+
+
+def run_test_cases(client, testCases, concurrency=1):
+    # type: (oauth_util.RestClient, Iterable[dict], int) -> Iterator[(dict, Response, float)]
+    """
+    Runs the test cases, up to concurrency of them at once.
+    The test cases are consumed lazily, so at most a few of them are held in memory at a time.
+
+    :param client: The authenticated client
+    :param testCases: The iterable of test cases
+    :param concurrency: Number of test cases run at once
+
+    :return: Generator of (test case, response, duration) in the order of testCases
+    """
+    if concurrency <= 1:
+        for testCase in testCases:
+            result, duration = run_test_case(client, testCase)
+            yield testCase, result, duration
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Results are yielded in submission order, so the output stays in the order of the test file.
+        # Keeping a few more cases in flight than workers lets a slow case hold up the output but not the workers.
+        pending = deque()
+        for testCase in testCases:
+            pending.append((testCase, executor.submit(run_test_case, client, testCase)))
+            if len(pending) >= concurrency * 2:
+                testCase, future = pending.popleft()
+                result, duration = future.result()
+                yield testCase, result, duration
+        while pending:
+            testCase, future = pending.popleft()
+            result, duration = future.result()
+            yield testCase, result, duration
 
 
 """
 ====================== Main ===========================
 """
 if __name__ == "__main__":
-    configFilePath, testFilePath, detail = parse_options()
+    options = parse_auto_test_options()
+    configFilePath, testFilePath, detail = options.filename, options.testcase, options.detail
+    concurrency = max(1, options.concurrency)
     config = ConfigManager(configFilePath).parse()
     if configFilePath is None:
         print ("No config file is provided.")
@@ -28,33 +91,18 @@ if __name__ == "__main__":
     if testFilePath is None:
         print ("No test file is provided.")
         exit(-1)
-    oauth_host = config["OAuth"]["Host"]
-    oauth_port = int(str(config["OAuth"]["Port"]))
-    oauth_url = config["OAuth"]["URL"]
-    oauth_use_http = config["OAuth"]["UseHTTP"]
-    oauth_concept = config["OAuth"]["Concept"]
-    oauth_user = config["OAuth"]["UserName"]
-    oauth_pw = config["OAuth"]["Password"]
-    oauth_version = config["OAuth"]["Version"]
-    oauth_consumer_key = config["OAuth"]["consumer_key"]
-    oauth_consumer_secret = config["OAuth"]["consumer_secret"]
-    domain = config["OAuth"]["domain"]
-    client = oauth_util.CernerOAuthUtil(oauth_host, oauth_port, oauth_url, oauth_user, oauth_pw,
-        use_http=oauth_use_http,
-        consumer_key=oauth_consumer_key,
-        consumer_secret=oauth_consumer_secret,
-        domain=domain)
+    http_options = oauth_util.HTTPOptions.from_config(config.get("HTTP"))
+    # Every concurrent case needs its own connection, otherwise the pool keeps discarding them.
+    http_options.pool_maxsize = max(http_options.pool_maxsize, concurrency)
+    oauth_user, oauth_pw = get_default_user(config)
+    client = client_factory(config, http_options)(oauth_user, oauth_pw)
     summaries = []
 
-    with open(testFilePath) as data_file:
-        data = json.load(data_file)
-        for testCase in data["TestCases"]:
-            req_url = testCase["url"]
-            req_method = testCase["method"] if "method" in testCase else "GET"
-            if "data" in testCase:
-                result = client.req_oauth(req_url, method=req_method, data=testCase["data"])
-            else:
-                result = client.req_oauth(req_url, method=req_method)
+    sink = open_sink(options.output) if options.output else None
+    start = time.perf_counter()
+    # Closed even when a test case fails, so that the records written so far are flushed to the file.
+    try:
+        for index, (testCase, result, duration) in enumerate(run_test_cases(client, iter_test_cases(testFilePath), concurrency)):
             print(("Running : %s" % testCase["name"]))
             if detail:
                 print(("Status: %s" % (str(result.status_code))))
@@ -66,11 +114,37 @@ if __name__ == "__main__":
                 except Exception as e:
                     print((str(type(e)) + ":" + str(e)))
                     print((result.text))
+            timings = result.timings
+            if sink is not None:
+                record = {"index": index, "name": testCase["name"], "method": testCase.get("method", "GET"),
+                          "url": testCase["url"], "status": result.status_code,
+                          "duration_ms": round(duration * 1000, 3), "result": result.text}
+                for phase in PHASES:
+                    record["%s_ms" % phase] = round(getattr(timings, phase) * 1000, 3)
+                sink.write(record)
+            # Only the preview is kept for the summary table, the full response goes to the sink.
             summaries.append(
-                {"RespCode": result.status_code, "TestName": testCase["name"], "Result": result.text}
+                {"RespCode": result.status_code, "TestName": cut_msg(testCase["name"]),
+                 "Result": cut_msg(result.text, limit=100), "Duration": duration, "Timings": timings}
                 )
+        wall_time = time.perf_counter() - start
+    finally:
+        if sink is not None:
+            sink.close()
 
-    t = PrettyTable(["TestName", "RCode", "Result"])
+    # Setup is the DNS lookup, connect and TLS handshake of a case that opened a connection, 0 on a kept-alive one.
+    t = PrettyTable(["TestName", "RCode", "Time(ms)", "Setup(ms)", "TTFB(ms)", "Download(ms)", "Result"])
     for summary in summaries:
-        t.add_row([cut_msg(summary["TestName"]), summary["RespCode"], cut_msg(summary["Result"], limit=100)])
+        timings = summary["Timings"]
+        t.add_row([summary["TestName"], summary["RespCode"], "%.1f" % (summary["Duration"] * 1000),
+                   "%.1f" % (timings.setup() * 1000), "%.1f" % (timings.ttfb * 1000),
+                   "%.1f" % (timings.download * 1000), summary["Result"]])
     print(t)
+    total_duration = sum(summary["Duration"] for summary in summaries)
+    print("Test cases: %d, concurrency: %d, wall time: %.3fs, sum of case times: %.3fs, speedup: %.2fx" % (
+        len(summaries), concurrency, wall_time, total_duration, total_duration / wall_time if wall_time > 0 else 1.0))
+    http_stats = client.http_stats()
+    if sink is not None:
+        print("%d results written to %s" % (sink.count, sink.filepath))
+    print("Connections opened: %d, requests sent: %d" % (http_stats["connections"], http_stats["requests"]))
+
@@ -0,0 +1,30 @@
+"""
+Runs a command and writes its wall time and the CPU time and peak memory of it and all of its descendants to a JSON file.
+It runs in a process of its own so that the resource usage of the children is not mixed with other runs.
+
+Usage: python -m benchmark.measure OUTPUT -- COMMAND [ARGS...]
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+if __name__ == "__main__":
+  output = sys.argv[1]
+  command = sys.argv[sys.argv.index("--") + 1:]
+  start = time.perf_counter()
+  returncode = subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  wall = time.perf_counter() - start
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  with open(output, "w") as outfile:
+    json.dump({
+      "returncode": returncode,
+      "wall": wall,
+      "user": usage.ru_utime,
+      "system": usage.ru_stime,
+      # Peak resident set of the largest single process, in kilobytes on Linux.
+      "maxrss_kb": usage.ru_maxrss
+    }, outfile)
+  sys.exit(returncode)
@@ -0,0 +1,279 @@
+"""
+Measures the overhead of the tools themselves against a local stub server.
+Every case runs load_test.py or auto_rest_test.py in a separate process and reports the generator-side throughput,
+the CPU time per request and the peak memory. The CPU time of a run without any request (same users, no iterations)
+is subtracted, so that interpreter startup and logging in do not count as per-request cost.
+
+Usage: python -m benchmark.run_benchmark [-o FILE] [--quick]
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from prettytable import PrettyTable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETTINGS = """[Auth]
+Backend: %(auth)s
+
+[OAuth]
+Version: 1.0
+Host: 127.0.0.1
+Port: %(port)d
+UseHTTP: True
+URL: /sessions
+Concept: Benchmark
+UserName: benchmark
+Password: benchmark
+consumer_key: benchmark
+consumer_secret: benchmark
+domain: benchmark
+CacheDir: %(cache)s
+
+[HTTP]
+Timeout: 30
+"""
+
+
+def default_cases(quick=False):
+  # type: (bool) -> list
+  """
+  :return: The benchmark cases. Each one changes a single dimension of the base case.
+  """
+  iterations = 10 if quick else 50
+  base = {"tool": "load_test", "engine": "process", "auth": "cerner_oauth1", "users": 4, "steps": 3,
+          "iterations": iterations, "size": 128, "depth": 1, "stream": False}
+  cases = [
+    dict(base, name="base"),
+    dict(base, name="auth-none", auth="none"),
+    dict(base, name="steps-12", steps=12),
+    dict(base, name="body-64k", size=64 * 1024),
+    dict(base, name="depth-32", depth=32),
+    dict(base, name="depth-32-stream", depth=32, stream=True),
+    dict(base, name="async-50", engine="async", users=50, iterations=iterations // 5),
+    dict(base, name="async-500", engine="async", users=500, iterations=iterations // 5),
+    {"tool": "auto_rest_test", "name": "auto-serial", "auth": "cerner_oauth1", "cases": iterations * 10,
+     "concurrency": 1, "size": 128, "depth": 1},
+    {"tool": "auto_rest_test", "name": "auto-concurrent", "auth": "cerner_oauth1", "cases": iterations * 10,
+     "concurrency": 8, "size": 128, "depth": 1},
+  ]
+  return cases
+
+
+def variable_path(depth):
+  # type: (int) -> str
+  return "$.data" + ".child" * depth + ".id"
+
+
+def build_scenario(base_url, case, iterations):
+  # type: (str, dict, int) -> dict
+  query = "size=%d&depth=%d" % (case["size"], case["depth"])
+  scenario = []
+  for index in range(case["steps"]):
+    if index % 2 == 0:
+      step = {"name": "get-%d" % index, "url": "%s/items/{{ user }}-%d?%s" % (base_url, index, query), "method": "GET",
+              "variables": {"item_id": variable_path(case["depth"])}}
+      if case["stream"]:
+        step["streamVariables"] = True
+    else:
+      step = {"name": "post-%d" % index, "url": "%s/items/{{ item_id }}" % base_url, "method": "POST",
+              "data": {"id": "{{ item_id }}", "user": "{{ user }}"}}
+    scenario.append(step)
+  return {
+    "TestIteration": iterations,
+    "TestData": [{"name": "vu%d" % user, "user": user} for user in range(case["users"])],
+    "Scenario": scenario
+  }
+
+
+def write_test_cases(filepath, base_url, case, count):
+  # type: (str, str, dict, int) -> None
+  query = "size=%d&depth=%d" % (case["size"], case["depth"])
+  with open(filepath, "w") as outfile:
+    for index in range(count):
+      outfile.write(json.dumps({"name": "case-%d" % index, "url": "%s/items/%d?%s" % (base_url, index, query), "method": "GET"}))
+      outfile.write("\n")
+
+
+def measure(workdir, command):
+  # type: (str, list) -> dict
+  output = os.path.join(workdir, "measure.json")
+  subprocess.call([sys.executable, "-m", "benchmark.measure", output, "--"] + command, cwd=workdir,
+                  env=dict(os.environ, PYTHONPATH=ROOT))
+  with open(output) as infile:
+    result = json.load(infile)
+  if result["returncode"] != 0:
+    raise RuntimeError("Benchmark command failed with %d: %s" % (result["returncode"], " ".join(command)))
+  return result
+
+
+def count_requests(histogram_file):
+  # type: (str) -> (int, float)
+  """
+  :return: Number of requests and elapsed seconds of a load test run
+  """
+  with open(histogram_file) as infile:
+    info = json.load(infile)
+  return sum(step["total_count"] for step in info["steps"].values()), info["elapsed"]
+
+
+def run_load_test_case(workdir, settings, base_url, case):
+  # type: (str, str, str, dict) -> dict
+  results = {}
+  for label, iterations in (("baseline", 0), ("run", case["iterations"])):
+    scenario_file = os.path.join(workdir, "scenario_%s.json" % label)
+    with open(scenario_file, "w") as outfile:
+      json.dump(build_scenario(base_url, case, iterations), outfile)
+    histogram_file = os.path.join(workdir, "histogram_%s.json" % label)
+    command = [sys.executable, os.path.join(ROOT, "load_test.py"), "-c", settings, "-t", scenario_file,
+               "-e", case["engine"], "-H", histogram_file]
+    if case["engine"] == "async":
+      command += ["-w", "1"]
+    results[label] = measure(workdir, command)
+    results[label]["requests"], results[label]["elapsed"] = count_requests(histogram_file)
+  # The process engine runs every user in a process of its own, the async engine all of them in one worker.
+  return summarize(case, results["baseline"], results["run"], users_per_process=1 if case["engine"] == "process" else case["users"])
+
+
+def run_auto_rest_test_case(workdir, settings, base_url, case):
+  # type: (str, str, str, dict) -> dict
+  results = {}
+  for label, count in (("baseline", 0), ("run", case["cases"])):
+    test_file = os.path.join(workdir, "cases_%s.jsonl" % label)
+    write_test_cases(test_file, base_url, case, count)
+    output_file = os.path.join(workdir, "results_%s.jsonl" % label)
+    command = [sys.executable, os.path.join(ROOT, "auto_rest_test.py"), "-c", settings, "-t", test_file,
+               "-n", str(case["concurrency"]), "-o", output_file]
+    results[label] = measure(workdir, command)
+    with open(output_file) as infile:
+      results[label]["requests"] = sum(1 for line in infile if line.strip())
+  # auto_rest_test does not report its run time, so startup is taken out with the wall time of the run without cases.
+  results["run"]["elapsed"] = max(results["run"]["wall"] - results["baseline"]["wall"], 1e-9)
+  return summarize(case, results["baseline"], results["run"], users_per_process=None)
+
+
+def summarize(case, baseline, run, users_per_process):
+  # type: (dict, dict, dict, int) -> dict
+  cpu = run["user"] + run["system"]
+  baseline_cpu = baseline["user"] + baseline["system"]
+  requests = run["requests"]
+  return {
+    "name": case["name"],
+    "case": case,
+    "requests": requests,
+    "elapsed": run["elapsed"],
+    "wall": run["wall"],
+    "throughput": requests / run["elapsed"] if run["elapsed"] > 0 else 0.0,
+    "cpu_seconds": cpu,
+    "baseline_cpu_seconds": baseline_cpu,
+    "cpu_per_request_us": (cpu - baseline_cpu) / requests * 1000000 if requests else 0.0,
+    "maxrss_kb": run["maxrss_kb"],
+    "memory_per_user_kb": run["maxrss_kb"] / float(users_per_process) if users_per_process else None
+  }
+
+
+def git_version():
+  # type: () -> str
+  try:
+    return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                                   stderr=subprocess.DEVNULL).decode("utf-8").strip()
+  except (OSError, subprocess.CalledProcessError):
+    return "unknown"
+
+
+def start_stub():
+  # type: () -> (subprocess.Popen, int)
+  stub = subprocess.Popen([sys.executable, "-m", "benchmark.stub_server"], cwd=ROOT, stdout=subprocess.PIPE)
+  port = int(stub.stdout.readline())
+  return stub, port
+
+
+def run_benchmark(cases, output):
+  # type: (list, str) -> dict
+  stub, port = start_stub()
+  workdir = tempfile.mkdtemp(prefix="rest_benchmark_")
+  os.makedirs(os.path.join(workdir, "logs"))
+  base_url = "http://127.0.0.1:%d" % port
+  results = []
+  try:
+    settings = {}
+    for auth in set(case["auth"] for case in cases):
+      settings[auth] = os.path.join(workdir, "settings_%s.conf" % auth)
+      with open(settings[auth], "w") as outfile:
+        outfile.write(SETTINGS % {"auth": auth, "port": port, "cache": os.path.join(workdir, "cache")})
+    for case in cases:
+      print("Running %s..." % case["name"])
+      sys.stdout.flush()
+      if case["tool"] == "load_test":
+        results.append(run_load_test_case(workdir, settings[case["auth"]], base_url, case))
+      else:
+        results.append(run_auto_rest_test_case(workdir, settings[case["auth"]], base_url, case))
+  finally:
+    stub.terminate()
+    stub.wait()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  report = {
+    "version": git_version(),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "cpu_count": os.cpu_count(),
+    "results": results,
+    "summary": summarize_memory(results)
+  }
+  with open(output, "w") as outfile:
+    json.dump(report, outfile, indent=2)
+  return report
+
+
+def summarize_memory(results):
+  # type: (list) -> dict
+  """
+  Memory per async virtual user is the slope between the two async cases, which run in a single worker process.
+  """
+  summary = {}
+  async_results = sorted((result for result in results if result["case"].get("engine") == "async"),
+                         key=lambda result: result["case"]["users"])
+  if len(async_results) >= 2:
+    small, large = async_results[0], async_results[-1]
+    users = large["case"]["users"] - small["case"]["users"]
+    if users > 0:
+      summary["async_memory_per_user_kb"] = (large["maxrss_kb"] - small["maxrss_kb"]) / float(users)
+  return summary
+
+
+def print_report(report):
+  t = PrettyTable(["Case", "Requests", "Req/s", "CPU/req(us)", "Max RSS(MB)", "RSS/user(KB)"])
+  for result in report["results"]:
+    t.add_row([result["name"], result["requests"], "%.1f" % result["throughput"], "%.1f" % result["cpu_per_request_us"],
+               "%.1f" % (result["maxrss_kb"] / 1024.0),
+               "-" if result["memory_per_user_kb"] is None else "%.1f" % result["memory_per_user_kb"]])
+  print(t)
+  if "async_memory_per_user_kb" in report["summary"]:
+    print("Memory per async virtual user: %.1f KB" % report["summary"]["async_memory_per_user_kb"])
+
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-o", "--output", dest="output", metavar="FILE", default="benchmark_results.json",
+                    help="JSON file to write the results to. benchmark_results.json by default.")
+  parser.add_option("--quick", dest="quick", action="store_true", default=False,
+                    help="Runs fewer iterations, for a fast smoke check.")
+  parser.add_option("--case", dest="cases", action="append", metavar="NAME",
+                    help="Runs only the named case. Can be given several times.")
+  options, args = parser.parse_args()
+  cases = default_cases(options.quick)
+  if options.cases:
+    cases = [case for case in cases if case["name"] in options.cases]
+  report = run_benchmark(cases, options.output)
+  print_report(report)
+  print("Results are written to %s" % options.output)
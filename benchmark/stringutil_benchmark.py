@@ -0,0 +1,189 @@
+"""
+Micro-benchmark of the similarity helpers of utils.stringutil on generated error message corpora.
+The original implementations are kept below as the reference: plain SequenceMatcher ratios, str.find in a loop
+and the recursive common_string. Both sides are checked to give the same answers before they are timed.
+
+Usage: python -m benchmark.stringutil_benchmark [-o FILE] [--quick]
+"""
+
+import json
+import random
+import sys
+import time
+from difflib import SequenceMatcher
+from optparse import OptionParser
+
+from prettytable import PrettyTable
+
+from utils import stringutil
+
+USERS = ["ABC%03d" % index for index in range(1000)]
+UPSTREAMS = ["db", "cache", "auth", "search", "billing"]
+FRAMES = ["handle_request", "dispatch", "load_user", "query", "execute", "fetch_rows", "decode_row", "validate"]
+
+
+def legacy_is_similar_between(a, b, ratio):
+  return True if (SequenceMatcher(None, a, b).ratio() > ratio) else False
+
+
+def legacy_find_first_common_char(left, right):
+  first_a = a_occur = sys.maxsize
+  first_b = b_occur = sys.maxsize
+  for i in range(len(left)):
+    if left[i] == "*":
+      continue
+    if a_occur > right.find(left[i]) >= 0:
+      a_occur = right.find(left[i])
+      first_a = i
+      if a_occur == 0:
+        break
+  for i in range(len(right)):
+    if right[i] == "*":
+      continue
+    if b_occur > left.find(right[i]) >= 0:
+      b_occur = left.find(right[i])
+      first_b = i
+      if b_occur == 0:
+        break
+  return first_a, first_b
+
+
+def legacy_common_string(left, right):
+  c = []
+  count_a, count_b = legacy_find_first_common_char(left, right)
+  if count_a > len(left) - 1 or count_b > len(right) - 1:
+    return ""
+  if count_a > count_b > 0:
+    count_a = 0
+  elif count_b > count_a > 0:
+    count_b = 0
+  elif count_a == count_b:
+    if left[count_a] != right[count_b]:
+      if len(left) > len(right):
+        count_b = 0
+      else:
+        count_a = 0
+  if count_a > 0 or count_b > 0:
+    c.append("*")
+  while count_a < len(left) and count_b < len(right) and left[count_a] == right[count_b]:
+    c.append(left[count_a])
+    count_a += 1
+    count_b += 1
+  c.append(legacy_common_string(left[count_a:], right[count_b:]))
+  return "".join(c)
+
+
+def short_message(rng):
+  # type: (random.Random) -> str
+  kind = rng.random()
+  if kind < 0.4:
+    return "There is an error with user %s with ID %d." % (rng.choice(USERS), rng.randint(10 ** 6, 10 ** 7))
+  if kind < 0.6:
+    return "Unable to start MainActivity for User %s." % rng.choice("ABCDEFG")
+  if kind < 0.9:
+    return '{"error": "timeout contacting upstream %s after %d ms", "trace": "%016x"}' \
+      % (rng.choice(UPSTREAMS), rng.randint(100, 9999), rng.getrandbits(64))
+  return "ConnectionResetError: [Errno 104] Connection reset by peer"
+
+
+def stack_trace(rng, depth):
+  # type: (random.Random, int) -> str
+  lines = ["Traceback (most recent call last):"]
+  for _ in range(depth):
+    lines.append('  File "/srv/app/%s.py", line %d, in %s' % (rng.choice(FRAMES), rng.randint(1, 900), rng.choice(FRAMES)))
+  lines.append("TimeoutError: upstream %s did not answer within %d ms" % (rng.choice(UPSTREAMS), rng.randint(100, 9999)))
+  return "\n".join(lines)
+
+
+def timed(function, repeat=1):
+  # type: (Callable, int) -> (Any, float)
+  start = time.perf_counter()
+  for _ in range(repeat):
+    result = function()
+  return result, (time.perf_counter() - start) / repeat
+
+
+def bench_pairs(corpus, ratio):
+  # type: (list, float) -> dict
+  pairs = list(zip(corpus, corpus[1:]))
+  legacy, legacy_time = timed(lambda: [legacy_is_similar_between(a, b, ratio) for a, b in pairs])
+  fast, fast_time = timed(lambda: [stringutil.is_similar_between(a, b, ratio) for a, b in pairs])
+  assert legacy == fast
+  return {"name": "is_similar_between", "operations": len(pairs), "legacy": legacy_time, "fast": fast_time}
+
+
+def bench_batch(corpus, ratio, queries):
+  # type: (list, float, int) -> dict
+  targets = corpus[:queries]
+
+  def legacy_batch():
+    return [[index for index, candidate in enumerate(corpus) if legacy_is_similar_between(candidate, text, ratio)]
+            for text in targets]
+
+  def fast_batch():
+    return [sorted(index for index, _ in stringutil.similar_candidates(text, corpus, ratio)) for text in targets]
+
+  legacy, legacy_time = timed(legacy_batch)
+  fast, fast_time = timed(fast_batch)
+  assert legacy == fast
+  return {"name": "similar_candidates", "operations": queries * len(corpus), "legacy": legacy_time, "fast": fast_time}
+
+
+def bench_common_string(pairs, name):
+  # type: (list, str) -> dict
+  def legacy_all():
+    return [legacy_common_string(a, b) for a, b in pairs]
+
+  try:
+    legacy, legacy_time = timed(legacy_all)
+  except RecursionError:
+    legacy, legacy_time = None, None
+  fast, fast_time = timed(lambda: [stringutil.common_string(a, b) for a, b in pairs])
+  if legacy is not None:
+    assert legacy == fast
+  return {"name": name, "operations": len(pairs), "legacy": legacy_time, "fast": fast_time}
+
+
+def run(quick=False):
+  # type: (bool) -> list
+  rng = random.Random(42)
+  size = 500 if quick else 3000
+  corpus = [short_message(rng) for _ in range(size)]
+  traces = [stack_trace(rng, 8) for _ in range(40 if quick else 200)]
+  long_traces = [stack_trace(rng, 60) for _ in range(4 if quick else 20)]
+  # Long enough for the recursive version to run out of stack.
+  huge_traces = [stack_trace(rng, 600) for _ in range(3)]
+  return [
+    bench_pairs(corpus, 0.8),
+    bench_pairs(corpus + traces, 0.8),
+    bench_batch(corpus, 0.8, 5 if quick else 20),
+    bench_common_string(list(zip(corpus, corpus[1:]))[:size // 5], "common_string (short)"),
+    bench_common_string(list(zip(traces, traces[1:])), "common_string (trace)"),
+    bench_common_string(list(zip(long_traces, long_traces[1:])), "common_string (long trace)"),
+    bench_common_string(list(zip(huge_traces, huge_traces[1:])), "common_string (huge trace)")
+  ]
+
+
+def print_report(results):
+  t = PrettyTable(["Case", "Operations", "Legacy(ms)", "Fast(ms)", "Speedup"])
+  for result in results:
+    legacy = result["legacy"]
+    t.add_row([result["name"], result["operations"],
+               "RecursionError" if legacy is None else "%.1f" % (legacy * 1000),
+               "%.1f" % (result["fast"] * 1000),
+               "-" if legacy is None else "%.1fx" % (legacy / result["fast"])])
+  print(t)
+
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                    help="Also writes the results to a JSON file.")
+  parser.add_option("--quick", dest="quick", action="store_true", default=False,
+                    help="Uses smaller corpora, for a fast smoke check.")
+  options, args = parser.parse_args()
+  results = run(options.quick)
+  print_report(results)
+  if options.output:
+    with open(options.output, "w") as outfile:
+      json.dump({"python": sys.version.split()[0], "results": results}, outfile, indent=2)
@@ -0,0 +1,109 @@
+"""
+Local stand-in for the services the tools talk to, for benchmarking without a real server.
+
+  POST /sessions                               login, returns a session
+  POST /oauth/<mnemonic>/<authority>/tokens    returns an OAuth token
+  GET  /items/<id>?size=S&depth=D              JSON response with a payload of S bytes, D objects deep
+  POST|PUT|DELETE /items/<id>                  echoes the size of the request body
+  GET  /error/<id>                             500 response
+
+Usage: python -m benchmark.stub_server [--port PORT]
+The listening port is printed on the first line of stdout.
+"""
+
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from urllib.parse import parse_qs, urlparse
+
+SESSION = {"session": {"identityStatement": "benchmark", "clientMnemonic": "benchmark", "authority": "benchmark"}}
+TOKEN = {"response": {"oauth_parameter": {"oauth_token": "benchmark-token", "oauth_token_secret": "benchmark-secret",
+                                          "oauth_expires_in": 3600, "oauth_authorization_expires_in": 7200}}}
+
+
+def item_document(item_id, size, depth):
+  # type: (str, int, int) -> dict
+  """
+  :return: {"data": {"child": ... {"id": item_id, "payload": "x" * size}}} with depth levels of "child"
+  """
+  node = {"id": item_id, "payload": "x" * size}
+  for _ in range(depth):
+    node = {"child": node, "sibling": [1, 2, 3]}
+  return {"data": node}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  # Headers and body leave in one segment, so Nagle's algorithm and delayed ACKs do not stall keep-alive requests.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+  # Rendered documents keyed by (size, depth), with "%ID%" in place of the item id.
+  documents = {}
+
+  def log_message(self, format, *args):
+    pass
+
+  def _send(self, status, body):
+    # type: (int, bytes) -> None
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _item(self, url):
+    query = parse_qs(url.query)
+    key = (int(query.get("size", ["16"])[0]), int(query.get("depth", ["1"])[0]))
+    template = self.documents.get(key)
+    if template is None:
+      template = self.documents[key] = json.dumps(item_document("%ID%", *key)).encode("utf-8")
+    return template.replace(b"%ID%", url.path.rsplit("/", 1)[-1].encode("utf-8"))
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    if url.path.startswith("/error/"):
+      self._send(500, b'{"error": "benchmark error"}')
+    elif url.path.startswith("/items/"):
+      self._send(200, self._item(url))
+    else:
+      self._send(404, b'{"error": "not found"}')
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    path = urlparse(self.path).path
+    if path == "/sessions":
+      self._send(200, json.dumps(SESSION).encode("utf-8"))
+    elif path.startswith("/oauth/") and path.endswith("/tokens"):
+      self._send(200, json.dumps(TOKEN).encode("utf-8"))
+    elif path.startswith("/items/"):
+      self._send(200, json.dumps({"id": path.rsplit("/", 1)[-1], "received": len(body)}).encode("utf-8"))
+    else:
+      self._send(404, b'{"error": "not found"}')
+
+  do_PUT = do_POST
+  do_DELETE = do_POST
+
+
+class StubServer(ThreadingHTTPServer):
+  daemon_threads = True
+  # The load engines open many connections at once.
+  request_queue_size = 1024
+
+
+def create_server(port=0):
+  # type: (int) -> StubServer
+  return StubServer(("127.0.0.1", port), StubHandler)
+
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-p", "--port", dest="port", type="int", default=0, help="Port to listen on. Any free port by default.")
+  options, args = parser.parse_args()
+  server = create_server(options.port)
+  print(server.server_address[1])
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
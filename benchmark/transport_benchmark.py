@@ -0,0 +1,111 @@
+"""
+Compares the transports of RestClient.req_oauth against the local stub server.
+Every case sends the same requests one after another over a kept-alive connection from this process, and reports
+the throughput per core of the client: requests divided by the CPU time this process spent sending them. The stub
+server runs in a process of its own and its CPU time is not counted.
+
+Usage: python -m benchmark.transport_benchmark [-o FILE] [--quick] [-n REQUESTS]
+"""
+
+import json
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+from prettytable import PrettyTable
+
+from auth_backends import NoAuthClient, StaticAuthClient
+from benchmark.run_benchmark import start_stub
+from transport import TRANSPORTS, HTTPOptions
+
+CASES = [
+  {"name": "GET 128B", "method": "GET", "path": "/items/1?size=128&depth=1", "body": None, "auth": False},
+  {"name": "GET 16KB", "method": "GET", "path": "/items/1?size=16384&depth=1", "body": None, "auth": False},
+  {"name": "POST 1KB", "method": "POST", "path": "/items/1", "body": json.dumps({"payload": "x" * 1024}).encode("utf-8"),
+   "auth": False},
+  {"name": "GET 128B bearer", "method": "GET", "path": "/items/1?size=128&depth=1", "body": None, "auth": True},
+]
+
+
+def create_client(transport, auth):
+  # type: (str, bool) -> RestClient
+  options = HTTPOptions(timeout=30, transport=transport)
+  if auth:
+    return StaticAuthClient({"Authorization": "Bearer benchmark"}, options)
+  return NoAuthClient(options)
+
+
+def run_case(base_url, transport, case, requests):
+  # type: (str, str, dict, int) -> dict
+  client = create_client(transport, case["auth"])
+  url = base_url + case["path"]
+  # Opens the connection and warms up the code paths.
+  for _ in range(min(100, requests)):
+    client.req_oauth(url, case["method"], body=case["body"])
+  errors = 0
+  wall_start = time.perf_counter()
+  cpu_start = time.process_time()
+  for _ in range(requests):
+    if client.req_oauth(url, case["method"], body=case["body"]).status_code != 200:
+      errors += 1
+  cpu = time.process_time() - cpu_start
+  wall = time.perf_counter() - wall_start
+  client.transport.close()
+  return {
+    "name": case["name"],
+    "transport": transport,
+    "requests": requests,
+    "errors": errors,
+    "cpu_seconds": cpu,
+    "wall_seconds": wall,
+    "throughput": requests / wall if wall > 0 else 0.0,
+    "requests_per_core": requests / cpu if cpu > 0 else 0.0,
+    "cpu_per_request_us": cpu / requests * 1000000
+  }
+
+
+def run(requests):
+  # type: (int) -> list
+  stub, port = start_stub()
+  base_url = "http://127.0.0.1:%d" % port
+  results = []
+  try:
+    for case in CASES:
+      for transport in TRANSPORTS:
+        print("Running %s over %s..." % (case["name"], transport))
+        sys.stdout.flush()
+        results.append(run_case(base_url, transport, case, requests))
+  finally:
+    stub.terminate()
+    stub.wait()
+  return results
+
+
+def print_report(results):
+  t = PrettyTable(["Case", "Transport", "Requests", "Errors", "Req/s", "Req/s per core", "CPU/req(us)", "Speedup"])
+  baselines = {result["name"]: result for result in results if result["transport"] == TRANSPORTS[0]}
+  for result in results:
+    baseline = baselines[result["name"]]
+    t.add_row([result["name"], result["transport"], result["requests"], result["errors"],
+               "%.0f" % result["throughput"], "%.0f" % result["requests_per_core"],
+               "%.1f" % result["cpu_per_request_us"],
+               "%.2fx" % (result["requests_per_core"] / baseline["requests_per_core"])])
+  print(t)
+
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                    help="Also writes the results to a JSON file.")
+  parser.add_option("--quick", dest="quick", action="store_true", default=False,
+                    help="Sends fewer requests, for a fast smoke check.")
+  parser.add_option("-n", "--requests", dest="requests", type="int", metavar="N",
+                    help="Requests per case, 5000 by default (500 with --quick).")
+  options, args = parser.parse_args()
+  results = run(options.requests or (500 if options.quick else 5000))
+  print_report(results)
+  if options.output:
+    with open(options.output, "w") as outfile:
+      json.dump({"python": platform.python_version(), "platform": platform.platform(), "results": results},
+                outfile, indent=2)
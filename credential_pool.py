@@ -0,0 +1,194 @@
+import asyncio
+import csv
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from token_broker import TokenBroker
+
+# Enough for one user's session and token. Every pre-authenticated user gets a broker of this size.
+USER_BROKER_CAPACITY = 8 * 1024
+DEFAULT_AUTH_PARALLELISM = 8
+
+
+def load_credentials(filepath):
+  # type: (str) -> list
+  """
+  Reads a credentials file: a CSV file with "username" and "password" columns,
+  or a JSON array of {"username": ..., "password": ...} objects.
+
+  :return: The list of (username, password) tuples
+  """
+  with open(filepath) as credentials_file:
+    if filepath.lower().endswith(".csv"):
+      rows = list(csv.DictReader(credentials_file))
+    else:
+      rows = json.load(credentials_file)
+  return [(row["username"], row["password"]) for row in rows]
+
+
+class CredentialPool:
+  """
+  One authenticated client per user of a run.
+  A TestData row names its user with "username" (and optionally "password"); rows without one are assigned
+  the users of the credentials file round-robin, or use the user of the settings file.
+  Users are either authenticated in parallel before the run, so that every worker process inherits their clients,
+  or lazily by the worker that needs them first.
+  """
+
+  def __init__(self, create_client, default_user, credentials=None):
+    # type: (Callable, (str, str), list) -> None
+    """
+    :param create_client: Called with (username, password, token_broker) to log a user in
+    :param default_user: The (username, password) of the settings file
+    :param credentials: The list of (username, password) tuples of the credentials file
+    """
+    self.create_client = create_client
+    self.default_username = default_user[0]
+    self.credentials = credentials or []
+    self.passwords = dict([default_user] + self.credentials)
+    self.clients = {}
+    self.auth_durations = {}
+    self.auth_users = 0
+    self.auth_time = 0.0
+    self.auth_max = 0.0
+    self.lazy_logins = 0
+    self.lazy_login_time = 0.0
+    # Set by the async engine for the run in this process, see RestClient.async_pool_maxsize.
+    self.async_pool_maxsize = None
+    self._lock = threading.Lock()
+
+  def assign(self, test_data_list):
+    # type: (list) -> list
+    """
+    Gives every row without a "username" a user of the credentials file.
+
+    :return: The distinct users of the rows, in order of appearance. The settings file user counts for rows without a user.
+    """
+    users = []
+    for index, test_data in enumerate(test_data_list):
+      if "username" not in test_data and self.credentials:
+        test_data["username"] = self.credentials[index % len(self.credentials)][0]
+      if "password" in test_data:
+        self.passwords[test_data["username"]] = test_data.pop("password")
+      username = test_data.get("username", self.default_username)
+      if username not in users:
+        users.append(username)
+    return users
+
+  def _login(self, username, token_broker=None):
+    # type: (str, TokenBroker) -> RestClient
+    if username not in self.passwords:
+      raise KeyError("No password for user %s in TestData or the credentials file" % username)
+    start = time.perf_counter()
+    client = self.create_client(username, self.passwords[username], token_broker)
+    duration = time.perf_counter() - start
+    self.auth_durations[username] = duration
+    if token_broker is None:
+      self.lazy_logins += 1
+      self.lazy_login_time += duration
+    return client
+
+  def authenticate(self, usernames, parallelism=DEFAULT_AUTH_PARALLELISM):
+    # type: (list, int) -> None
+    """
+    Logs the users in, parallelism of them at once. Must run in the parent before the workers start,
+    so that the clients and their token brokers are shared with every worker.
+
+    :raises RuntimeError: If any user fails to log in
+    """
+    usernames = [username for username in usernames if username not in self.clients]
+    start = time.perf_counter()
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+      futures = [(username, executor.submit(self._login, username, TokenBroker(USER_BROKER_CAPACITY)))
+                 for username in usernames]
+      for username, future in futures:
+        try:
+          self.clients[username] = future.result()
+        except Exception as e:
+          failures.append("%s: %s" % (username, e))
+    self.auth_time += time.perf_counter() - start
+    durations = [self.auth_durations[username] for username in usernames if username in self.clients]
+    self.auth_users += len(durations)
+    self.auth_max = max([self.auth_max] + durations)
+    if failures:
+      raise RuntimeError("Authentication failed for %d user(s): %s" % (len(failures), "; ".join(failures)))
+
+  def client_for(self, test_data):
+    # type: (dict) -> RestClient
+    """
+    :return: The client of the row's user, logging the user in if that did not happen yet
+    """
+    username = test_data.get("username", self.default_username)
+    client = self.clients.get(username)
+    if client is None:
+      with self._lock:
+        client = self.clients.get(username)
+        if client is None:
+          client = self.clients[username] = self._login(username)
+    return client
+
+  async def async_client_for(self, test_data):
+    # type: (dict) -> RestClient
+    # A lazy login uses the blocking helpers, so it runs off the event loop.
+    if test_data.get("username", self.default_username) in self.clients:
+      client = self.client_for(test_data)
+    else:
+      client = await asyncio.get_running_loop().run_in_executor(None, self.client_for, test_data)
+    client.async_pool_maxsize = self.async_pool_maxsize
+    return client
+
+  def all_clients(self):
+    # type: () -> list
+    # Backends without users hand the same client to everybody.
+    clients = []
+    for client in self.clients.values():
+      if not any(client is known for known in clients):
+        clients.append(client)
+    return clients
+
+  def http_stats(self):
+    # type: () -> dict
+    stats = {"connections": 0, "requests": 0}
+    for client in self.all_clients():
+      client_stats = client.http_stats()
+      stats["connections"] += client_stats["connections"]
+      stats["requests"] += client_stats["requests"]
+    return stats
+
+  def sign_stats(self):
+    # type: () -> dict
+    stats = {"signed": 0, "sign_time": 0.0}
+    for client in self.all_clients():
+      client_stats = client.sign_stats()
+      stats["signed"] += client_stats["signed"]
+      stats["sign_time"] += client_stats["sign_time"]
+    return stats
+
+  async def close_async(self):
+    for client in self.all_clients():
+      if client._async_http is not None:
+        await client._async_http.close()
+
+  def token_stats(self):
+    # type: () -> dict
+    """
+    :return: The token broker stats summed over every user
+    """
+    stats = {"refreshes": 0, "refresh_time": 0.0, "waits": 0, "wait_time": 0.0, "max_wait": 0.0}
+    for client in self.all_clients():
+      if client.token_broker is None:
+        continue
+      broker_stats = client.token_broker.stats()
+      for key, value in broker_stats.items():
+        stats[key] = max(stats[key], value) if key == "max_wait" else stats[key] + value
+    return stats
+
+  def auth_stats(self):
+    # type: () -> dict
+    """
+    :return: Number of users logged in by authenticate, the wall time it took and the slowest login in seconds
+    """
+    return {"users": self.auth_users, "time": self.auth_time, "max": self.auth_max}
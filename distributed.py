@@ -0,0 +1,244 @@
+import json
+import os
+import resource
+import socket
+import time
+
+DEFAULT_PORT = 7461
+# Seconds between the moment every agent is ready and the start of the run, enough for the start message to arrive.
+DEFAULT_START_DELAY = 2.0
+AGENT_CONNECT_TIMEOUT = 30.0
+CLOCK_SYNC_ROUNDS = 5
+# An agent busier than this share of its cores is likely the bottleneck of the run, not the service.
+SATURATED_CPU = 0.8
+
+
+def parse_address(address, default_host="0.0.0.0"):
+  # type: (str, str) -> (str, int)
+  """
+  :param address: "HOST:PORT", "PORT" or "HOST"
+
+  :return: The (host, port) tuple
+  """
+  host, separator, port = address.rpartition(":")
+  if not separator:
+    return (default_host, int(address)) if address.isdigit() else (address, DEFAULT_PORT)
+  return host or default_host, int(port)
+
+
+def cpu_seconds():
+  # type: () -> float
+  """
+  :return: User and system CPU time of this process and its finished children
+  """
+  usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+  return sum(item.ru_utime + item.ru_stime for item in usage)
+
+
+class Channel:
+  """
+  Newline-delimited JSON messages over a TCP connection.
+  Every message has a "type"; an "error" message from the other side is raised as RuntimeError.
+  """
+
+  def __init__(self, sock):
+    # type: (socket.socket) -> None
+    self.sock = sock
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.reader = sock.makefile("rb")
+
+  def send(self, message_type, **fields):
+    fields["type"] = message_type
+    self.sock.sendall(json.dumps(fields).encode("utf-8") + b"\n")
+
+  def receive(self, expected=None):
+    # type: (str) -> dict
+    line = self.reader.readline()
+    if not line:
+      raise ConnectionError("Connection closed by %s" % (self.sock.getpeername(),))
+    message = json.loads(line)
+    if message["type"] == "error":
+      raise RuntimeError(message["message"])
+    if expected is not None and message["type"] != expected:
+      raise ValueError("Expected a %s message, got %s" % (expected, message["type"]))
+    return message
+
+  def close(self):
+    self.reader.close()
+    self.sock.close()
+
+
+class AgentInfo:
+  """
+  An agent connected to the coordinator
+  """
+
+  def __init__(self, channel, hello):
+    # type: (Channel, dict) -> None
+    self.channel = channel
+    self.name = hello["name"]
+    self.cores = hello["cores"]
+    self.engine = hello["engine"]
+    self.workers = hello["workers"]
+    # Agent clock minus coordinator clock, and the round trip it was measured with.
+    self.offset = 0.0
+    self.rtt = 0.0
+
+
+def split_test_data(data, count):
+  # type: (dict, int) -> list
+  """
+  Splits the TestData of a scenario, and the rows of its Feeder, round-robin into one scenario per agent.
+
+  :return: The list of (scenario, rate_scale). Each agent runs rate_scale of the LoadProfile arrival rate.
+  :raises ValueError: If there are fewer TestData rows than agents
+  """
+  rows = data["TestData"]
+  if len(rows) < count:
+    raise ValueError("TestData has %d row(s), fewer than the %d agent(s)" % (len(rows), count))
+  shares = []
+  for index in range(count):
+    scenario = dict(data, TestData=rows[index::count])
+    if "Feeder" in data:
+      # Every agent reads its own copy of the feeder file, and uses a disjoint part of its rows.
+      scenario["Feeder"] = dict(data["Feeder"], partition=[index, count])
+    shares.append((scenario, 1.0 / count))
+  return shares
+
+
+class Coordinator:
+  """
+  Splits a run among the agents that connect to it, starts them at the same moment and collects their results
+  """
+
+  def __init__(self, address, agents, start_delay=DEFAULT_START_DELAY):
+    # type: ((str, int), int, float) -> None
+    """
+    :param address: The (host, port) to listen on
+    :param agents: Number of agents to wait for
+    :param start_delay: Seconds between the last agent being ready and the start of the run
+    """
+    self.expected = agents
+    self.start_delay = start_delay
+    self.agents = []
+    self.server = socket.create_server(address)
+    self.server.listen(agents)
+
+  def address(self):
+    # type: () -> (str, int)
+    return self.server.getsockname()[:2]
+
+  def wait_for_agents(self):
+    # type: () -> list
+    """
+    Accepts connections until every expected agent said hello, and measures their clock offsets.
+
+    :return: The AgentInfo list
+    """
+    while len(self.agents) < self.expected:
+      sock, _ = self.server.accept()
+      channel = Channel(sock)
+      agent = AgentInfo(channel, channel.receive("hello"))
+      self._sync_clock(agent)
+      self.agents.append(agent)
+    return self.agents
+
+  def _sync_clock(self, agent):
+    # type: (AgentInfo) -> None
+    # NTP style: the agent's reply was taken halfway through the shortest round trip.
+    best = None
+    for _ in range(CLOCK_SYNC_ROUNDS):
+      sent = time.time()
+      agent.channel.send("ping")
+      reply = agent.channel.receive("pong")
+      received = time.time()
+      if best is None or received - sent < best[0]:
+        best = (received - sent, reply["time"] - (sent + received) / 2)
+    agent.rtt, agent.offset = best
+
+  def run(self, data):
+    # type: (dict) -> list
+    """
+    Sends every agent its share of the scenario, waits until all of them are ready (authenticated),
+    starts them at the same moment and waits for their results.
+
+    :return: The result message of every agent, in agent order
+    """
+    shares = split_test_data(data, len(self.agents))
+    for agent, (scenario, rate_scale) in zip(self.agents, shares):
+      agent.channel.send("prepare", data=scenario, rate_scale=rate_scale)
+    for agent in self.agents:
+      agent.channel.receive("ready")
+    start_at = time.time() + self.start_delay
+    for agent in self.agents:
+      agent.channel.send("start", start_at=start_at + agent.offset)
+    return [agent.channel.receive("result") for agent in self.agents]
+
+  def close(self):
+    for agent in self.agents:
+      agent.channel.close()
+    self.server.close()
+
+
+class AgentClient:
+  """
+  Connection of an agent to its coordinator
+  """
+
+  def __init__(self, address, engine, workers, timeout=AGENT_CONNECT_TIMEOUT):
+    # type: ((str, int), str, int, float) -> None
+    """
+    Connects to the coordinator, retrying until timeout so that agents can be started first.
+    """
+    self.name = "%s-%d" % (socket.gethostname(), os.getpid())
+    deadline = time.time() + timeout
+    while True:
+      try:
+        sock = socket.create_connection(address)
+        break
+      except ConnectionRefusedError:
+        if time.time() >= deadline:
+          raise
+        time.sleep(0.5)
+    self.channel = Channel(sock)
+    self.channel.send("hello", name=self.name, cores=os.cpu_count() or 1, engine=engine, workers=workers)
+
+  def wait_for_run(self):
+    # type: () -> (dict, float)
+    """
+    Answers the clock pings until the coordinator sends the scenario.
+
+    :return: The scenario of this agent and its share of the arrival rate
+    """
+    while True:
+      message = self.channel.receive()
+      if message["type"] == "ping":
+        self.channel.send("pong", time=time.time())
+      elif message["type"] == "prepare":
+        return message["data"], message["rate_scale"]
+      else:
+        raise ValueError("Unexpected %s message from the coordinator" % message["type"])
+
+  def ready(self):
+    self.channel.send("ready")
+
+  def wait_for_start(self):
+    # type: () -> float
+    """
+    Sleeps until the start time the coordinator sent.
+
+    :return: The start time in this agent's clock
+    """
+    start_at = self.channel.receive("start")["start_at"]
+    time.sleep(max(0.0, start_at - time.time()))
+    return start_at
+
+  def send_result(self, **result):
+    self.channel.send("result", name=self.name, cores=os.cpu_count() or 1, **result)
+
+  def send_error(self, message):
+    # type: (str) -> None
+    self.channel.send("error", message="Agent %s failed: %s" % (self.name, message))
+
+  def close(self):
+    self.channel.close()
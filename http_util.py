@@ -1,16 +1,577 @@
+import asyncio
 import http.client
+import json
 import logging
+import os
+import select
+import socket
 import ssl
+import threading
+from urllib.parse import urlsplit
+
+from utils.phasetiming import PhaseTimings
+
+log = logging.getLogger(__name__)
+
+# Errors that mean a kept-alive connection was closed by the server while it sat idle in the pool.
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                           BrokenPipeError, ConnectionAbortedError)
+
+# Methods that can be sent again when a reused connection fails after the request may have reached the server.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+
+_ssl_contexts = {}
+_ssl_context_lock = threading.Lock()
+
+
+def get_ssl_context(verify=False):
+  # type: (bool) -> ssl.SSLContext
+  """
+  Returns the process-wide SSL context. Building a context loads the cipher and CA setup,
+  so it is done once and shared by every HTTPS connection.
+
+  :param verify: Checks the certificate and host name of the server. The session and token endpoints
+                 are reached without checking them, load test targets are checked unless turned off.
+  """
+  context = _ssl_contexts.get(verify)
+  if context is None:
+    with _ssl_context_lock:
+      context = _ssl_contexts.get(verify)
+      if context is None:
+        context = _ssl_contexts[verify] = ssl.create_default_context() if verify else ssl._create_unverified_context()
+  return context
+
+
+def create_connection(address, timeout=None, source_address=None, socket_options=None, timings=None):
+  # type: ((str, int), float, tuple, list, PhaseTimings) -> socket.socket
+  """
+  socket.create_connection with the name lookup and the TCP handshake timed as the dns and connect phases.
+  Every address the name resolves to is tried in turn.
+
+  :param timeout: Socket timeout in seconds. Anything but a number leaves the socket default.
+  :param socket_options: (level, option, value) tuples set before connecting
+  """
+  host, port = address
+  addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+  if timings is not None:
+    timings.lap("dns")
+  error = None
+  for family, socktype, proto, _, sockaddr in addresses:
+    sock = socket.socket(family, socktype, proto)
+    try:
+      for option in socket_options or ():
+        sock.setsockopt(*option)
+      if isinstance(timeout, (int, float)):
+        sock.settimeout(timeout)
+      if source_address:
+        sock.bind(source_address)
+      sock.connect(sockaddr)
+    except OSError as e:
+      sock.close()
+      error = e
+      continue
+    if timings is not None:
+      timings.lap("connect")
+    return sock
+  raise error if error is not None else OSError("getaddrinfo returned no address for %s" % host)
+
+
+def is_connection_dropped(sock):
+  # type: (socket.socket) -> bool
+  """
+  :return: True if an idle connection was closed by the server. An idle connection has nothing to read otherwise.
+  """
+  if sock is None:
+    return True
+  try:
+    if hasattr(select, "poll"):
+      poller = select.poll()
+      poller.register(sock, select.POLLIN)
+      return bool(poller.poll(0))
+    return bool(select.select([sock], [], [], 0)[0])
+  except (OSError, ValueError):
+    return True
+
+
+class TimedHTTPConnection(http.client.HTTPConnection):
+  """
+  HTTPConnection that times its name lookup and connect into the timings of the request that opens it
+  """
+  timings = None
+
+  def __init__(self, *args, **kwargs):
+    http.client.HTTPConnection.__init__(self, *args, **kwargs)
+    self._create_connection = self._timed_create_connection
+
+  def _timed_create_connection(self, address, timeout=None, source_address=None):
+    return create_connection(address, timeout, source_address, timings=self.timings)
+
+
+class TimedHTTPSConnection(http.client.HTTPSConnection):
+  """
+  HTTPSConnection that also times its TLS handshake
+  """
+  timings = None
+
+  def __init__(self, *args, **kwargs):
+    http.client.HTTPSConnection.__init__(self, *args, **kwargs)
+    self._create_connection = self._timed_create_connection
+
+  def _timed_create_connection(self, address, timeout=None, source_address=None):
+    return create_connection(address, timeout, source_address, timings=self.timings)
+
+  def connect(self):
+    http.client.HTTPSConnection.connect(self)
+    if self.timings is not None:
+      self.timings.lap("tls")
+
+
+class PooledResponse:
+  """
+  Fully read response. The body is consumed up front so that the connection can go back to the pool.
+  """
+  def __init__(self, status, reason, headers, data, timings=None):
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.data = data
+    self.timings = timings
+
+  def read(self):
+    # type: () -> bytes
+    return self.data
+
+  def getheader(self, name, default=None):
+    return self.headers.get(name, default)
+
+  def __repr__(self):
+    return "<PooledResponse [%d %s]>" % (self.status, self.reason)
+
+
+class ConnectionPool:
+  """
+  Keeps idle keep-alive connections per (scheme, host, port) and reconnects once when a reused
+  connection turns out to be stale.
+  """
+  def __init__(self, maxsize=4, timeout=None):
+    self.maxsize = maxsize
+    self.timeout = timeout
+    self._idle = {}
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+    self.stats = {"connections": 0, "requests": 0, "reconnects": 0}
+
+  def _check_fork(self):
+    # Connections inherited from the parent process share its sockets, so a forked child starts over.
+    if self._pid != os.getpid():
+      self._idle = {}
+      self._lock = threading.Lock()
+      self._pid = os.getpid()
+      self.stats = {"connections": 0, "requests": 0, "reconnects": 0}
+
+  def _count(self, key):
+    with self._lock:
+      self.stats[key] += 1
+
+  def _new_connection(self, scheme, host, port):
+    # type: (str, str, int) -> http.client.HTTPConnection
+    self._count("connections")
+    if scheme == "https":
+      return TimedHTTPSConnection(host, port, timeout=self.timeout, context=get_ssl_context())
+    return TimedHTTPConnection(host, port, timeout=self.timeout)
+
+  def _acquire(self, key):
+    # type: (tuple) -> (http.client.HTTPConnection, bool)
+    with self._lock:
+      self._check_fork()
+      idle = self._idle.get(key)
+      while idle:
+        conn = idle.pop()
+        # Found before the request is written, so even a request that is not idempotent can go out on a new one.
+        if not is_connection_dropped(conn.sock):
+          return conn, True
+        conn.close()
+    return self._new_connection(*key), False
+
+  def _release(self, key, conn):
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.maxsize:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def _send(self, key, conn, reused, method, url, headers, body):
+    # type: (tuple, http.client.HTTPConnection, bool, str, str, dict, str) -> (PooledResponse, http.client.HTTPConnection)
+    timings = PhaseTimings()
+    written = []
+    try:
+      self._count("requests")
+      res, data = self._exchange(conn, timings, method, url, headers, body, written)
+    except STALE_CONNECTION_ERRORS:
+      conn.close()
+      # The server may have acted on a request it received, e.g. a login, so only idempotent ones are sent twice.
+      if not reused or (written and method not in IDEMPOTENT_METHODS):
+        raise
+      log.debug("Stale connection to %s://%s:%s, reconnecting" % key)
+      self._count("reconnects")
+      conn = self._new_connection(*key)
+      try:
+        self._count("requests")
+        res, data = self._exchange(conn, timings, method, url, headers, body)
+      except Exception:
+        conn.close()
+        raise
+    if res.will_close:
+      conn.close()
+      conn = None
+    return PooledResponse(res.status, res.reason, res.headers, data, timings), conn
+
+  def _exchange(self, conn, timings, method, url, headers, body, written=None):
+    # type: (http.client.HTTPConnection, PhaseTimings, str, str, dict, str, list) -> (http.client.HTTPResponse, bytes)
+    # A new connection opens inside request() and laps the setup phases itself.
+    # written gets an entry once the request is sent, after which the server may have received it.
+    conn.timings = timings
+    timings.start()
+    try:
+      conn.request(method=method, url=url, headers=headers or {}, body=body)
+      if written is not None:
+        written.append(True)
+      res = conn.getresponse()
+      timings.lap("ttfb")
+      data = res.read()
+      timings.finish()
+    finally:
+      conn.timings = None
+    return res, data
+
+  def request(self, scheme, host, port, method, url, headers=None, body=None):
+    # type: (str, str, int, str, str, dict, str) -> PooledResponse
+    key = (scheme, host, port)
+    conn, reused = self._acquire(key)
+    try:
+      res, conn = self._send(key, conn, reused, method, url, headers, body)
+    except Exception:
+      conn.close()
+      raise
+    if conn is not None:
+      self._release(key, conn)
+    return res
+
+  def close(self):
+    with self._lock:
+      for idle in self._idle.values():
+        for conn in idle:
+          conn.close()
+      self._idle = {}
+
+
+default_pool = ConnectionPool()
+
 
 def my_httpreq(host, port, headers, method, url, body=None):
-  # type: (str, int, dict, str, str, str) -> HTTPResponse
-  c = http.client.HTTPConnection(host, port)
-  c.request(method=method, url=url, headers=headers, body=body)
-  logging.debug("Got response: %s" % c.getresponse())
-  return c.getresponse()
+  # type: (str, int, dict, str, str, str) -> PooledResponse
+  res = default_pool.request("http", host, port, method, url, headers=headers, body=body)
+  log.debug("Got response: %s" % res)
+  return res
+
 
 def my_httpsreq(host, port, headers, method, url, body=None):
-  # type: (str, int, dict, str, str, str) -> HTTPSResponse
-  c = http.client.HTTPSConnection(host, port, context=ssl._create_unverified_context())
-  c.request(method=method, url=url, headers=headers, body=body)
-  return c.getresponse()
\ No newline at end of file
+  # type: (str, int, dict, str, str, str) -> PooledResponse
+  return default_pool.request("https", host, port, method, url, headers=headers, body=body)
+
+
+class SimpleResponse:
+  """
+  Minimal stand-in for requests.Response returned by the asyncio client.
+  """
+  def __init__(self, status_code, reason, headers, content, timings=None):
+    self.status_code = status_code
+    self.reason = reason
+    self.headers = headers
+    self.content = content
+    self.timings = timings
+
+  @property
+  def text(self):
+    # type: () -> str
+    return self.content.decode("utf-8", errors="replace")
+
+  def json(self):
+    return json.loads(self.content)
+
+  def __repr__(self):
+    return "<SimpleResponse [%d]>" % self.status_code
+
+
+def split_url(url):
+  # type: (str) -> (str, str, int, str)
+  parts = urlsplit(url)
+  scheme = parts.scheme or "http"
+  port = parts.port or (443 if scheme == "https" else 80)
+  path = parts.path or "/"
+  if parts.query:
+    path = "%s?%s" % (path, parts.query)
+  return scheme, parts.hostname, port, path
+
+
+def _has_body(method, status):
+  # type: (str, int) -> bool
+  return method != "HEAD" and status not in (204, 304) and not 100 <= status < 200
+
+
+async def _read_body(reader, headers, method, status):
+  # type: (asyncio.StreamReader, http.client.HTTPMessage, str, int) -> (bytes, bool)
+  if not _has_body(method, status):
+    return b"", False
+  if headers.get("Transfer-Encoding", "").lower() == "chunked":
+    chunks = []
+    async for chunk in _iter_chunked(reader):
+      chunks.append(chunk)
+    return b"".join(chunks), False
+  length = headers.get("Content-Length")
+  if length is not None:
+    return await reader.readexactly(int(length)), False
+  # Neither length nor chunking: the body runs until the server closes the connection.
+  return await reader.read(), True
+
+
+async def _iter_chunked(reader):
+  while True:
+    size = int((await reader.readuntil(b"\r\n")).split(b";", 1)[0], 16)
+    if size == 0:
+      # Skip trailers up to the terminating empty line.
+      while (await reader.readuntil(b"\r\n")) != b"\r\n":
+        pass
+      return
+    yield await reader.readexactly(size)
+    await reader.readexactly(2)
+
+
+async def _iter_body(reader, headers, chunk_size):
+  if headers.get("Transfer-Encoding", "").lower() == "chunked":
+    async for chunk in _iter_chunked(reader):
+      yield chunk
+    return
+  length = headers.get("Content-Length")
+  if length is None:
+    while True:
+      chunk = await reader.read(chunk_size)
+      if not chunk:
+        return
+      yield chunk
+  remaining = int(length)
+  while remaining > 0:
+    chunk = await reader.readexactly(min(remaining, chunk_size))
+    remaining -= len(chunk)
+    yield chunk
+
+
+class AsyncStreamingResponse(SimpleResponse):
+  """
+  Response whose body is still on the wire. The connection goes back to the pool only when the body was read
+  to the end, otherwise close() drops it.
+  """
+  def __init__(self, pool, key, conn, status_code, reason, headers, will_close, has_body, timings=None):
+    super().__init__(status_code, reason, headers, None, timings)
+    self._pool = pool
+    self._key = key
+    self._conn = conn
+    self._will_close = will_close or (has_body and "Content-Length" not in headers
+                                      and headers.get("Transfer-Encoding", "").lower() != "chunked")
+    self._consumed = not has_body
+    self.bytes_read = 0
+
+  async def iter_chunks(self, chunk_size=65536):
+    if self._consumed:
+      return
+    async for chunk in _iter_body(self._conn[0], self.headers, chunk_size):
+      self.bytes_read += len(chunk)
+      yield chunk
+    self._consumed = True
+    if self.timings is not None:
+      self.timings.finish()
+
+  async def read(self):
+    # type: () -> bytes
+    if self.content is None:
+      chunks = []
+      async for chunk in self.iter_chunks():
+        chunks.append(chunk)
+      self.content = b"".join(chunks)
+    return self.content
+
+  @property
+  def text(self):
+    # type: () -> str
+    return (self.content or b"").decode("utf-8", errors="replace")
+
+  def close(self):
+    if self._conn is None:
+      return
+    # A body abandoned halfway counts as downloaded up to here.
+    if self.timings is not None:
+      self.timings.finish()
+    if self._consumed and not self._will_close:
+      self._pool._release(self._key, self._conn)
+    else:
+      self._conn[1].close()
+    self._conn = None
+
+
+async def _connect_any(loop, host, addresses):
+  # type: (asyncio.AbstractEventLoop, str, list) -> socket.socket
+  # Tries every address the name resolves to, like socket.create_connection.
+  error = None
+  for family, socktype, proto, _, sockaddr in addresses:
+    sock = socket.socket(family, socktype, proto)
+    sock.setblocking(False)
+    try:
+      await loop.sock_connect(sock, sockaddr)
+    except OSError as e:
+      sock.close()
+      error = e
+      continue
+    except BaseException:
+      # Cancelled by the timeout of the pool.
+      sock.close()
+      raise
+    return sock
+  raise error if error is not None else OSError("getaddrinfo returned no address for %s" % host)
+
+
+class _LineReader:
+  """
+  Feeds already-read header lines to http.client.parse_headers.
+  """
+  def __init__(self, lines):
+    self._lines = iter(lines)
+
+  def readline(self, limit=-1):
+    return next(self._lines, b"")
+
+
+class AsyncConnectionPool:
+  """
+  asyncio counterpart of ConnectionPool. Speaks just enough HTTP/1.1 for the load engine:
+  keep-alive, Content-Length and chunked bodies. Idle connections are kept per (scheme, host, port)
+  and one stale reused connection is reopened transparently. The timeout covers opening a connection
+  as well as each exchange.
+  """
+  def __init__(self, maxsize=4, timeout=None, verify=True):
+    self.maxsize = maxsize
+    self.timeout = timeout
+    self.verify = verify
+    self._idle = {}
+    self.stats = {"connections": 0, "requests": 0, "reconnects": 0}
+
+  async def _open(self, key, timings):
+    # type: (tuple, PhaseTimings) -> (asyncio.StreamReader, asyncio.StreamWriter)
+    # Lookup, connect and handshake are separate steps so that each one is timed.
+    scheme, host, port = key
+    loop = asyncio.get_running_loop()
+    self.stats["connections"] += 1
+    try:
+      # IP literals need no lookup, and skip the executor thread of loop.getaddrinfo.
+      addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST)
+    except socket.gaierror:
+      addresses = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    timings.lap("dns")
+    sock = await _connect_any(loop, host, addresses)
+    timings.lap("connect")
+    try:
+      if scheme != "https":
+        return await asyncio.open_connection(sock=sock)
+      conn = await asyncio.open_connection(sock=sock, ssl=get_ssl_context(self.verify), server_hostname=host)
+    except BaseException:
+      sock.close()
+      raise
+    timings.lap("tls")
+    return conn
+
+  def _release(self, key, conn):
+    idle = self._idle.setdefault(key, [])
+    if len(idle) < self.maxsize:
+      idle.append(conn)
+      return
+    conn[1].close()
+
+  async def _exchange(self, key, conn, payload, method, stream, timings):
+    reader, writer = conn
+    timings.start()
+    writer.write(payload)
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+      raise http.client.RemoteDisconnected("Remote end closed connection without response")
+    version, status, reason = (status_line.decode("iso-8859-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+    status = int(status)
+    header_lines = []
+    while True:
+      line = await reader.readline()
+      header_lines.append(line)
+      if line in (b"\r\n", b"\n", b""):
+        break
+    headers = http.client.parse_headers(_LineReader(header_lines))
+    timings.lap("ttfb")
+    will_close = headers.get("Connection", "").lower() == "close" or version == "HTTP/1.0"
+    if stream:
+      return AsyncStreamingResponse(self, key, conn, status, reason, headers, will_close, _has_body(method, status),
+                                    timings), None
+    content, until_close = await _read_body(reader, headers, method, status)
+    timings.finish()
+    return SimpleResponse(status, reason, headers, content, timings), will_close or until_close
+
+  async def request(self, method, url, headers=None, body=None, stream=False):
+    # type: (str, str, dict, bytes, bool) -> SimpleResponse
+    """
+    Sends a request. With stream=True the body is left unread, and the caller reads it from the returned
+    AsyncStreamingResponse and must close() it.
+    """
+    scheme, host, port, path = split_url(url)
+    key = (scheme, host, port)
+    default_port = 443 if scheme == "https" else 80
+    lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % (host if port == default_port else "%s:%d" % (host, port))]
+    for name, value in (headers or {}).items():
+      lines.append("%s: %s" % (name, value))
+    if body is not None or method in ("POST", "PUT"):
+      lines.append("Content-Length: %d" % len(body or b""))
+    payload = ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1") + (body or b"")
+
+    timings = PhaseTimings()
+    idle = self._idle.get(key)
+    reused = bool(idle)
+    conn = idle.pop() if reused else await asyncio.wait_for(self._open(key, timings), self.timeout)
+    try:
+      self.stats["requests"] += 1
+      res, will_close = await asyncio.wait_for(self._exchange(key, conn, payload, method, stream, timings), self.timeout)
+    except STALE_CONNECTION_ERRORS + (asyncio.IncompleteReadError,):
+      conn[1].close()
+      if not reused:
+        raise
+      log.debug("Stale connection to %s://%s:%s, reconnecting" % key)
+      self.stats["reconnects"] += 1
+      timings.start()
+      conn = await asyncio.wait_for(self._open(key, timings), self.timeout)
+      try:
+        self.stats["requests"] += 1
+        res, will_close = await asyncio.wait_for(self._exchange(key, conn, payload, method, stream, timings), self.timeout)
+      except BaseException:
+        conn[1].close()
+        raise
+    except BaseException:
+      conn[1].close()
+      raise
+    if stream:
+      return res
+    if will_close:
+      conn[1].close()
+    else:
+      self._release(key, conn)
+    return res
+
+  async def close(self):
+    for idle in self._idle.values():
+      for reader, writer in idle:
+        writer.close()
+    self._idle = {}
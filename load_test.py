@@ -1,7 +1,11 @@
 #!/usr/local/bin/python
 
+import asyncio
 import http.client
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from http.client import HTTPResponse
 from optparse import OptionParser
 from urllib.parse import urlencode, quote
@@ -15,12 +19,22 @@ from requests_oauthlib import OAuth1
 import os
 import time
 from datetime import datetime
-from multiprocessing import Process
-
-from jinja2 import Template
+from multiprocessing import Process, Queue
 
+from scenario_plan import ScenarioPlan, profile_plan
+from distributed import AgentClient, Coordinator, SATURATED_CPU, cpu_seconds, parse_address
+from auth_backends import client_factory, get_backend, get_default_user
+from credential_pool import CredentialPool, load_credentials
 from utils.configmanager import ConfigManager
-from utils.parsingmanager import parse_options
+from utils.extractor import Extractor, ExtractionError
+from utils.feeder import DataFeeder, FeederExhausted
+from utils.loadprofile import LoadProfile
+from utils.metrics import MetricsAggregator, MetricsReporter, NullReporter, SeriesWriter, PrometheusWriter, ConsoleWriter
+from utils.logpipeline import LogPipeline, RequestSampler, LazyBody, LazyCall, cap_body, DEFAULT_BODY_LIMIT
+from utils.parsingmanager import parse_load_test_options
+from utils.phasetiming import PHASES
+from utils.errorcluster import summarize as summarize_errors
+from utils.runstats import RunStats
 from utils.stringutil import cut_msg
 import logging
 import sys
@@ -37,6 +51,11 @@ COLOR_TABLE = {
   "Reset": "\u001b[0m"
 }
 
+# Arrival-rate scheduler reports starts later than this (seconds) as falling behind.
+SCHEDULE_LAG_TOLERANCE = 0.01
+REPORT_PERCENTILES = [50, 90, 99, 99.9]
+STREAM_CHUNK_SIZE = 16384
+
 log = logging.getLogger(__name__)
 out_hdlr = logging.StreamHandler(sys.stdout)
 out_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
@@ -44,6 +63,16 @@ out_hdlr.setLevel(logging.DEBUG)
 log.addHandler(out_hdlr)
 log.setLevel(logging.DEBUG)
 
+# Per-request log lines are written for the requests picked by the sampler. Errors are always logged.
+sampler = RequestSampler()
+body_limit = DEFAULT_BODY_LIMIT
+# Set when live metrics are on. Every worker process reports to the channel through a reporter of its own.
+metrics_channel = None
+metrics_aggregator = None
+live_metrics = NullReporter()
+# Set when the test file has a "Feeder". Created before the workers are forked, so that they share its cursor.
+feeder = None
+
 def color_text(color, text):
   return "%s%s%s" % (COLOR_TABLE[color], text, COLOR_TABLE["Reset"])
 
@@ -60,24 +89,8 @@ def color_status_code(status_code):
 
 
 def get_params(test_data, result, variables):
-  updated_variables = {}
-  for key_item in variables.keys():
-    key_info = variables[key_item]
-    result_point = result
-    while True:
-      #log.debug(key_info)
-      #log.debug(result_point)
-      if key_info["type"] == "dict":
-        result_point = result_point[key_info["key"]]
-        key_info = key_info["child"]
-      elif key_info["type"] == "list":
-        result_point = result_point[int(key_info["index"])]
-        key_info = key_info["child"]
-      else:
-        test_data[key_item] = result_point[key_info["key"]]
-        updated_variables[key_item] = result_point[key_info["key"]]
-        break
-  #log.debug("Now test_data has: %s" % test_data)
+  updated_variables = Extractor(variables).extract(result)
+  test_data.update(updated_variables)
   return updated_variables
 
 
@@ -93,103 +106,786 @@ def print_variables(test_data, updated_variables):
   return t
 
 
-def run_test_case(test_data, scenario, iteration):
+def is_success(result):
+  return result.status_code >= 200 and result.status_code < 400
+
+
+def receive_result(step, test_data, result):
+  # type: (CompiledStep, dict, Response) -> (dict, Exception)
+  if not is_success(result) or step.variables is None:
+    return None, None
+  try:
+    extractor = step.get_extractor(test_data)
+    if step.stream_variables:
+      try:
+        updated_variables = extractor.extract_stream(result.iter_content(STREAM_CHUNK_SIZE))
+      finally:
+        result.close()
+    elif len(result.content) > 0:
+      updated_variables = extractor.extract_bytes(result.content)
+    else:
+      return None, None
+  except (ExtractionError, ValueError) as e:
+    return None, e
+  test_data.update(updated_variables)
+  return updated_variables, None
+
+
+async def receive_result_async(step, test_data, result):
+  # type: (CompiledStep, dict, SimpleResponse) -> (dict, Exception)
+  if not is_success(result) or step.variables is None:
+    if step.stream_variables:
+      await result.read()
+      result.close()
+    return None, None
+  try:
+    extractor = step.get_extractor(test_data)
+    if step.stream_variables:
+      extraction = extractor.stream()
+      try:
+        async for chunk in result.iter_chunks(STREAM_CHUNK_SIZE):
+          if extraction.feed(chunk):
+            break
+        else:
+          extraction.feed(None)
+      finally:
+        result.close()
+      updated_variables = extraction.result()
+    elif len(result.content) > 0:
+      updated_variables = extractor.extract_bytes(result.content)
+    else:
+      return None, None
+  except (ExtractionError, ValueError) as e:
+    return None, e
+  test_data.update(updated_variables)
+  return updated_variables, None
+
+
+def log_request(process_name, step, url, body):
+  log.info("%s <%s>\tRequesting: %s, method=%s", process_name, step.name, url, step.method)
+  if body is not None:
+    log.debug("%s Data: %s", process_name, LazyBody(body, body_limit))
+
+
+def start_live_metrics(worker_name):
+  # Runs in the worker process, the reporter thread does not survive a fork.
+  global live_metrics
+  if metrics_channel is not None:
+    live_metrics = MetricsReporter(metrics_channel, worker_name).start()
+
+
+def record_request(stats, status, step, latency, timings=None, lag=0.0):
+  if timings is not None:
+    # A streamed body has been read by now.
+    timings.finish()
+  stats.record(status, step.name, latency, timings, lag)
+  if lag > SCHEDULE_LAG_TOLERANCE:
+    stats.late_requests += 1
+  live_metrics.record(status, latency)
+
+
+def handle_result(process_name, step, test_data, result, error_log, i, stats=None, latency=None,
+                  updated_variables=None, extraction_error=None, sampled=True, lag=0.0):
+  if stats is not None:
+    record_request(stats, result.status_code, step, latency, result.timings, lag)
+  if is_success(result):
+    if sampled:
+      log.info("%s Status: %s", process_name, LazyCall(color_status_code, result.status_code))
+      if not step.stream_variables:
+        log.debug("%s Result: %s", process_name, LazyBody(result.content, body_limit))
+    if extraction_error is not None:
+      log.error("%s <%s> Variable extraction failed: %s", process_name, step.name, extraction_error)
+      error_log.add(result.status_code, "Variable extraction failed: %s" % extraction_error, i)
+    elif updated_variables and sampled:
+      log.info("%s ---Variables---\n%s", process_name, LazyCall(print_variables, test_data, updated_variables))
+  else:
+    message = cap_body(result.content, body_limit)
+    log.warning("%s <%s> Status: %s", process_name, step.name, LazyCall(color_status_code, result.status_code))
+    log.debug("%s Result: %s", process_name, message)
+    error_log.add(result.status_code, message, i)
+
+
+def report_errors(process_name, error_log):
+  # The errors themselves are listed by cluster in the run report.
+  if len(error_log) > 0:
+    log.error("%s %d Error Occurred in %d cluster(s)", process_name, len(error_log), len(error_log.clusters))
+
+
+def iteration_lag(stats, scheduled_at, now):
+  # type: (RunStats, float, float) -> float
+  # Seconds an iteration starts behind its schedule. Every request of the iteration is that much later than intended.
+  lag = max(0.0, now - scheduled_at)
+  if lag > SCHEDULE_LAG_TOLERANCE:
+    stats.late_starts += 1
+    stats.max_lag = max(stats.max_lag, lag)
+  return lag
+
+
+def draw_row(process_name, test_data, user_index):
+  # type: (str, dict, int) -> bool
+  # Puts the next feeder row into the variables of the user. False once a unique feeder has run out.
+  if feeder is None:
+    return True
+  try:
+    test_data.update(feeder.next_row(user_index))
+  except FeederExhausted as e:
+    log.info("%s %s, stopping", process_name, e)
+    return False
+  return True
+
+
+def run_step(process_name, client, step, test_data, i, stats, error_log, lag, lock):
+  # Runs in a thread of the user when the steps of an iteration run concurrently, so the stats are updated under lock.
+  renderedUrl = step.render_url(test_data)
+  renderedBody = step.render_body(test_data)
+  sampled = sampler.sample()
+  if sampled:
+    log_request(process_name, step, renderedUrl, renderedBody)
+  live_metrics.request_started()
+  request_start = time.perf_counter()
+  try:
+    result = client.req_oauth(renderedUrl, step.method, body=renderedBody, stream=step.stream_variables)
+    updated_variables, extraction_error = receive_result(step, test_data, result)
+  except (OSError, requests.RequestException, http.client.HTTPException) as e:
+    log.error("%s <%s> Request to %s failed: %s", process_name, step.name, renderedUrl, e)
+    with lock:
+      error_log.add(0, "%s: %s" % (type(e).__name__, e), i)
+      record_request(stats, 0, step, time.perf_counter() - request_start, lag=lag)
+    return
+  latency = time.perf_counter() - request_start
+  with lock:
+    handle_result(process_name, step, test_data, result, error_log, i, stats, latency,
+      updated_variables, extraction_error, sampled, lag)
+  if step.delay is not None:
+    if sampled:
+      log.info("%s Sleeping %d seconds...", process_name, step.delay)
+    time.sleep(step.delay)
+
+
+def run_test_case(test_data, plan, iteration, result_queue=None, pacing=None, user_index=0):
   proc = os.getpid()
-  error_log = []
+  stats = RunStats("PID(%d)" % proc if "name" not in test_data else test_data['name'])
+  error_log = stats.error_clusters
+  stats.users = 1
   process_name = "PID(%d)" % proc if "name" not in test_data else "PID(%d) <%s>" % (proc, test_data['name'])
-  for i in range(0, iteration):
-    log.info("%s Iteration:%d Start" % (process_name, i))
-    for step in scenario:
-      urlTemplate = Template(step['url'])
-      renderedUrl = urlTemplate.render(**test_data)
-      log.info("%s <%s>\tRequesting: %s, method=%s" % (process_name, step['name'], renderedUrl, step['method']))
-      if "data" in step:
-        dataTemplate = Template(json.dumps(step['data']))
-        renderedData = dataTemplate.render(**test_data)
-        log.debug("%s Data: %s" % (process_name, renderedData))
-        result = client.req_oauth(renderedUrl, step['method'], json.loads(renderedData))
-      else:
-        result = client.req_oauth(renderedUrl, step['method'])
-      log.info("%s Status: %s" % (process_name, color_status_code(result.status_code)))
-      log.debug("%s Result: %s" % (process_name, result.text))
-      if result.status_code >= 200 and result.status_code < 400:
-        if len(result.text) > 0:
-          variableTemplate = Template(json.dumps(step["variables"]))
-          renderedVariable = variableTemplate.render(**test_data)
-          updated_variables = get_params(test_data, json.loads(result.text), json.loads(renderedVariable))
-          log.info("%s ---Variables---\n%s" % (process_name, print_variables(test_data, updated_variables)))
+  start_live_metrics(process_name)
+  live_metrics.user_started()
+  start = time.time()
+  executor = None
+  # The parent waits for the stats of every process, so they are sent even when the user fails.
+  try:
+    # A lazy login happens here, before the clock of the run starts.
+    client = credential_pool.client_for(test_data)
+    start = time.time()
+    # Independent steps of an iteration are sent from a thread each.
+    executor = None if plan.is_serial else ThreadPoolExecutor(plan.width, "step")
+    stats_lock = threading.Lock()
+    # With pacing, iteration i of the user is meant to start i * pacing seconds after the first one.
+    stats.scheduled = bool(pacing)
+    schedule_start = time.perf_counter()
+    for i in range(0, iteration):
+      lag = 0.0
+      if pacing:
+        wait = schedule_start + i * pacing - time.perf_counter()
+        if wait > 0:
+          time.sleep(wait)
+        lag = iteration_lag(stats, schedule_start + i * pacing, time.perf_counter())
+      if not draw_row(process_name, test_data, user_index):
+        break
+      iteration_start = time.perf_counter()
+      if not sampler.errors_only:
+        log.info("%s Iteration:%d Start", process_name, i)
+      if executor is None:
+        for step in plan:
+          run_step(process_name, client, step, test_data, i, stats, error_log, lag, stats_lock)
       else:
-        error_log.append({"iteration": iteration, "status": result.status_code, "message": result.text})
-      if "delayToNext" in step:
-        log.info("%s Sleeping %d seconds..." % (process_name, step["delayToNext"]))
-        time.sleep(step["delayToNext"])
-    log.info("%s Iteration:%d End" % (process_name, i))
-    
-  if len(error_log) > 0:
-    log.error("%s %d Error Occurred\n" % (process_name, len(error_log)))
-    for error_item in error_log:
-      log.error(
-        "%s iteration: %d | status: %s\n %s" 
-          % (process_name, error_item['iteration'], color_status_code(error_item['status']), error_item['message'])
-      )
+        plan.run(partial(run_step, process_name, client, test_data=test_data, i=i, stats=stats,
+          error_log=error_log, lag=lag, lock=stats_lock), executor)
+      stats.iterations += 1
+      stats.record_iteration(time.perf_counter() - iteration_start)
+      if not sampler.errors_only:
+        log.info("%s Iteration:%d End", process_name, i)
+  finally:
+    if executor is not None:
+      executor.shutdown()
+    live_metrics.user_finished()
+    live_metrics.stop()
+    report_errors(process_name, error_log)
+    http_stats = credential_pool.http_stats()
+    stats.elapsed = time.time() - start
+    stats.connections = http_stats["connections"]
+    stats.logins = credential_pool.lazy_logins
+    stats.login_time = credential_pool.lazy_login_time
+    sign_stats = credential_pool.sign_stats()
+    stats.signed = sign_stats["signed"]
+    stats.sign_time = sign_stats["sign_time"]
+    log.info("%s Connections opened: %d, requests sent: %d" % (process_name, http_stats["connections"], http_stats["requests"]))
+    if result_queue is not None:
+      result_queue.put(stats.to_dict())
+
+
+async def run_step_async(process_name, client, step, test_data, i, stats, error_log, lag):
+  renderedUrl = step.render_url(test_data)
+  renderedBody = step.render_body(test_data)
+  sampled = sampler.sample()
+  if sampled:
+    log_request(process_name, step, renderedUrl, renderedBody)
+  live_metrics.request_started()
+  request_start = time.perf_counter()
+  try:
+    result = await client.async_req_oauth(renderedUrl, step.method, body=renderedBody, stream=step.stream_variables)
+    updated_variables, extraction_error = await receive_result_async(step, test_data, result)
+  except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, http.client.HTTPException) as e:
+    log.error("%s <%s> Request to %s failed: %s", process_name, step.name, renderedUrl, e)
+    error_log.add(0, "%s: %s" % (type(e).__name__, e), i)
+    record_request(stats, 0, step, time.perf_counter() - request_start, lag=lag)
+    return
+  handle_result(process_name, step, test_data, result, error_log, i, stats, time.perf_counter() - request_start,
+    updated_variables, extraction_error, sampled, lag)
+  if step.delay is not None:
+    if sampled:
+      log.info("%s Sleeping %d seconds...", process_name, step.delay)
+    await asyncio.sleep(step.delay)
+
+
+async def run_iteration(process_name, test_data, plan, i, stats, error_log, scheduled_at=None):
+  # scheduled_at is the loop time the iteration was meant to start at, by the arrival rate or the pacing.
+  loop = asyncio.get_running_loop()
+  iteration_start = loop.time()
+  lag = 0.0 if scheduled_at is None else max(0.0, iteration_start - scheduled_at)
+  client = await credential_pool.async_client_for(test_data)
+  if not sampler.errors_only:
+    log.info("%s Iteration:%d Start", process_name, i)
+  if plan.is_serial:
+    for step in plan:
+      await run_step_async(process_name, client, step, test_data, i, stats, error_log, lag)
+  else:
+    await plan.run_async(partial(run_step_async, process_name, client, test_data=test_data, i=i, stats=stats,
+      error_log=error_log, lag=lag))
+  stats.iterations += 1
+  stats.record_iteration(loop.time() - iteration_start)
+  if not sampler.errors_only:
+    log.info("%s Iteration:%d End", process_name, i)
+
+
+async def run_virtual_user(test_data, plan, iteration, user_index, stats, pacing=None):
+  # Same flow as run_test_case, but as a coroutine so that thousands of users can share one process.
+  proc = os.getpid()
+  # The virtual users of a worker share its error clusters.
+  error_log = stats.error_clusters
+  process_name = "PID(%d) VU(%d)" % (proc, user_index) if "name" not in test_data else "PID(%d) VU(%d) <%s>" % (proc, user_index, test_data['name'])
+  live_metrics.user_started()
+  loop = asyncio.get_running_loop()
+  schedule_start = loop.time()
+  for i in range(0, iteration):
+    scheduled_at = None
+    if pacing:
+      scheduled_at = schedule_start + i * pacing
+      if scheduled_at > loop.time():
+        await asyncio.sleep(scheduled_at - loop.time())
+      iteration_lag(stats, scheduled_at, loop.time())
+    if not draw_row(process_name, test_data, user_index):
+      break
+    await run_iteration(process_name, test_data, plan, i, stats, error_log, scheduled_at)
+  live_metrics.user_finished()
+
+
+async def run_arrival_schedule(indexed_test_data, plan, profile, stats):
+  # Open model: iterations start when the profile says so, whether or not earlier ones have finished.
+  loop = asyncio.get_running_loop()
+  proc = os.getpid()
+  error_log = stats.error_clusters
+  in_flight = set()
+  last_warning = None
+  start = loop.time()
+  for n, offset in enumerate(profile.arrival_times()):
+    lag = loop.time() - start - offset
+    if lag < 0:
+      await asyncio.sleep(-lag)
+      lag = loop.time() - start - offset
+    else:
+      # Let in-flight iterations make progress while catching up.
+      await asyncio.sleep(0)
+    if lag > SCHEDULE_LAG_TOLERANCE:
+      stats.late_starts += 1
+      stats.max_lag = max(stats.max_lag, lag)
+      if last_warning is None or loop.time() - last_warning >= 1.0:
+        log.warning("PID(%d) Scheduler is %.3f seconds behind the requested rate (%.1f/s), %d iterations in flight"
+          % (proc, lag, profile.rate_at(offset), len(in_flight)))
+        last_warning = loop.time()
+    if profile.max_in_flight and len(in_flight) >= profile.max_in_flight:
+      stats.dropped += 1
+      continue
+    user_index, test_data = indexed_test_data[n % len(indexed_test_data)]
+    process_name = "PID(%d) IT(%d)" % (proc, n) if "name" not in test_data else "PID(%d) IT(%d) <%s>" % (proc, n, test_data['name'])
+    test_data = dict(test_data)
+    if not draw_row(process_name, test_data, user_index):
+      break
+    task = loop.create_task(run_iteration(process_name, test_data, plan, n, stats, error_log, start + offset))
+    in_flight.add(task)
+    task.add_done_callback(in_flight.discard)
+    # An iteration in flight is an active user of the open model.
+    live_metrics.user_started()
+    task.add_done_callback(lambda task: live_metrics.user_finished())
+    stats.users = max(stats.users, len(in_flight))
+  if in_flight:
+    await asyncio.gather(*in_flight)
+
+
+async def run_virtual_users(indexed_test_data, plan, iteration, stats, profile=None, pacing=None, pool_maxsize=None):
+  start = time.time()
+  credential_pool.async_pool_maxsize = pool_maxsize
+  stats.scheduled = profile is not None or bool(pacing)
+  try:
+    if profile is not None:
+      await run_arrival_schedule(indexed_test_data, plan, profile, stats)
+    else:
+      # Every virtual user shares the process, so each one gets its own copy of its TestData row.
+      users = [run_virtual_user(dict(test_data), plan, iteration, index, stats, pacing)
+               for index, test_data in indexed_test_data]
+      stats.users += len(users)
+      await asyncio.gather(*users)
+  finally:
+    stats.elapsed = time.time() - start
+    report_errors("PID(%d)" % os.getpid(), stats.error_clusters)
+    await credential_pool.close_async()
+    stats.connections = credential_pool.http_stats()["connections"]
+    stats.logins = credential_pool.lazy_logins
+    stats.login_time = credential_pool.lazy_login_time
+    sign_stats = credential_pool.sign_stats()
+    stats.signed = sign_stats["signed"]
+    stats.sign_time = sign_stats["sign_time"]
+
+
+def shard_test_data(test_data_list, workers):
+  # type: (list, int) -> list
+  # Round-robin keeps the shards even and every row keeps its global user index.
+  indexed = list(enumerate(test_data_list))
+  return [indexed[worker::workers] for worker in range(workers) if indexed[worker::workers]]
+
+
+def run_async_worker(worker_index, indexed_test_data, plan, iteration, profile, pacing, pool_maxsize, result_queue):
+  stats = RunStats("worker-%d" % worker_index)
+  start_live_metrics(stats.name)
+  try:
+    asyncio.run(run_virtual_users(indexed_test_data, plan, iteration, stats, profile, pacing, pool_maxsize))
+  finally:
+    live_metrics.stop()
+    result_queue.put(stats.to_dict())
+
+
+def print_run_summary(worker_stats, total):
+  t = PrettyTable(["Worker", "Users", "Requests", "Errors", "Connections", "Elapsed(s)", "Req/s"])
+  for stats in worker_stats + [total]:
+    t.add_row([stats.name, stats.users, stats.requests, stats.errors, stats.connections,
+      "%.2f" % stats.elapsed, "%.1f" % stats.throughput()])
+  log.info("Run summary\n%s" % t)
+  log.info("Status codes: %s" % ", ".join("%s=%d" % (color_status_code(status), count)
+    for status, count in sorted(total.status_counts.items())))
+  if total.late_starts or total.dropped:
+    log.warning("Scheduler fell behind: %d of %d iterations started late (max lag %.3f seconds), %d dropped at the in-flight limit"
+      % (total.late_starts, total.iterations + total.dropped, total.max_lag, total.dropped))
+
+
+def print_error_clusters(total):
+  if not total.error_clusters.clusters:
+    return
+  t = PrettyTable(["Count", "Status", "First iteration", "Pattern"])
+  t.align["Pattern"] = "l"
+  for count, status, first_iteration, pattern in summarize_errors(total.error_clusters):
+    t.add_row([count, status, first_iteration, pattern])
+  log.error("%d error(s) in %d cluster(s)\n%s", len(total.error_clusters), len(total.error_clusters.clusters), t)
+  if total.error_clusters.overflow:
+    log.error("%d error(s) did not fit in the cluster limit and are only counted", total.error_clusters.overflow)
+
+
+def latency_table(histograms, plan, elapsed):
+  # Steps are listed in scenario order, latencies in milliseconds.
+  t = PrettyTable(["Step", "Count", "Req/s", "p50", "p90", "p99", "p99.9", "Max"])
+  for step in plan:
+    histogram = histograms.get(step.name)
+    if histogram is None:
+      continue
+    values = histogram.percentiles(REPORT_PERCENTILES)
+    t.add_row([step.name, histogram.total_count,
+      "%.1f" % (histogram.total_count / elapsed if elapsed > 0 else 0.0)]
+      + ["%.1f" % (values[percentile] / 1000.0) for percentile in REPORT_PERCENTILES]
+      + ["%.1f" % (histogram.max_recorded / 1000.0)])
+  return t
+
+
+def print_latency_report(total, plan):
+  log.info("Latency per step (ms)\n%s" % latency_table(total.step_histograms, plan, total.elapsed))
+  # The raw latency starts when a request is sent, so a stall that holds back the next requests of a user does not show.
+  corrected, expected_interval, omitted = total.corrected_histograms()
+  log.info("Latency per step corrected for coordinated omission (ms)\n%s" % latency_table(corrected, plan, total.elapsed))
+  if expected_interval is None:
+    log.info("Corrected latency counts from the intended start of every request by the schedule: %d request(s) started"
+      " more than %d ms late" % (total.late_requests, SCHEDULE_LAG_TOLERANCE * 1000))
+  else:
+    log.info("Corrected latency assumes every user meant to start an iteration every %.1f ms (the median iteration,"
+      " set \"Pacing\" for an explicit schedule): %d request(s) held back by stalls were added"
+      % (expected_interval / 1000.0, omitted))
+
+
+def print_phase_report(total, plan):
+  # Setup phases are the mean per new connection, TTFB and download the mean per request, in milliseconds.
+  t = PrettyTable(["Step", "Requests", "New conns", "DNS", "Connect", "TLS", "TTFB", "Download", "Setup total(s)"])
+  setup = requests = new_connections = 0
+  for step in plan:
+    phases = total.step_phases.get(step.name)
+    if phases is None:
+      continue
+    t.add_row([step.name, phases.requests, phases.new_connections]
+      + ["%.2f" % (phases.mean(phase) * 1000) for phase in PHASES] + ["%.3f" % phases.setup()])
+    setup += phases.setup()
+    requests += phases.requests
+    new_connections += phases.new_connections
+  if not requests:
+    return
+  log.info("Request phases per step (ms)\n%s" % t)
+  if new_connections:
+    log.info("%d of %d request(s) opened a connection, %.3f seconds in total (%.1f ms each): reusing connections"
+      " (keep-alive, a larger pool) would save most of that", new_connections, requests, setup, setup / new_connections * 1000)
+
+
+def export_histograms(total, filepath):
+  with open(filepath, 'w') as outfile:
+    json.dump({
+      "elapsed": total.elapsed,
+      "steps": {step: histogram.to_dict() for step, histogram in total.step_histograms.items()},
+      "corrected_steps": {step: histogram.to_dict() for step, histogram in total.corrected_histograms()[0].items()}
+    }, outfile)
+  log.info("Histograms are exported to %s" % filepath)
+
+
+def print_auth_stats(total, auth_stats):
+  if auth_stats["users"]:
+    log.info("Authentication before the run: %d user(s) in %.3f seconds (slowest login %.3f seconds), not included in the latencies"
+      % (auth_stats["users"], auth_stats["time"], auth_stats["max"]))
+  if total.logins:
+    log.info("Lazy authentication during the run: %d login(s), %.3f seconds in total, not included in the latencies"
+      % (total.logins, total.login_time))
+
+
+def print_sign_stats(total):
+  if total.signed:
+    log.info("Request signing: %d request(s), %.1f us per request, %.3f seconds in total"
+      % (total.signed, total.sign_time / total.signed * 1000000, total.sign_time))
+
+
+def print_token_stats(token_stats):
+  log.info("Token refreshes: %d (%.3f seconds), workers that waited for a refresh: %d (total %.3f seconds, max %.3f seconds)"
+    % (token_stats["refreshes"], token_stats["refresh_time"], token_stats["waits"], token_stats["wait_time"],
+       token_stats["max_wait"]))
 
 
-def run_test_main(data):  
+def stop_metrics():
+  # The workers are done, so the last seconds are written before the report.
+  if metrics_aggregator is not None:
+    metrics_aggregator.stop()
+    if options.metrics_file:
+      log.info("Per-second metrics are written to %s", options.metrics_file)
+
+
+def report_run(worker_stats, plan, histogram_file=None, auth_stats=None, token_stats=None):
+  stop_metrics()
+  total = RunStats("total")
+  for stats in worker_stats:
+    total.merge(stats)
+  print_run_summary(worker_stats, total)
+  print_latency_report(total, plan)
+  print_phase_report(total, plan)
+  print_error_clusters(total)
+  # The credential pool of this process, unless the run happened on agents.
+  print_auth_stats(total, auth_stats or credential_pool.auth_stats())
+  print_sign_stats(total)
+  print_token_stats(token_stats or credential_pool.token_stats())
+  if histogram_file:
+    export_histograms(total, histogram_file)
+  return total
+
+
+def get_pacing(data):
+  # type: (dict) -> float
+  # Seconds between the starts of two iterations of a closed-model user, None to run them back to back.
+  return float(data["Pacing"]) if data.get("Pacing") else None
+
+
+def run_process_workers(data, plan):
   procs = []
   iteration = int(data["TestIteration"])
+  result_queue = Queue()
   # Do multi process run
-  for test_data in data["TestData"]:
-    proc = Process(target=run_test_case, args=(test_data, data["Scenario"],iteration))
+  pacing = get_pacing(data)
+  for user_index, test_data in enumerate(data["TestData"]):
+    proc = Process(target=run_test_case, args=(test_data, plan, iteration, result_queue, pacing, user_index))
     procs.append(proc)
     proc.start()
+  worker_stats = [RunStats.from_dict(result_queue.get()) for _ in procs]
   for proc in procs:
     proc.join()
+  return worker_stats
+
+
+def run_plan_profile(data):
+  iteration = int(data.get("TestIteration", 1))
+  result = profile_plan(data["Scenario"], data.get("TestData", []), iteration)
+  t = PrettyTable(["Mode", "Total(s)", "Per step(us)"])
+  t.add_row(["Template per iteration", "%.4f" % result["legacy_seconds"], "%.1f" % result["legacy_us_per_step"]])
+  t.add_row(["Compiled plan", "%.4f" % result["compiled_seconds"], "%.1f" % result["compiled_us_per_step"]])
+  log.info("Request preparation for %d step renders (%d of %d steps need no rendering)\n%s"
+    % (result["renders"], result["static_steps"], result["steps"], t))
+  log.info("Compiled plan saved %.4f seconds, net of its compile time of %.4f seconds" % (result["saved_seconds"], result["compile_seconds"]))
+  return result
+
+
+def worker_profile(profile, rate_scale, worker_index, workers):
+  # type: (LoadProfile, float, int, int) -> LoadProfile
+  # Every worker drives an equal share of the requested arrival rate, or of this agent's share of it,
+  # shifted so that the workers take turns.
+  if profile is None:
+    return None
+  return profile.scaled(rate_scale / workers, float(worker_index) / workers)
+
+
+def run_async_workers(data, plan, workers=None, rate_scale=1.0):
+  iteration = int(data.get("TestIteration", 1))
+  shards = shard_test_data(data["TestData"], workers or os.cpu_count() or 1)
+  # The virtual users of a worker share the pools of their clients, which must keep a connection for each of them.
+  pool_maxsize = max(http_options.pool_maxsize, max(len(shard) for shard in shards))
+  pacing = get_pacing(data)
+  profile = None
+  if "LoadProfile" in data:
+    profile = LoadProfile.parse(data["LoadProfile"])
+    pool_maxsize = max(pool_maxsize, profile.max_in_flight)
+    log.info("Arrival-rate profile: %d stage(s), %.1f seconds, %.0f arrival(s) over %d worker(s)"
+      % (len(profile.stages), profile.duration, profile.expected_arrivals() * rate_scale, len(shards)))
+  worker_stats = []
+  if len(shards) == 1:
+    stats = RunStats("worker-0")
+    start_live_metrics(stats.name)
+    try:
+      asyncio.run(run_virtual_users(shards[0], plan, iteration, stats, worker_profile(profile, rate_scale, 0, 1), pacing,
+        pool_maxsize))
+    finally:
+      live_metrics.stop()
+    worker_stats.append(stats)
+  else:
+    result_queue = Queue()
+    procs = []
+    for worker_index, shard in enumerate(shards):
+      proc = Process(target=run_async_worker, args=(worker_index, shard, plan, iteration,
+        worker_profile(profile, rate_scale, worker_index, len(shards)), pacing, pool_maxsize, result_queue))
+      procs.append(proc)
+      proc.start()
+    # Drain the queue before joining, a worker blocks on exit until its result is consumed.
+    for _ in procs:
+      worker_stats.append(RunStats.from_dict(result_queue.get()))
+    for proc in procs:
+      proc.join()
+    worker_stats.sort(key=lambda stats: int(stats.name.split("-")[1]))
+  return worker_stats
+
+
+def authenticate_users(data):
+  users = credential_pool.assign(data["TestData"])
+  if options.auth_parallelism > 0:
+    # Users are logged in before the workers start, so that the workers inherit their tokens and token brokers.
+    log.info("Authenticating %d user(s)..." % len(users))
+    credential_pool.authenticate(users, options.auth_parallelism)
+
+
+def print_agent_summary(results):
+  # CPU is the share of the agent's cores used during the run. Start lag is how late the agent started.
+  t = PrettyTable(["Agent", "Users", "Requests", "Errors", "Req/s", "CPU(%)", "Start lag(ms)", "Late starts", "Max lag(s)"])
+  for result in results:
+    total = result["total"]
+    t.add_row([result["name"], total.users, total.requests, total.errors, "%.1f" % total.throughput(),
+      "%.0f" % (result["cpu_utilization"] * 100), "%.1f" % (result["start_lag"] * 1000), total.late_starts,
+      "%.3f" % total.max_lag])
+  log.info("Agents\n%s", t)
+  for result in results:
+    if result["cpu_utilization"] >= SATURATED_CPU or result["total"].late_starts:
+      log.warning("Agent %s used %.0f%% of its %d core(s) and started %d iteration(s) late: the load generator itself"
+        " may be the bottleneck, add agents or workers", result["name"], result["cpu_utilization"] * 100,
+        result["cores"], result["total"].late_starts)
+
+
+def sum_stats(stats_list):
+  # The max_* fields are maxima, everything else adds up.
+  total = {}
+  for stats in stats_list:
+    for key, value in stats.items():
+      total[key] = max(total.get(key, 0), value) if key.startswith("max") else total.get(key, 0) + value
+  return total
+
+
+def run_coordinator(data, address, agents, start_delay, histogram_file=None):
+  plan = ScenarioPlan(data["Scenario"], not options.serial_steps)
+  coordinator = Coordinator(address, agents, start_delay)
+  try:
+    log.info("Waiting for %d agent(s) on %s:%d...", agents, *coordinator.address())
+    for agent in coordinator.wait_for_agents():
+      log.info("Agent %s connected: %d core(s), %s engine, clock offset %.1f ms (round trip %.1f ms)",
+        agent.name, agent.cores, agent.engine, agent.offset * 1000, agent.rtt * 1000)
+    results = coordinator.run(data)
+  finally:
+    coordinator.close()
+  worker_stats = []
+  for result in results:
+    agent_stats = [RunStats.from_dict(stats) for stats in result["worker_stats"]]
+    for stats in agent_stats:
+      stats.name = "%s/%s" % (result["name"], stats.name)
+    result["total"] = RunStats(result["name"])
+    for stats in agent_stats:
+      result["total"].merge(stats)
+    worker_stats += agent_stats
+  total = report_run(worker_stats, plan, histogram_file, sum_stats(result["auth_stats"] for result in results),
+    sum_stats(result["token_stats"] for result in results))
+  print_agent_summary(results)
+  return total
+
+
+def run_agent(address):
+  agent = AgentClient(address, options.engine, options.workers)
+  log.info("Agent %s connected to the coordinator at %s:%d", agent.name, *address)
+  try:
+    data, rate_scale = agent.wait_for_run()
+    log.info("Received %d TestData row(s)", len(data["TestData"]))
+    plan = ScenarioPlan(data["Scenario"], not options.serial_steps)
+    authenticate_users(data)
+    agent.ready()
+    start_at = agent.wait_for_start()
+    start = time.time()
+    cpu_start = cpu_seconds()
+    worker_stats = run_workers(data, plan, rate_scale)
+    elapsed = time.time() - start
+    cpu = cpu_seconds() - cpu_start
+  except Exception as e:
+    agent.send_error("%s: %s" % (type(e).__name__, e))
+    agent.close()
+    raise
+  report_run(worker_stats, plan)
+  cores = os.cpu_count() or 1
+  agent.send_result(worker_stats=[stats.to_dict() for stats in worker_stats], auth_stats=credential_pool.auth_stats(),
+    token_stats=credential_pool.token_stats(), start_lag=start - start_at, elapsed=elapsed,
+    cpu_utilization=cpu / (elapsed * cores) if elapsed > 0 else 0.0)
+  agent.close()
+
+
+def open_feeder(data):
+  # type: (dict) -> DataFeeder
+  config = data.get("Feeder")
+  if not config:
+    return None
+  data_feeder = DataFeeder(config["file"], config.get("policy", "circular"), len(data["TestData"]),
+    tuple(config.get("partition", (0, 1))), config.get("seed"))
+  log.info("Feeding %d row(s) of %s to %d user(s), %s policy", len(data_feeder), config["file"], len(data["TestData"]),
+    data_feeder.policy)
+  return data_feeder
+
+
+def expand_users(data):
+  # type: (dict) -> dict
+  # With a feeder, the users can be given as a count of empty TestData rows.
+  if "TestData" not in data and "Users" in data:
+    data["TestData"] = [{} for _ in range(int(data["Users"]))]
+  return data
+
+
+def run_workers(data, plan, rate_scale=1.0):
+  global feeder
+  if not plan.is_serial:
+    log.info("Up to %d of the %d scenario steps run concurrently", plan.width, len(plan))
+  feeder = open_feeder(data)
+  if options.engine == "async":
+    return run_async_workers(data, plan, options.workers, rate_scale)
+  if "LoadProfile" in data:
+    raise ValueError("LoadProfile is only supported by the async engine (-e async).")
+  return run_process_workers(data, plan)
+
+
+def add_file_handler(name):
+  file_hdlr = logging.FileHandler('logs/load_test_%s_%s.log' % (name, datetime.now().strftime("%Y%m%d-%H%M%S")))
+  file_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+  file_hdlr.setLevel(logging.DEBUG)
+  log.addHandler(file_hdlr)
 
 
 """
 ====================== Main ===========================
 """
 if __name__ == "__main__":
-  configFilePath, testFilePath, detail = parse_options()
+  options = parse_load_test_options()
+  configFilePath, testFilePath, detail = options.filename, options.testcase, options.detail
 
   if detail:
     log.setLevel(logging.DEBUG)
   else:
     log.setLevel(logging.INFO)
 
+  if testFilePath is None and options.agent is None:
+    print ("No test file is provided.")
+    exit(-1)
+  if options.profile_plan:
+    with open(testFilePath) as data_file:
+      run_plan_profile(expand_users(json.load(data_file)))
+    exit(0)
+  if options.coordinator is not None:
+    # The coordinator sends no request itself, so it needs no settings file.
+    add_file_handler("coordinator")
+    log_pipeline = LogPipeline(log)
+    log_pipeline.start()
+    with open(testFilePath) as data_file:
+      data = expand_users(json.load(data_file))
+    log.info("Load testing:%s" % testFilePath)
+    run_coordinator(data, parse_address(options.coordinator), options.agents, options.start_delay, options.histogram_file)
+    log_pipeline.stop()
+    exit(0)
   if configFilePath is None:
     print ("No config file is provided.")
     exit(-1)
-  if testFilePath is None:
-    print ("No test file is provided.")
-    exit(-1)
   
   config = ConfigManager(configFilePath).parse()
-  oauth_host = config["OAuth"]["Host"]
-  oauth_port = int(str(config["OAuth"]["Port"]))
-  oauth_url = config["OAuth"]["URL"]
-  oauth_use_http = config["OAuth"]["UseHTTP"]
-  oauth_concept = config["OAuth"]["Concept"]
-  oauth_user = config["OAuth"]["UserName"]
-  oauth_pw = config["OAuth"]["Password"]
-  oauth_version = config["OAuth"]["Version"]
-  oauth_consumer_key = config["OAuth"]["consumer_key"]
-  oauth_consumer_secret = config["OAuth"]["consumer_secret"]
-  domain = config["OAuth"]["domain"]
+  oauth_user, oauth_pw = get_default_user(config)
+  http_options = oauth_util.HTTPOptions.from_config(config.get("HTTP"))
 
   # Logging file as well
-  file_hdlr = logging.FileHandler('logs/load_test_%s_%s.log' % (oauth_user, datetime.now().strftime("%Y%m%d-%H%M%S")))
-  file_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
-  file_hdlr.setLevel(logging.DEBUG)
-  log.addHandler(file_hdlr)
+  add_file_handler(oauth_user or get_backend(config))
+  # Workers only put records on a queue, the parent writes them. Must start before any worker is forked.
+  log_pipeline = LogPipeline(log)
+  log_pipeline.start()
+  # The live console line replaces the per-request lines.
+  sampler = RequestSampler(options.log_sample, options.log_errors_only or options.live)
+  body_limit = options.log_body_limit
+  metrics_writers = []
+  if options.metrics_file:
+    metrics_writers.append(SeriesWriter(options.metrics_file))
+  if options.prometheus_file:
+    metrics_writers.append(PrometheusWriter(options.prometheus_file))
+  if options.live:
+    metrics_writers.append(ConsoleWriter(log))
+  if metrics_writers:
+    metrics_channel = Queue()
+    metrics_aggregator = MetricsAggregator(metrics_channel, metrics_writers).start()
 
-  client = oauth_util.CernerOAuthUtil(oauth_host, oauth_port, oauth_url, oauth_user, oauth_pw,
-    use_http=oauth_use_http,
-    consumer_key=oauth_consumer_key,
-    consumer_secret=oauth_consumer_secret,
-    domain=domain)
-  
-  with open(testFilePath) as data_file:
-    data = json.load(data_file)
+  create_client = client_factory(config, http_options)
+  credentials = load_credentials(options.credentials) if options.credentials else None
+  credential_pool = CredentialPool(create_client, (oauth_user, oauth_pw), credentials)
+
+  if options.agent is not None:
+    run_agent(parse_address(options.agent, "127.0.0.1"))
+  else:
+    with open(testFilePath) as data_file:
+      data = expand_users(json.load(data_file))
     log.info("Load testing:%s" % testFilePath)
-    run_test_main(data)
+    plan = ScenarioPlan(data["Scenario"], not options.serial_steps)
+    authenticate_users(data)
+    try:
+      worker_stats = run_workers(data, plan)
+    except ValueError as e:
+      log.error("%s", e)
+      exit(-1)
+    report_run(worker_stats, plan, options.histogram_file)
+  log_pipeline.stop()
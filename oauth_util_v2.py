@@ -1,49 +1,48 @@
+import asyncio
 import base64
 import json
+import os
 import requests
 import random
+import threading
 import time
 import hmac
 from datetime import datetime, timedelta
 from hashlib import sha1
 from urllib.parse import urlencode, quote_plus
+from requests.auth import AuthBase
+from oauthlib.oauth1 import Client as OAuth1Signer
 from requests_oauthlib import OAuth1
-from http_util import my_httpreq, my_httpsreq
+from http_util import AsyncConnectionPool, my_httpreq, my_httpsreq
+from transport import HTTPOptions, PooledHTTPAdapter, Transport, create_http_session, create_transport
+from utils.phasetiming import begin_timings, end_timings
 
-def cache_session(domain, username, session):
-  with open('oauth_session_%s_%s.json' % (domain, username), 'w') as outfile:
-    json.dump(session, outfile)
 
-
-def load_session_from_cache(domain, username):
-  try:
-      fh = open('oauth_session_%s_%s.json' % (domain, username), 'r')
-      with fh as cache_session_file:
-        return json.load(cache_session_file)
-  except FileNotFoundError:
-      return None
-
-
-def req_session(host, port, url_session, username, password, use_http = False, **kwargs):
-  # type: (str, int, str, str, str, dict) -> Object
-  req_hdr = {"Accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"}
-  body = urlencode(
+def _session_body(username, password):
+  # type: (str, str) -> str
+  return urlencode(
     {
       "username": username,
       "password": password,
       "login_method": "PASSWORD"
     }
   )
+
+
+def req_session(host, port, url_session, username, password, use_http = False, **kwargs):
+  # type: (str, int, str, str, str, dict) -> Object
+  req_hdr = {"Accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"}
+  body = _session_body(username, password)
   res = my_httpreq(host, port, req_hdr, "POST", url_session, body=body) if use_http else my_httpsreq(host, port, req_hdr, "POST", url_session, body=body)
   res = res.read()
   res = json.loads(res)
   return res
 
 
-def req_token(host, port, identityStatement, clientMnemonic, authority, **kwargs):
-  # type: (str, int, str, dict) -> Object
+def req_token(host, port, identityStatement, clientMnemonic, authority, use_http = False, **kwargs):
+  # type: (str, int, str, str, str, bool, dict) -> Object
   url_token = ("/oauth/%s/%s/tokens" % (clientMnemonic, authority))
-  url = "https://%s%s" % (host, url_token)
+  url = "%s://%s%s" % ("http" if use_http else "https", host, url_token)
   req_hdr = {"Accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"}
   timestamp = int(time.time())
   nonce = random.randint(0, 100000000)
@@ -67,7 +66,7 @@ def req_token(host, port, identityStatement, clientMnemonic, authority, **kwargs
   oauth_params["oauth_signature"] = oauthSignature64
 
   body = urlencode(oauth_params)
-  res = my_httpsreq(host, port, req_hdr, "POST", url_token, body=body)
+  res = my_httpreq(host, port, req_hdr, "POST", url_token, body=body) if use_http else my_httpsreq(host, port, req_hdr, "POST", url_token, body=body)
   res = res.read()
   res = json.loads(res)
   return res
@@ -97,8 +96,142 @@ def req_oauth(url_req, username, password, method=None, data=None, **kwargs):
     raise RuntimeError("Unsupported HTTP request method.")
 
 
-class CernerOAuthUtil:
-  def __init__(self, host, port, url_session, username, password, use_http, consumer_key, consumer_secret, domain):
+class TimedAuth(AuthBase):
+  """
+  Wraps a requests auth so that the time spent signing adds up in the client's signing stats.
+  """
+  def __init__(self, client, auth):
+    self.client = client
+    self.auth = auth
+
+  def __call__(self, r):
+    start = time.perf_counter()
+    r = self.auth(r)
+    self.client.sign_time += time.perf_counter() - start
+    self.client.signed += 1
+    return r
+
+
+class RestClient:
+  """
+  Pooled HTTP client. Subclasses decide how requests are authenticated by overriding
+  ensure_auth (keep the credentials fresh), requests_auth (sync requests) and sign (async requests).
+  """
+  token_broker = None
+  # Connections the async pool keeps per host, pool_maxsize of the options if not set.
+  async_pool_maxsize = None
+
+  def __init__(self, http_options=None):
+    self.http_options = http_options if http_options is not None else HTTPOptions()
+    self._transport = None
+    self._transport_pid = None
+    self._async_http = None
+    self._async_http_loop = None
+    self.signed = 0
+    self.sign_time = 0.0
+
+  @property
+  def transport(self):
+    # type: () -> Transport
+    # Sockets must not be shared across fork(), so every process lazily builds its own transport.
+    if self._transport is None or self._transport_pid != os.getpid():
+      self._transport = create_transport(self.http_options)
+      self._transport_pid = os.getpid()
+    return self._transport
+
+  def http_stats(self):
+    # type: () -> dict
+    stats = {"connections": 0, "requests": 0}
+    pools = []
+    if self._transport is not None and self._transport_pid == os.getpid():
+      pools.append(self._transport.stats())
+    if self._async_http is not None:
+      pools.append(self._async_http.stats)
+    for pool_stats in pools:
+      stats["connections"] += pool_stats["connections"]
+      stats["requests"] += pool_stats["requests"]
+    return stats
+
+  @property
+  def async_http(self):
+    # type: () -> AsyncConnectionPool
+    # asyncio streams belong to the loop that opened them, so the pool follows the running loop.
+    loop = asyncio.get_running_loop()
+    if self._async_http is None or self._async_http_loop is not loop:
+      self._async_http = AsyncConnectionPool(maxsize=self.async_pool_maxsize or self.http_options.pool_maxsize,
+                                              timeout=self.http_options.timeout, verify=self.http_options.verify)
+      self._async_http_loop = loop
+    return self._async_http
+
+  def sign_stats(self):
+    # type: () -> dict
+    """
+    :return: Number of requests signed by this process and the seconds spent signing them
+    """
+    return {"signed": self.signed, "sign_time": self.sign_time}
+
+  def ensure_auth(self):
+    pass
+
+  async def async_ensure_auth(self):
+    self.ensure_auth()
+
+  def requests_auth(self):
+    # type: () -> AuthBase
+    return None
+
+  def sign(self, method, url, headers):
+    # type: (str, str, dict) -> (str, dict)
+    return url, headers
+
+  def req_oauth(self, url_req, method=None, data=None, body=None, stream=False, **kwargs):
+    # body is an already serialized JSON payload (bytes) and takes precedence over data.
+    # With stream=True the response body is left unread for the caller to consume, and to finish() the
+    # download phase of response.timings once it has.
+    timings = begin_timings()
+    try:
+      response = self._send(url_req, method, data, body, stream, timings)
+    finally:
+      end_timings()
+    if not stream:
+      timings.finish()
+    response.timings = timings
+    return response
+
+  def _send(self, url_req, method, data, body, stream, timings):
+    self.ensure_auth()
+    if (data is not None or body is not None) and method is None:
+      method = "POST"
+    elif method is None:
+      method = "GET"
+    if method not in ("GET", "POST", "PUT", "DELETE"):
+      raise RuntimeError("Unsupported HTTP request method.")
+    if method == "GET":
+      body = None
+    elif body is None and data is not None:
+      body = json.dumps(data).encode("utf-8")
+    return self.transport.send(self, method, url_req, body, stream, timings)
+
+  async def async_req_oauth(self, url_req, method=None, data=None, body=None, stream=False, **kwargs):
+    await self.async_ensure_auth()
+    req_hdr = {"Accept": "application/json", "Content-Type": "application/json"}
+    if (data is not None or body is not None) and method is None:
+      method = "POST"
+    elif method is None:
+      method = "GET"
+    if method not in ("GET", "POST", "PUT", "DELETE"):
+      raise RuntimeError("Unsupported HTTP request method.")
+    if method == "GET":
+      body = None
+    elif body is None and data is not None:
+      body = json.dumps(data).encode("utf-8")
+    url_req, req_hdr = self.sign(method, url_req, req_hdr)
+    return await self.async_http.request(method, url_req, headers=req_hdr, body=body, stream=stream)
+
+
+class CernerOAuthUtil(RestClient):
+  def __init__(self, host, port, url_session, username, password, use_http, consumer_key, consumer_secret, domain,
+               http_options=None, refresh_margin=0, token_broker=None, credential_cache=None):
     self.host = host
     self.port = port
     self.username = username
@@ -112,41 +245,133 @@ class CernerOAuthUtil:
     self.token = None
     self.token_expires = None
     self.session_expires = None
-    self.get_session()
-    self.get_token()
+    # Seconds before expiry at which the session and token are refreshed, capped at half of their lifetime.
+    self.refresh_margin = refresh_margin
+    self.token_refresh_at = None
+    self.session_refresh_at = None
+    self.token_broker = token_broker
+    self.credentials_version = 0
+    self.credential_cache = credential_cache
+    RestClient.__init__(self, http_options)
+    # The OAuth1 auth and signer are built once per token and reused by every request.
+    self._signed_token = None
+    self._auth = None
+    self._signer = None
+    self._token_lock = threading.Lock()
+    self.login()
+    if self.token_broker is not None:
+      self.token_broker.publish(self.credentials())
+      self.credentials_version = self.token_broker.version
+
+  def login(self):
+    # Starts from the cached session and token while they are valid, and only asks the server for what is missing.
+    if self.credential_cache is not None:
+      credentials = self.credential_cache.load(self.domain, self.username)
+      if credentials is not None:
+        self.adopt_credentials(credentials, self.credentials_version)
+        print("Credential cache hit: session valid until %s, token valid until %s" % (self.session_expires, self.token_expires))
+    if self.is_token_expired():
+      self.refresh_expired()
 
   def get_session(self):
-    self.session = load_session_from_cache(self.domain, self.username)
-    if self.session is None:
-        self.session = req_session(self.host, self.port, self.url_session, self.username, self.password, self.use_http, domain=self.domain)["session"]
-        cache_session(self.domain, self.username, self.session)
-    else:
-      print("Session cache hit: %s" % self.session)
+    self.session = req_session(self.host, self.port, self.url_session, self.username, self.password, self.use_http, domain=self.domain)["session"]
 
   def get_token(self):
     self.token = req_token(self.host, self.port, self.session["identityStatement"], self.session["clientMnemonic"], self.session["authority"],
-      consumer_key=self.consumer_key, consumer_secret=self.consumer_secret)['response']['oauth_parameter']
-    self.session_expires = datetime.now() + timedelta(seconds=self.token['oauth_authorization_expires_in'])
-    self.token_expires = datetime.now() + timedelta(seconds=self.token['oauth_expires_in'])
+      use_http=self.use_http, consumer_key=self.consumer_key, consumer_secret=self.consumer_secret)['response']['oauth_parameter']
+    now = datetime.now()
+    self.session_expires = now + timedelta(seconds=self.token['oauth_authorization_expires_in'])
+    self.token_expires = now + timedelta(seconds=self.token['oauth_expires_in'])
+    self.session_refresh_at = self.session_expires - self._margin(self.token['oauth_authorization_expires_in'])
+    self.token_refresh_at = self.token_expires - self._margin(self.token['oauth_expires_in'])
+
+  def _margin(self, lifetime):
+    # type: (float) -> timedelta
+    return timedelta(seconds=min(self.refresh_margin, lifetime / 2.0))
+
+  def credentials(self):
+    # type: () -> dict
+    """
+    The session and token with their expiry times, in a JSON friendly form for the token broker and the credential cache.
+    """
+    return {
+      "session": self.session,
+      "token": self.token,
+      "session_expires": self.session_expires.timestamp(),
+      "token_expires": self.token_expires.timestamp(),
+      "session_refresh_at": self.session_refresh_at.timestamp(),
+      "token_refresh_at": self.token_refresh_at.timestamp()
+    }
 
-  def req_oauth(self, url_req, method=None, data=None, **kwargs):
-    if self.session_expires is None or self.session_expires < datetime.now():
+  def adopt_credentials(self, credentials, version):
+    # type: (dict, int) -> None
+    self.session = credentials["session"]
+    self.token = credentials["token"]
+    self.session_expires = datetime.fromtimestamp(credentials["session_expires"])
+    self.token_expires = datetime.fromtimestamp(credentials["token_expires"])
+    self.session_refresh_at = datetime.fromtimestamp(credentials["session_refresh_at"])
+    self.token_refresh_at = datetime.fromtimestamp(credentials["token_refresh_at"])
+    self.credentials_version = version
+
+  def is_token_expired(self):
+    # type: () -> bool
+    # True once the session or token is within the refresh margin of its expiry.
+    now = datetime.now()
+    return self.session_refresh_at is None or self.session_refresh_at < now or self.token_refresh_at is None or self.token_refresh_at < now
+
+  def refresh_expired(self):
+    if self.session_refresh_at is None or self.session_refresh_at < datetime.now():
       self.get_session()
-    if self.token_expires is None or self.token_expires < datetime.now():
+      # A new session needs a new token as well.
+      self.token_refresh_at = None
+    if self.token_refresh_at is None or self.token_refresh_at < datetime.now():
       self.get_token()
-    req_hdr = req_hdr = {"Accept": "application/json", "Content-Type": "application/json"}
-    auth = OAuth1(self.consumer_key, self.consumer_secret, self.token["oauth_token"], self.token["oauth_token_secret"])
-    if data is not None and method is None:
-      method = "POST"
-    elif data is None and method is None:
-      method = "GET"
-    if method == "GET":
-      return requests.get(url_req, auth=auth, headers=req_hdr)
-    elif method == "POST":
-      return requests.post(url_req, json=data, auth=auth, headers=req_hdr)
-    elif method == "PUT":
-      return requests.put(url_req, json=data, auth=auth, headers=req_hdr)
-    elif method == "DELETE":
-      return requests.delete(url_req, json=data, auth=auth, headers=req_hdr)
-    else:
-      raise RuntimeError("Unsupported HTTP request method.")
+      if self.credential_cache is not None:
+        self.credential_cache.store(self.domain, self.username, self.credentials())
+
+  def refresh_token(self):
+    with self._token_lock:
+      if self.token_broker is not None:
+        self.token_broker.refresh(self)
+      elif self.is_token_expired():
+        self.refresh_expired()
+
+  def sync_token(self):
+    # Picks up credentials another process refreshed through the broker. The version check does not take the lock.
+    if self.token_broker is not None and self.token_broker.version != self.credentials_version:
+      with self._token_lock:
+        credentials, version = self.token_broker.load()
+        if credentials is not None:
+          self.adopt_credentials(credentials, version)
+
+  def ensure_auth(self):
+    self.sync_token()
+    if self.is_token_expired():
+      self.refresh_token()
+
+  async def async_ensure_auth(self):
+    self.sync_token()
+    if self.is_token_expired():
+      # Session and token endpoints use the blocking helpers, so keep them off the event loop.
+      await asyncio.get_running_loop().run_in_executor(None, self.refresh_token)
+
+  def _update_signer(self):
+    token = self.token
+    if self._signed_token is not token:
+      self._auth = TimedAuth(self, OAuth1(self.consumer_key, self.consumer_secret, token["oauth_token"], token["oauth_token_secret"]))
+      self._signer = OAuth1Signer(self.consumer_key, self.consumer_secret, token["oauth_token"], token["oauth_token_secret"])
+      self._signed_token = token
+
+  def requests_auth(self):
+    # type: () -> AuthBase
+    self._update_signer()
+    return self._auth
+
+  def sign(self, method, url, headers):
+    # type: (str, str, dict) -> (str, dict)
+    self._update_signer()
+    start = time.perf_counter()
+    url, headers, _ = self._signer.sign(url, http_method=method, headers=headers)
+    self.sign_time += time.perf_counter() - start
+    self.signed += 1
+    return url, headers
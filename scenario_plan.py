@@ -0,0 +1,298 @@
+import asyncio
+import json
+import time
+from collections import namedtuple
+from concurrent import futures
+
+from jinja2 import Environment, Template, meta
+
+from utils.extractor import Extractor
+
+# Anything that can start a Jinja2 construct. Sources without these render to themselves.
+TEMPLATE_MARKERS = ("{{", "{%", "{#")
+
+EXTRACTOR_CACHE_SIZE = 256
+
+_environment = Environment()
+
+
+def has_placeholders(source):
+  # type: (str) -> bool
+  return any(marker in source for marker in TEMPLATE_MARKERS)
+
+
+def referenced_variables(source):
+  # type: (str) -> frozenset
+  """
+  :return: The names of the variables a template reads
+  """
+  if not has_placeholders(source):
+    return frozenset()
+  return frozenset(meta.find_undeclared_variables(_environment.parse(source)))
+
+
+class CompiledTemplate:
+  """
+  Template compiled once per run. Sources without placeholders skip rendering altogether.
+  """
+  __slots__ = ("source", "template")
+
+  def __init__(self, source):
+    self.source = source
+    self.template = _environment.from_string(source) if has_placeholders(source) else None
+
+  @property
+  def is_static(self):
+    # type: () -> bool
+    return self.template is None
+
+  def render(self, variables):
+    # type: (dict) -> str
+    if self.template is None:
+      return self.source
+    return self.template.render(variables)
+
+
+_CompiledStepFields = namedtuple("_CompiledStepFields", [
+  "name", "method", "url", "body", "static_body", "variables", "static_variables", "extractor", "stream_variables",
+  "references", "produces", "parallel", "delay", "extractor_cache"])
+
+
+class CompiledStep(_CompiledStepFields):
+  """
+  Immutable execution plan of one Scenario step. Steps compare and hash by identity, like other objects.
+  """
+  __slots__ = ()
+  __eq__ = object.__eq__
+  __ne__ = object.__ne__
+  __hash__ = object.__hash__
+
+  def __new__(cls, step):
+    # type: (dict) -> CompiledStep
+    url = CompiledTemplate(step['url'])
+    body = CompiledTemplate(json.dumps(step['data'])) if "data" in step else None
+    variables = CompiledTemplate(json.dumps(step['variables'])) if "variables" in step else None
+    static_variables = step['variables'] if variables is not None and variables.is_static else None
+    # What the dependency graph of the plan is built from: the variables the templates of the step read,
+    # and the ones its extraction sets.
+    sources = [template.source for template in (url, body, variables) if template is not None]
+    return _CompiledStepFields.__new__(
+      cls,
+      name=step['name'],
+      method=step.get('method', "POST" if "data" in step else "GET"),
+      url=url,
+      body=body,
+      static_body=body.source.encode("utf-8") if body is not None and body.is_static else None,
+      variables=variables,
+      static_variables=static_variables,
+      extractor=Extractor(static_variables) if static_variables is not None else None,
+      # Streaming pulls only the extracted fields off the wire instead of parsing the whole body.
+      stream_variables=bool(step.get("streamVariables", False)) and variables is not None,
+      references=frozenset().union(*(referenced_variables(source) for source in sources)),
+      produces=frozenset(step['variables']) if "variables" in step else frozenset(),
+      # "parallel": false keeps the step in order with every other step.
+      parallel=bool(step.get("parallel", True)),
+      delay=step.get("delayToNext"),
+      # Extractors of templated descriptors, by rendering. The only part of a step that changes.
+      extractor_cache={})
+
+  def render_url(self, test_data):
+    # type: (dict) -> str
+    return self.url.render(test_data)
+
+  def render_body(self, test_data):
+    # type: (dict) -> bytes
+    """
+    Renders the request body straight to the bytes that go on the wire, None if the step has no data.
+    """
+    if self.static_body is not None or self.body is None:
+      return self.static_body
+    return self.body.render(test_data).encode("utf-8")
+
+  def render_variables(self, test_data):
+    # type: (dict) -> dict
+    if self.static_variables is not None or self.variables is None:
+      return self.static_variables
+    return json.loads(self.variables.render(test_data))
+
+  def get_extractor(self, test_data):
+    # type: (dict) -> Extractor
+    if self.extractor is not None or self.variables is None:
+      return self.extractor
+    # Templated descriptors are compiled once per distinct rendering.
+    rendered = self.variables.render(test_data)
+    extractor = self.extractor_cache.get(rendered)
+    if extractor is None:
+      if len(self.extractor_cache) >= EXTRACTOR_CACHE_SIZE:
+        self.extractor_cache.clear()
+      extractor = self.extractor_cache[rendered] = Extractor(json.loads(rendered))
+    return extractor
+
+
+def depends_on(step, earlier):
+  # type: (CompiledStep, CompiledStep) -> bool
+  """
+  :return: True if step has to wait for an earlier step of the scenario: it reads a variable the earlier step
+           extracts, extracts one the earlier step reads or extracts too, or either of them opted out of running in
+           parallel. A step with a non-zero delayToNext holds back every later step.
+  """
+  if not (step.parallel and earlier.parallel) or earlier.delay:
+    return True
+  return bool(earlier.produces & (step.references | step.produces) or step.produces & earlier.references)
+
+
+class ScenarioPlan:
+  """
+  Scenario compiled once per run into immutable steps.
+  Steps that do not depend on each other run concurrently within an iteration, unless concurrent is False.
+  """
+  def __init__(self, scenario, concurrent=True):
+    # type: (list, bool) -> None
+    self.scenario = scenario
+    self.steps = tuple(CompiledStep(step) for step in scenario)
+    self.concurrent = concurrent
+    # Indexes of the earlier steps every step waits for.
+    self.dependencies = tuple(
+      frozenset(index for index in range(position) if not concurrent or depends_on(step, self.steps[index]))
+      for position, step in enumerate(self.steps))
+    # Longest chain of steps up to every step. Steps of the same level can be in flight together.
+    levels = []
+    for dependencies in self.dependencies:
+      levels.append(1 + max((levels[index] for index in dependencies), default=0))
+    self.levels = tuple(levels)
+
+  def __iter__(self):
+    return iter(self.steps)
+
+  def __len__(self):
+    return len(self.steps)
+
+  def __reduce__(self):
+    # Compiled Jinja2 templates cannot be pickled, so workers started by pickling recompile from the source.
+    return ScenarioPlan, (self.scenario, self.concurrent)
+
+  @property
+  def is_serial(self):
+    # type: () -> bool
+    """
+    True if every step waits for the one before, i.e. the steps run in scenario order.
+    """
+    return all(len(dependencies) == position for position, dependencies in enumerate(self.dependencies))
+
+  @property
+  def width(self):
+    # type: () -> int
+    """
+    Largest number of steps on the same level of the dependency graph.
+    """
+    return max((self.levels.count(level) for level in set(self.levels)), default=0)
+
+  def run(self, run_step, executor):
+    # type: (Callable, futures.Executor) -> None
+    """
+    Runs every step as soon as the steps it depends on are done, each one as run_step(step) on the executor.
+    Raises the first exception of a step, once the running steps are done.
+    """
+    done = set()
+    pending = list(range(len(self.steps)))
+    running = {}
+    while pending or running:
+      for index in [index for index in pending if self.dependencies[index] <= done]:
+        pending.remove(index)
+        running[executor.submit(run_step, self.steps[index])] = index
+      finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+      for future in finished:
+        done.add(running.pop(future))
+        if future.exception() is not None:
+          futures.wait(running)
+          raise future.exception()
+
+  async def run_async(self, run_step):
+    # type: (Callable) -> None
+    """
+    Coroutine version of run(): awaits run_step(step) for every step as soon as the steps it depends on are done.
+    Raises the first exception of a step, once the other steps were cancelled.
+    """
+    tasks = []
+    for step, dependencies in zip(self.steps, self.dependencies):
+      tasks.append(asyncio.ensure_future(self._run_after([tasks[index] for index in dependencies], run_step, step)))
+    try:
+      done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+      for task in tasks:
+        task.cancel()
+    if pending:
+      await asyncio.wait(pending)
+    for task in tasks:
+      if task in done and task.exception() is not None:
+        raise task.exception()
+
+  @staticmethod
+  async def _run_after(dependencies, run_step, step):
+    if dependencies:
+      await asyncio.wait(dependencies)
+      for dependency in dependencies:
+        # A step that failed did not set its variables, so the steps that depend on it must not run.
+        dependency.result()
+    await run_step(step)
+
+  @property
+  def static_step_count(self):
+    # type: () -> int
+    return sum(1 for step in self.steps
+               if step.url.is_static and (step.body is None or step.body.is_static))
+
+
+def render_legacy(scenario, test_data):
+  """
+  Renders every step the way load_test did before plans: new Templates and a JSON round trip per step.
+  """
+  for step in scenario:
+    Template(step['url']).render(**test_data)
+    if "data" in step:
+      json.dumps(json.loads(Template(json.dumps(step['data'])).render(**test_data))).encode("utf-8")
+    if "variables" in step:
+      json.loads(Template(json.dumps(step["variables"])).render(**test_data))
+
+
+def render_plan(plan, test_data):
+  for step in plan.steps:
+    step.render_url(test_data)
+    step.render_body(test_data)
+    step.render_variables(test_data)
+
+
+def profile_plan(scenario, test_data_list, iteration):
+  # type: (list, list, int) -> dict
+  """
+  Measures the request preparation cost of the scenario without sending anything,
+  once with per-iteration templates and once with the compiled plan.
+  """
+  rows = test_data_list or [{}]
+  start = time.perf_counter()
+  for _ in range(iteration):
+    for test_data in rows:
+      render_legacy(scenario, test_data)
+  legacy = time.perf_counter() - start
+
+  start = time.perf_counter()
+  plan = ScenarioPlan(scenario)
+  compile_time = time.perf_counter() - start
+  start = time.perf_counter()
+  for _ in range(iteration):
+    for test_data in rows:
+      render_plan(plan, test_data)
+  compiled = time.perf_counter() - start
+
+  renders = iteration * len(rows) * len(scenario)
+  return {
+    "steps": len(scenario),
+    "static_steps": plan.static_step_count,
+    "renders": renders,
+    "legacy_seconds": legacy,
+    "compiled_seconds": compiled,
+    "compile_seconds": compile_time,
+    "legacy_us_per_step": legacy / renders * 1000000 if renders else 0.0,
+    "compiled_us_per_step": compiled / renders * 1000000 if renders else 0.0,
+    "saved_seconds": legacy - compiled - compile_time
+  }
@@ -0,0 +1,89 @@
+import json
+import multiprocessing
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from utils.credcache import CredentialCache
+
+
+def store_repeatedly(directory, writer, count):
+  cache = CredentialCache(directory)
+  for index in range(count):
+    # Big enough that a torn write would be caught half-way.
+    cache.store("domain", "user", {"writer": writer, "index": index, "padding": "x" * 65536,
+                                   "session_expires": time.time() + 60, "token_expires": time.time() + 60})
+
+
+class CredentialCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="credcache_test_")
+    self.cache = CredentialCache(os.path.join(self.directory, "cache"))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_round_trip(self):
+    credentials = {"session": {"id": "s"}, "token": {"oauth_token": "t"}, "session_expires": time.time() + 60,
+                   "token_expires": time.time() + 30}
+    self.assertIsNone(self.cache.load("domain", "user"))
+    self.cache.store("domain", "user", credentials)
+    self.assertEqual(self.cache.load("domain", "user"), credentials)
+    # Users and domains do not share entries.
+    self.assertIsNone(self.cache.load("domain", "other"))
+    self.assertIsNone(self.cache.load("other", "user"))
+    # Written through a temporary file that is renamed into place, readable by the owner only.
+    path = self.cache.path("domain", "user")
+    self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+    self.assertEqual([name for name in os.listdir(self.cache.directory) if name.endswith(".tmp")], [])
+
+  def test_expired_session_is_not_loaded(self):
+    self.cache.store("domain", "user", {"session_expires": time.time() - 1, "token_expires": time.time() - 1})
+    self.assertIsNone(self.cache.load("domain", "user"))
+    # An expired token alone is left to the caller, which refreshes it with the session.
+    credentials = {"session_expires": time.time() + 60, "token_expires": time.time() - 1}
+    self.cache.store("domain", "user", credentials)
+    self.assertEqual(self.cache.load("domain", "user"), credentials)
+
+  def test_unreadable_entry_and_clear(self):
+    with open(self.cache.path("domain", "user"), "w") as cache_file:
+      cache_file.write("{not json")
+    self.assertIsNone(self.cache.load("domain", "user"))
+    self.cache.store("domain", "user", {"session_expires": time.time() + 60, "token_expires": 0})
+    self.cache.clear("domain", "user")
+    self.assertIsNone(self.cache.load("domain", "user"))
+    self.cache.clear("domain", "user")
+
+  def test_concurrent_writers(self):
+    self.cache.store("domain", "user", {"writer": -1, "padding": "", "session_expires": time.time() + 60,
+                                        "token_expires": 0})
+    writers = [multiprocessing.Process(target=store_repeatedly, args=(self.cache.directory, writer, 50))
+               for writer in range(3)]
+    for writer in writers:
+      writer.start()
+    loads = 0
+    while any(writer.is_alive() for writer in writers) or loads == 0:
+      credentials = self.cache.load("domain", "user")
+      # Never a missing or half-written entry.
+      self.assertIsNotNone(credentials)
+      self.assertIn(len(credentials["padding"]), (0, 65536))
+      loads += 1
+    for writer in writers:
+      writer.join()
+      self.assertEqual(writer.exitcode, 0)
+    self.assertEqual(self.cache.load("domain", "user")["index"], 49)
+
+  def test_path_is_sanitized(self):
+    path = self.cache.path("dom/ain", "../user name")
+    self.assertEqual(os.path.dirname(path), self.cache.directory)
+    self.cache.store("dom/ain", "../user name", {"session_expires": time.time() + 60, "token_expires": 0})
+    with open(path) as cache_file:
+      self.assertIn("session_expires", json.load(cache_file))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from utils.errorcluster import ErrorClusterer
+from utils.stringutil import closest_match_words
+
+
+def patterns(messages):
+  # type: (list) -> list
+  clusterer = ErrorClusterer()
+  for message in messages:
+    clusterer.add(500, message)
+  return [cluster.pattern() for cluster in clusterer.most_common()]
+
+
+class PatternTest(unittest.TestCase):
+
+  def test_keeps_trailing_punctuation(self):
+    self.assertEqual(patterns(["There is an error with user ABC001 with ID 4011234.",
+                               "There is an error with user AEF005 with ID 10324."]),
+                     ["There is an error with user A* with ID *."])
+    self.assertEqual(patterns(['{"error": "user 12"}', '{"error": "user 1234"}']), ['{"error": "user *"}'])
+
+  def test_words_keep_their_common_start(self):
+    self.assertEqual(closest_match_words(["abcdefg", "aacceee"]), "a*c*e**")
+    self.assertEqual(closest_match_words(["abc", "abcd"]), "abc*")
+
+
+if __name__ == "__main__":
+  unittest.main()
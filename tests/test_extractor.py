@@ -0,0 +1,71 @@
+import json
+import unittest
+
+from utils.extractor import ExtractionError, Extractor
+
+DOCUMENT = {
+  "meta": {"note": "braces { and ] in \"strings\", escapes \\ too", "tags": ["a", {"b": [1, 2]}], "empty": {}},
+  "devices": [
+    {"id": "dev-0", "ports": [80, 443], "enabled": True},
+    {"id": "dev-1", "ports": [], "enabled": False, "owner": None},
+  ],
+  "total": -12.5e3,
+  "unicode": "café ☃",
+  "last": {"id": 42}
+}
+
+VARIABLES = {
+  "first_id": "$.devices[0].id",
+  "second_port": "devices[0].ports[1]",
+  "enabled": "$.devices[1].enabled",
+  "owner": "$.devices[1].owner",
+  "note": "$.meta.note",
+  "nested": "$.meta.tags[1].b",
+  "total": "$.total",
+  "unicode": "$.unicode",
+  "last_id": {"type": "dict", "key": "last", "child": {"type": "str", "key": "id"}},
+  "device": {"type": "dict", "key": "devices",
+             "child": {"type": "list", "index": 1, "child": {"type": "str", "key": "id"}}}
+}
+
+
+def chunks(content, size):
+  # type: (bytes, int) -> list
+  return [content[start:start + size] for start in range(0, len(content), size)]
+
+
+class StreamingExtractionTest(unittest.TestCase):
+
+  def test_stream_equals_full_parse(self):
+    extractor = Extractor(VARIABLES)
+    for indent in (None, 2):
+      content = json.dumps(DOCUMENT, indent=indent, ensure_ascii=False).encode("utf-8")
+      expected = extractor.extract_bytes(content)
+      self.assertEqual(expected["last_id"], 42)
+      for size in (1, 2, 3, 7, 64, len(content)):
+        self.assertEqual(extractor.extract_stream(chunks(content, size)), expected, "chunks of %d bytes" % size)
+
+  def test_stream_stops_once_found(self):
+    extraction = Extractor({"first_id": "$.devices[0].id"}).stream()
+    content = json.dumps(DOCUMENT).encode("utf-8")
+    for chunk in chunks(content, 16):
+      if extraction.feed(chunk):
+        break
+    self.assertLess(extraction.bytes_read, len(content))
+    self.assertEqual(extraction.result(), {"first_id": "dev-0"})
+
+  def test_negative_index_is_not_streamed(self):
+    with self.assertRaises(ValueError):
+      Extractor({"device": "$.devices[-1].id"}).stream()
+
+  def test_missing_variable(self):
+    extractor = Extractor({"missing": "$.devices[5].id"})
+    content = json.dumps(DOCUMENT).encode("utf-8")
+    with self.assertRaises(ExtractionError):
+      extractor.extract_bytes(content)
+    with self.assertRaises(ExtractionError):
+      extractor.extract_stream(chunks(content, 5))
+
+
+if __name__ == "__main__":
+  unittest.main()
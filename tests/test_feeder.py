@@ -0,0 +1,91 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.feeder import DataFeeder, FeederExhausted, index_records
+
+ROWS = 10
+
+
+def draw_until_exhausted(feeder, results):
+  ids = []
+  try:
+    while True:
+      ids.append(feeder.next_row()["id"])
+  except FeederExhausted:
+    pass
+  results.put(ids)
+
+
+class DataFeederTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="feeder_test_")
+    self.jsonl = os.path.join(self.directory, "rows.jsonl")
+    with open(self.jsonl, "w") as datafile:
+      for index in range(ROWS):
+        datafile.write(json.dumps({"id": index}) + "\n")
+        if index == 4:
+          datafile.write("\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_unique_exhaustion(self):
+    feeder = DataFeeder(self.jsonl, "unique")
+    self.assertEqual(len(feeder), ROWS)
+    self.assertEqual([feeder.next_row()["id"] for _ in range(ROWS)], list(range(ROWS)))
+    with self.assertRaises(FeederExhausted):
+      feeder.next_row()
+
+  def test_unique_across_processes(self):
+    # Every row is handed out exactly once, whichever worker draws it.
+    feeder = DataFeeder(self.jsonl, "unique")
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=draw_until_exhausted, args=(feeder, results)) for _ in range(3)]
+    for proc in procs:
+      proc.start()
+    drawn = [row for _ in procs for row in results.get(timeout=30)]
+    for proc in procs:
+      proc.join()
+    self.assertEqual(sorted(drawn), list(range(ROWS)))
+
+  def test_sharded_assignment(self):
+    feeder = DataFeeder(self.jsonl, "sharded", users=3)
+    # User k of 3 cycles through rows k, k + 3, k + 6...
+    self.assertEqual([feeder.next_row(0)["id"] for _ in range(5)], [0, 3, 6, 9, 0])
+    self.assertEqual([feeder.next_row(1)["id"] for _ in range(4)], [1, 4, 7, 1])
+    self.assertEqual([feeder.next_row(5)["id"] for _ in range(4)], [2, 5, 8, 2])
+    with self.assertRaises(ValueError):
+      DataFeeder(self.jsonl, "sharded", users=ROWS + 1)
+
+  def test_circular_and_partition(self):
+    feeder = DataFeeder(self.jsonl, "circular", partition=(1, 4))
+    self.assertEqual([feeder.next_row()["id"] for _ in range(4)], [1, 5, 9, 1])
+
+  def test_csv_multiline_records(self):
+    path = os.path.join(self.directory, "rows.csv")
+    with open(path, "w", newline="") as datafile:
+      datafile.write('id,note\r\n1,"two\r\nlines"\r\n\r\n2,"a ""quoted"" word"\r\n3,"x\n\ny"\r\n')
+    self.assertEqual(len(index_records(path, quoted=True)), 4)
+    feeder = DataFeeder(path, "unique")
+    self.assertEqual([feeder.next_row() for _ in range(3)], [
+      {"id": "1", "note": "two\r\nlines"},
+      {"id": "2", "note": 'a "quoted" word'},
+      {"id": "3", "note": "x\n\ny"}
+    ])
+
+  def test_unknown_policy_and_empty_file(self):
+    with self.assertRaises(ValueError):
+      DataFeeder(self.jsonl, "sequential")
+    path = os.path.join(self.directory, "empty.jsonl")
+    open(path, "w").close()
+    with self.assertRaises(ValueError):
+      DataFeeder(path)
+
+
+if __name__ == "__main__":
+  unittest.main()
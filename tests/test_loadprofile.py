@@ -0,0 +1,45 @@
+import unittest
+
+from utils.loadprofile import LoadProfile
+
+
+def arrivals(info, factor=1.0, phase=0.0):
+  # type: (Any, float, float) -> list
+  return list(LoadProfile.parse(info).scaled(factor, phase).arrival_times())
+
+
+class ArrivalTimesTest(unittest.TestCase):
+
+  def test_spike_gets_its_arrivals(self):
+    # 2.5 seconds at 1/s and 0.5 seconds at 200/s.
+    times = arrivals({"type": "spike", "rate": 1, "peak": 200, "spikeAt": 1, "spikeDuration": 0.5, "duration": 3})
+    self.assertEqual(len(times), 103)
+    self.assertEqual(len([t for t in times if 1 <= t < 1.5]), 100)
+
+  def test_stage_switch(self):
+    times = arrivals([{"type": "constant", "rate": 1, "duration": 0.9}, {"type": "constant", "rate": 500, "duration": 1}])
+    self.assertEqual(len(times), 501)
+    self.assertEqual(len([t for t in times if t < 0.9]), 1)
+
+  def test_ramp_from_zero(self):
+    times = arrivals({"type": "ramp", "from": 0, "to": 100, "duration": 10})
+    self.assertEqual(len(times), 500)
+    self.assertEqual(times, sorted(times))
+    self.assertLess(times[-1], 10)
+
+  def test_step_plateaus(self):
+    times = arrivals({"type": "step", "from": 10, "to": 40, "steps": 4, "duration": 4})
+    self.assertEqual([len([t for t in times if second <= t < second + 1]) for second in range(4)], [10, 20, 30, 40])
+
+  def test_workers_share_the_arrivals(self):
+    info = {"type": "spike", "rate": 1, "peak": 200, "spikeAt": 1, "spikeDuration": 0.5, "duration": 3}
+    workers = 16
+    shared = sorted(t for worker in range(workers) for t in arrivals(info, 1.0 / workers, float(worker) / workers))
+    single = arrivals(info)
+    self.assertEqual(len(shared), len(single))
+    for left, right in zip(shared, single):
+      self.assertAlmostEqual(left, right)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,70 @@
+import multiprocessing
+import time
+import unittest
+
+from token_broker import TokenBroker
+
+WORKERS = 6
+
+
+class ExpiringClient:
+  """
+  The part of CernerOAuthUtil the broker uses, with a token that starts out expired and a slow refresh.
+  """
+
+  def __init__(self):
+    self.token_expires = 0
+    self.credentials_version = 0
+
+  def adopt_credentials(self, credentials, version):
+    self.token_expires = credentials["token_expires"]
+    self.credentials_version = version
+
+  def is_token_expired(self):
+    return self.token_expires <= time.time()
+
+  def refresh_expired(self):
+    time.sleep(0.2)
+    self.token_expires = time.time() + 3600
+
+  def credentials(self):
+    return {"token_expires": self.token_expires}
+
+
+def refresh_in_worker(broker, start, results):
+  client = ExpiringClient()
+  start.wait()
+  broker.refresh(client)
+  results.put((client.is_token_expired(), client.credentials_version))
+
+
+class TokenBrokerTest(unittest.TestCase):
+
+  def test_refresh_happens_once_across_processes(self):
+    broker = TokenBroker()
+    broker.publish({"token_expires": 0})
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=refresh_in_worker, args=(broker, start, results)) for _ in range(WORKERS)]
+    for proc in procs:
+      proc.start()
+    start.set()
+    outcomes = [results.get(timeout=30) for _ in procs]
+    for proc in procs:
+      proc.join()
+    stats = broker.stats()
+    self.assertEqual(stats["refreshes"], 1)
+    self.assertEqual(stats["waits"], WORKERS - 1)
+    # Every process ends up with the one refreshed token.
+    self.assertEqual(outcomes, [(False, broker.version)] * WORKERS)
+    credentials, version = broker.load()
+    self.assertGreater(credentials["token_expires"], time.time())
+
+  def test_credentials_must_fit(self):
+    broker = TokenBroker(capacity=16)
+    with self.assertRaises(ValueError):
+      broker.publish({"token_expires": 0, "token": "x" * 16})
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,126 @@
+import json
+import socket
+import struct
+import threading
+import unittest
+
+from auth_backends import NoAuthClient
+from benchmark.stub_server import create_server
+from transport import TRANSPORT_HTTPCLIENT, TRANSPORT_REQUESTS, HTTPOptions, create_transport
+from utils.phasetiming import PhaseTimings
+
+TRANSPORTS = [TRANSPORT_REQUESTS, TRANSPORT_HTTPCLIENT]
+
+
+class ClosingServer:
+  """
+  Answers the first request on every connection with keep-alive, then drops the connection the moment the next
+  request arrives, i.e. a server that timed out an idle connection while the client was sending on it.
+  """
+
+  def __init__(self):
+    self.listener = socket.socket()
+    self.listener.bind(("127.0.0.1", 0))
+    self.listener.listen(8)
+    self.port = self.listener.getsockname()[1]
+    self.requests = []
+    threading.Thread(target=self._serve, daemon=True).start()
+
+  def _serve(self):
+    while True:
+      try:
+        conn, _ = self.listener.accept()
+      except OSError:
+        return
+      threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+  def _handle(self, conn):
+    with conn:
+      data = conn.recv(65536)
+      self.requests.append(data.split(b" ", 1)[0].decode("ascii"))
+      conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}")
+      conn.recv(65536)
+      # Reset rather than close, so that the client sees the drop whether or not its request was read.
+      conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+
+  def close(self):
+    self.listener.close()
+
+
+class TransportTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.server = create_server(0)
+    threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+    cls.base = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def send(self, transport, method, path, body=None, stream=False):
+    return transport.send(NoAuthClient(transport.options), method, self.base + path, body, stream, PhaseTimings())
+
+  def test_requests(self):
+    for name in TRANSPORTS:
+      with self.subTest(transport=name):
+        transport = create_transport(HTTPOptions(transport=name, timeout=10))
+        try:
+          response = self.send(transport, "GET", "/items/7?size=4&depth=0")
+          self.assertEqual(response.status_code, 200)
+          self.assertEqual(json.loads(response.content), {"data": {"id": "7", "payload": "xxxx"}})
+          response = self.send(transport, "POST", "/items/8", b'{"name": "item"}')
+          self.assertEqual(json.loads(response.text), {"id": "8", "received": 16})
+          self.assertEqual(self.send(transport, "GET", "/error/9").status_code, 500)
+          # Every request went over the one kept-alive connection.
+          self.assertEqual(transport.stats(), {"connections": 1, "requests": 3})
+        finally:
+          transport.close()
+
+  def test_streaming(self):
+    for name in TRANSPORTS:
+      with self.subTest(transport=name):
+        transport = create_transport(HTTPOptions(transport=name, timeout=10))
+        try:
+          response = self.send(transport, "GET", "/items/1?size=200000&depth=0", stream=True)
+          content = b"".join(response.iter_content(4096))
+          self.assertEqual(len(json.loads(content)["data"]["payload"]), 200000)
+          # Read to the end, the connection is reused.
+          self.assertEqual(self.send(transport, "GET", "/items/2").status_code, 200)
+          self.assertEqual(transport.stats()["connections"], 1)
+        finally:
+          transport.close()
+
+  def test_no_keep_alive(self):
+    transport = create_transport(HTTPOptions(transport=TRANSPORT_HTTPCLIENT, keep_alive=False, timeout=10))
+    try:
+      for item in range(3):
+        self.assertEqual(self.send(transport, "GET", "/items/%d" % item).status_code, 200)
+      self.assertEqual(transport.stats(), {"connections": 3, "requests": 3})
+    finally:
+      transport.close()
+
+  def test_stale_connection_resends_idempotent_requests_only(self):
+    server = ClosingServer()
+    transport = create_transport(HTTPOptions(transport=TRANSPORT_HTTPCLIENT, timeout=10))
+    client = NoAuthClient(transport.options)
+    url = "http://127.0.0.1:%d/items/1" % server.port
+    try:
+      transport.send(client, "GET", url, None, False, PhaseTimings())
+      # The GET is sent again over a new connection.
+      self.assertEqual(transport.send(client, "GET", url, None, False, PhaseTimings()).status_code, 200)
+      self.assertEqual(server.requests, ["GET", "GET"])
+      self.assertEqual(transport.stats(), {"connections": 2, "requests": 3})
+      # The server may have acted on the POST, it is not sent twice.
+      with self.assertRaises(OSError):
+        transport.send(client, "POST", url, b"{}", False, PhaseTimings())
+      self.assertEqual(server.requests, ["GET", "GET"])
+    finally:
+      transport.close()
+      server.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,106 @@
+import json
+import multiprocessing
+import time
+
+# Room for the JSON encoded session and token. Cerner session and token objects are well under this.
+DEFAULT_CAPACITY = 64 * 1024
+DEFAULT_REFRESH_MARGIN = 60
+
+
+class TokenBroker:
+  """
+  Shares the OAuth session and token between every process of a run.
+  The credentials live in shared memory behind a lock. The first process that finds them due for a refresh
+  refreshes them while holding the lock; the others wait on the lock and pick up the fresh credentials
+  instead of hitting the token endpoint themselves.
+  Must be created in the parent before the worker processes are started.
+  """
+
+  def __init__(self, capacity=DEFAULT_CAPACITY):
+    # type: (int) -> None
+    self.capacity = capacity
+    self._lock = multiprocessing.Lock()
+    self._state = multiprocessing.RawArray("c", capacity)
+    self._length = multiprocessing.RawValue("l", 0)
+    self._version = multiprocessing.RawValue("l", 0)
+    self._refreshes = multiprocessing.RawValue("l", 0)
+    self._refresh_time = multiprocessing.RawValue("d", 0.0)
+    self._waits = multiprocessing.RawValue("l", 0)
+    self._wait_time = multiprocessing.RawValue("d", 0.0)
+    self._max_wait = multiprocessing.RawValue("d", 0.0)
+
+  @property
+  def version(self):
+    # type: () -> int
+    # Bumped on every publish, so a process can tell whether its copy is stale without taking the lock.
+    return self._version.value
+
+  def _write(self, credentials):
+    # type: (dict) -> None
+    data = json.dumps(credentials).encode("utf-8")
+    if len(data) > self.capacity:
+      raise ValueError("Credentials of %d bytes do not fit the token broker (%d bytes)" % (len(data), self.capacity))
+    self._state[:len(data)] = data
+    self._length.value = len(data)
+    self._version.value += 1
+
+  def _read(self):
+    # type: () -> (dict, int)
+    if not self._length.value:
+      return None, self._version.value
+    return json.loads(self._state[:self._length.value].decode("utf-8")), self._version.value
+
+  def publish(self, credentials):
+    # type: (dict) -> None
+    """
+    Stores credentials obtained outside the broker, e.g. by the parent at startup.
+    """
+    with self._lock:
+      self._write(credentials)
+
+  def load(self):
+    # type: () -> (dict, int)
+    """
+    :return: The shared credentials, None if nothing was published yet, and their version
+    """
+    with self._lock:
+      return self._read()
+
+  def refresh(self, client):
+    # type: (CernerOAuthUtil) -> None
+    """
+    Brings the client up to date, refreshing the shared credentials at most once for every process.
+
+    :param client: The client to update
+    """
+    start = time.perf_counter()
+    with self._lock:
+      waited = time.perf_counter() - start
+      credentials, version = self._read()
+      if credentials is not None:
+        client.adopt_credentials(credentials, version)
+      if client.is_token_expired():
+        client.refresh_expired()
+        self._write(client.credentials())
+        client.credentials_version = self._version.value
+        self._refreshes.value += 1
+        self._refresh_time.value += time.perf_counter() - start
+      else:
+        # Somebody else refreshed while this process was waiting.
+        self._waits.value += 1
+        self._wait_time.value += waited
+        self._max_wait.value = max(self._max_wait.value, waited)
+
+  def stats(self):
+    # type: () -> dict
+    """
+    :return: Number of refreshes and their total time, and the number of processes that waited
+             for another process to refresh, with the total and longest wait in seconds
+    """
+    return {
+      "refreshes": self._refreshes.value,
+      "refresh_time": self._refresh_time.value,
+      "waits": self._waits.value,
+      "wait_time": self._wait_time.value,
+      "max_wait": self._max_wait.value
+    }
@@ -0,0 +1,422 @@
+"""
+Transports that send the synchronous requests of RestClient.req_oauth.
+
+  requests     requests.Session over a counting urllib3 pool: retries, cookies, hooks and proxies from the environment
+  httpclient   pooled keep-alive sockets: every request goes out as one pre-encoded bytes payload, and the response is
+               parsed by http.client. No retries, cookies or proxies.
+
+The backend is chosen by "Transport" in the [HTTP] section of the settings file.
+"""
+
+import http.client
+import logging
+import socket
+import threading
+from abc import ABC, abstractmethod
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, InsecureRequestWarning, NameResolutionError, NewConnectionError
+from urllib3.util.retry import Retry
+
+from http_util import IDEMPOTENT_METHODS, STALE_CONNECTION_ERRORS, SimpleResponse, create_connection, get_ssl_context, \
+  is_connection_dropped, split_url
+from utils.configmanager import to_bool
+from utils.phasetiming import current_timings
+
+TRANSPORT_REQUESTS = "requests"
+TRANSPORT_HTTPCLIENT = "httpclient"
+TRANSPORTS = (TRANSPORT_REQUESTS, TRANSPORT_HTTPCLIENT)
+
+JSON_HEADERS = {"Accept": "application/json", "Content-Type": "application/json"}
+
+log = logging.getLogger(__name__)
+
+
+class HTTPOptions:
+  """
+  Transport tuning for the pooled client session, read from the [HTTP] section of the settings file.
+  """
+  def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive=True, max_retries=0, backoff_factor=0.0,
+               retry_on_status=None, timeout=None, transport=TRANSPORT_REQUESTS, verify=True):
+    self.pool_connections = pool_connections
+    self.pool_maxsize = pool_maxsize
+    self.keep_alive = keep_alive
+    self.max_retries = max_retries
+    self.backoff_factor = backoff_factor
+    self.retry_on_status = retry_on_status if retry_on_status is not None else []
+    self.timeout = timeout
+    self.transport = transport
+    self.verify = verify
+
+  @classmethod
+  def from_config(cls, section):
+    # type: (dict) -> HTTPOptions
+    section = section or {}
+    retry_on_status = [int(code) for code in section.get("RetryOnStatus", "").split(",") if code.strip()]
+    timeout = section.get("Timeout", "")
+    verify = to_bool(section.get("Verify", True))
+    if not verify:
+      log.warning("TLS certificates of the load test target are not verified ([HTTP] Verify: False)")
+    return cls(
+      pool_connections=int(section.get("PoolConnections", 10)),
+      pool_maxsize=int(section.get("PoolMaxSize", 10)),
+      keep_alive=to_bool(section.get("KeepAlive", True)),
+      max_retries=int(section.get("MaxRetries", 0)),
+      backoff_factor=float(section.get("BackoffFactor", 0)),
+      retry_on_status=retry_on_status,
+      timeout=float(timeout) if timeout else None,
+      transport=section.get("Transport", TRANSPORT_REQUESTS).strip().lower(),
+      verify=verify)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+  """
+  HTTPAdapter that counts the sockets its pools open and the requests they send over them,
+  so that connection reuse shows up in the run stats. Its connections also time the phases of the request
+  started with begin_timings() on the sending thread.
+  """
+  def __init__(self, *args, **kwargs):
+    self._stats = {"connections": 0, "requests": 0}
+    self._stats_lock = threading.Lock()
+    super().__init__(*args, **kwargs)
+
+  def _count(self, key):
+    with self._stats_lock:
+      self._stats[key] += 1
+
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    count = self._count
+    pool_classes = {}
+    for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+      class CountingConnection(pool_cls.ConnectionCls):
+        def _new_conn(self):
+          # Same as urllib3, with the name lookup and the connect timed apart.
+          try:
+            return create_connection((self._dns_host, self.port), self.timeout, self.source_address,
+                                     self.socket_options, current_timings())
+          except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+          except socket.timeout as e:
+            raise ConnectTimeoutError(self, "Connection to %s timed out. (connect timeout=%s)" % (self.host, self.timeout)) from e
+          except OSError as e:
+            raise NewConnectionError(self, "Failed to establish a new connection: %s" % e) from e
+
+        tls = scheme == "https"
+
+        def connect(self):
+          count("connections")
+          super().connect()
+          # What connect() does after _new_conn is the TLS handshake.
+          timings = current_timings()
+          if self.tls and timings is not None:
+            timings.lap("tls")
+
+      class CountingPool(pool_cls):
+        ConnectionCls = CountingConnection
+
+        def _make_request(self, *args, **kwargs):
+          count("requests")
+          timings = current_timings()
+          if timings is not None:
+            timings.start()
+          response = super()._make_request(*args, **kwargs)
+          if timings is not None:
+            timings.lap("ttfb")
+          return response
+
+      pool_classes[scheme] = CountingPool
+    self.poolmanager.pool_classes_by_scheme = pool_classes
+
+  def stats(self):
+    # type: () -> dict
+    with self._stats_lock:
+      return dict(self._stats)
+
+
+def create_http_session(options):
+  # type: (HTTPOptions) -> requests.Session
+  retry = Retry(total=options.max_retries, backoff_factor=options.backoff_factor,
+                status_forcelist=options.retry_on_status, raise_on_status=False)
+  adapter = PooledHTTPAdapter(pool_connections=options.pool_connections, pool_maxsize=options.pool_maxsize,
+                              max_retries=retry)
+  session = requests.Session()
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  if not options.keep_alive:
+    session.headers["Connection"] = "close"
+  return session
+
+
+class Transport(ABC):
+  """
+  Sends the requests of a RestClient. A transport belongs to one process.
+  """
+  name = None
+
+  def __init__(self, options):
+    # type: (HTTPOptions) -> None
+    self.options = options
+
+  @abstractmethod
+  def send(self, client, method, url, body, stream, timings):
+    # type: (RestClient, str, str, bytes, bool, PhaseTimings) -> Any
+    """
+    Authenticates a request through the hooks of the client and sends it.
+
+    :param body: The serialized request body, None for none
+    :param stream: Leaves the response body unread, for the caller to read through iter_content() and close()
+    :param timings: The timings of the request, also current_timings() of this thread
+
+    :return: The response, with status_code, headers, content, text and iter_content()
+    """
+
+  @abstractmethod
+  def stats(self):
+    # type: () -> dict
+    """
+    :return: Number of connections opened and requests sent
+    """
+
+  def close(self):
+    pass
+
+
+class RequestsTransport(Transport):
+  """
+  requests.Session with a PooledHTTPAdapter. Authenticates with client.requests_auth().
+  """
+  name = TRANSPORT_REQUESTS
+
+  def __init__(self, options):
+    # type: (HTTPOptions) -> None
+    Transport.__init__(self, options)
+    self.session = create_http_session(options)
+    if not options.verify:
+      # Turned off on purpose and reported once, not for every request.
+      urllib3.disable_warnings(InsecureRequestWarning)
+
+  def send(self, client, method, url, body, stream, timings):
+    auth = client.requests_auth()
+    # Passed with every request, since a session-wide verify is overridden by REQUESTS_CA_BUNDLE.
+    if method == "GET":
+      return self.session.get(url, auth=auth, headers=JSON_HEADERS, timeout=self.options.timeout, stream=stream,
+                              verify=self.options.verify)
+    return self.session.request(method, url, data=body, auth=auth, headers=JSON_HEADERS, timeout=self.options.timeout,
+                                stream=stream, verify=self.options.verify)
+
+  def stats(self):
+    return self.session.get_adapter("https://").stats()
+
+  def close(self):
+    self.session.close()
+
+
+class StreamingResponse(SimpleResponse):
+  """
+  Response of the httpclient transport whose body is still on the wire. The connection goes back to the pool once
+  the body was read to the end, through iter_content() or content, otherwise close() drops it.
+  """
+  def __init__(self, transport, key, sock, response, timings=None):
+    self._transport = transport
+    self._key = key
+    self._sock = sock
+    self._response = response
+    super().__init__(response.status, response.reason, response.headers, None, timings)
+
+  @property
+  def content(self):
+    # type: () -> bytes
+    if self._content is None:
+      self._content = b"".join(self.iter_content())
+    return self._content
+
+  @content.setter
+  def content(self, value):
+    self._content = value
+
+  def iter_content(self, chunk_size=65536):
+    if self._sock is None:
+      return
+    while True:
+      chunk = self._response.read(chunk_size)
+      if not chunk:
+        break
+      yield chunk
+    self.close()
+
+  def close(self):
+    if self._sock is None:
+      return
+    # A body abandoned halfway counts as downloaded up to here.
+    if self.timings is not None:
+      self.timings.finish()
+    self._transport.release(self._key, self._sock, self._response)
+    self._sock = None
+
+
+class HTTPClientTransport(Transport):
+  """
+  Pooled keep-alive sockets per (scheme, host, port). The request line, the headers and the body leave in a single
+  sendall(): the Host and JSON header lines are encoded once per origin, so a request costs one string format and one
+  encode, plus the headers the client signs it with. One stale reused connection is reopened transparently.
+  Authenticates with client.sign().
+  """
+  name = TRANSPORT_HTTPCLIENT
+
+  def __init__(self, options):
+    # type: (HTTPOptions) -> None
+    Transport.__init__(self, options)
+    self._idle = {}
+    self._lock = threading.Lock()
+    self._origins = {}
+    self._stats = {"connections": 0, "requests": 0}
+    self._common_lines = "".join("%s: %s\r\n" % item for item in JSON_HEADERS.items())
+    if not options.keep_alive:
+      self._common_lines += "Connection: close\r\n"
+
+  def _target(self, url):
+    # type: (str) -> ((tuple, str), str)
+    # Splits the URL into its origin, i.e. (key, header lines), and the request target.
+    start = url.find("/", url.find("://") + 3)
+    if start < 0:
+      return self._origin(url), split_url(url)[3]
+    base = url[:start]
+    origin = self._origins.get(base)
+    if origin is None:
+      origin = self._origins[base] = self._origin(base)
+    return origin, url[start:]
+
+  def _origin(self, url):
+    # type: (str) -> (tuple, str)
+    scheme, host, port, _ = split_url(url)
+    default_port = 443 if scheme == "https" else 80
+    host_line = "Host: %s\r\n" % (host if port == default_port else "%s:%d" % (host, port))
+    return (scheme, host, port), host_line + self._common_lines
+
+  def _count(self, key):
+    with self._lock:
+      self._stats[key] += 1
+
+  def _connect(self, key, timings):
+    # type: (tuple, PhaseTimings) -> socket.socket
+    scheme, host, port = key
+    self._count("connections")
+    sock = create_connection((host, port), self.options.timeout,
+                             socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)], timings=timings)
+    if scheme == "https":
+      try:
+        sock = get_ssl_context(self.options.verify).wrap_socket(sock, server_hostname=host)
+      except BaseException:
+        sock.close()
+        raise
+      if timings is not None:
+        timings.lap("tls")
+    return sock
+
+  def _acquire(self, key, timings):
+    # type: (tuple, PhaseTimings) -> (socket.socket, bool)
+    with self._lock:
+      idle = self._idle.get(key)
+      while idle:
+        sock = idle.pop()
+        if not is_connection_dropped(sock):
+          return sock, True
+        sock.close()
+    return self._connect(key, timings), False
+
+  def release(self, key, sock, response):
+    # type: (tuple, socket.socket, http.client.HTTPResponse) -> None
+    """
+    Puts a connection back into the pool once its response was read to the end, closes it otherwise.
+    """
+    # Without keep-alive the request asked the server to close, whether or not its response says so.
+    if self.options.keep_alive and response.isclosed() and not response.will_close:
+      with self._lock:
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.options.pool_maxsize:
+          idle.append(sock)
+          return
+    sock.close()
+
+  def _exchange(self, sock, payload, method, timings, written=None):
+    # type: (socket.socket, bytes, str, PhaseTimings, list) -> http.client.HTTPResponse
+    self._count("requests")
+    sock.sendall(payload)
+    if written is not None:
+      written.append(True)
+    response = http.client.HTTPResponse(sock, method=method)
+    response.begin()
+    if timings is not None:
+      timings.lap("ttfb")
+    return response
+
+  def send(self, client, method, url, body, stream, timings):
+    url, headers = client.sign(method, url, dict(JSON_HEADERS))
+    (key, lines), path = self._target(url)
+    extra_lines = "".join(["%s: %s\r\n" % (name, value) for name, value in headers.items()
+                           if JSON_HEADERS.get(name) != value])
+    if body is not None or method in ("POST", "PUT"):
+      payload = ("%s %s HTTP/1.1\r\n%s%sContent-Length: %d\r\n\r\n" % (method, path, lines, extra_lines, len(body or b""))
+                 ).encode("iso-8859-1") + (body or b"")
+    else:
+      payload = ("%s %s HTTP/1.1\r\n%s%s\r\n" % (method, path, lines, extra_lines)).encode("iso-8859-1")
+
+    if timings is not None:
+      timings.start()
+    sock, reused = self._acquire(key, timings)
+    written = []
+    try:
+      response = self._exchange(sock, payload, method, timings, written)
+    except STALE_CONNECTION_ERRORS:
+      sock.close()
+      # As in http_util.ConnectionPool, a request the server may have acted on is sent again only if idempotent.
+      if not reused or (written and method not in IDEMPOTENT_METHODS):
+        raise
+      log.debug("Stale connection to %s://%s:%s, reconnecting" % key)
+      sock = self._connect(key, timings)
+      try:
+        response = self._exchange(sock, payload, method, timings)
+      except BaseException:
+        sock.close()
+        raise
+    except BaseException:
+      sock.close()
+      raise
+    if stream:
+      return StreamingResponse(self, key, sock, response, timings)
+    try:
+      content = response.read()
+    except BaseException:
+      sock.close()
+      raise
+    self.release(key, sock, response)
+    return SimpleResponse(response.status, response.reason, response.headers, content, timings)
+
+  def stats(self):
+    with self._lock:
+      return dict(self._stats)
+
+  def close(self):
+    with self._lock:
+      for idle in self._idle.values():
+        for sock in idle:
+          sock.close()
+      self._idle = {}
+
+
+def create_transport(options):
+  # type: (HTTPOptions) -> Transport
+  """
+  :return: The transport of the [HTTP] Transport option
+  :raises ValueError: On an unknown transport
+  """
+  if options.transport == TRANSPORT_REQUESTS:
+    return RequestsTransport(options)
+  if options.transport == TRANSPORT_HTTPCLIENT:
+    if options.max_retries:
+      log.warning("The httpclient transport does not retry requests, MaxRetries is ignored")
+    return HTTPClientTransport(options)
+  raise ValueError("Unknown transport %s, expected one of %s" % (options.transport, ", ".join(TRANSPORTS)))
@@ -36,3 +36,18 @@ class ConfigManager:
                 cfg_item[item[0]] = item[1]
             info[section] = cfg_item
         return info
+
+
+def to_bool(value):
+    # type: (Any) -> bool
+    """
+    Converts a config value into a boolean. ConfigParser keeps every value as a string,
+    so "False" would otherwise be truthy.
+
+    :param value: The config value
+
+    :return: The boolean value
+    """
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
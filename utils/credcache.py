@@ -0,0 +1,114 @@
+"""
+On-disk cache of OAuth credentials.
+Each entry holds the session and the token of one user together with their expiry times,
+so a later run can reuse them without logging in as long as they are valid.
+Entries are written to a temporary file and renamed into place under an exclusive lock,
+so concurrent runs never see a half-written file.
+"""
+
+import json
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on Windows. The atomic rename still prevents torn files.
+    fcntl = None
+
+DEFAULT_CACHE_DIR = "."
+
+
+class CredentialCache:
+    """
+    Stores credentials per domain and user in a cache directory
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        # type: (str) -> None
+        """
+        Creates CredentialCache instance.
+        :param directory: The cache directory. Created if missing.
+        """
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, domain, username):
+        # type: (str, str) -> str
+        """
+        :return: The cache file path of the user
+        """
+        name = "oauth_credentials_%s_%s.json" % (domain, username)
+        return os.path.join(self.directory, re.sub(r"[^\w.@-]", "_", name))
+
+    @contextmanager
+    def _locked(self, path, exclusive):
+        # The lock lives in a side file, since the cache file itself is replaced on every write.
+        with open(path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self, domain, username):
+        # type: (str, str) -> dict
+        """
+        Loads the cached credentials of the user.
+
+        :param domain: The domain
+        :param username: The user name
+
+        :return: The credentials, None if there is no entry, it is unreadable, or the session expired.
+                 The token inside may still be expired; its expiry is in "token_expires".
+        """
+        path = self.path(domain, username)
+        try:
+            with self._locked(path, exclusive=False):
+                with open(path) as cache_file:
+                    credentials = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(credentials, dict) or credentials.get("session_expires", 0) <= time.time():
+            return None
+        return credentials
+
+    def store(self, domain, username, credentials):
+        # type: (str, str, dict) -> None
+        """
+        Atomically replaces the cached credentials of the user.
+
+        :param domain: The domain
+        :param username: The user name
+        :param credentials: The credentials with "session_expires" and "token_expires" epoch seconds
+        """
+        path = self.path(domain, username)
+        with self._locked(path, exclusive=True):
+            # mkstemp creates the file readable by the owner only.
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".oauth_credentials_", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as temp_file:
+                    json.dump(credentials, temp_file)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+    def clear(self, domain, username):
+        # type: (str, str) -> None
+        """
+        Removes the cached credentials of the user.
+        """
+        path = self.path(domain, username)
+        with self._locked(path, exclusive=True):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,223 @@
+"""
+Online clustering of error messages.
+Every message gets a MinHash signature of its character n-grams, and a locality sensitive hashing (LSH) index
+of signature bands finds the candidate clusters, so a message is compared with a handful of clusters instead of
+every message seen before. A cluster keeps a count and a few exemplars only, and its pattern is squashed from
+the exemplars with utils.stringutil, e.g. "There is an error with user A* with ID *.".
+"""
+
+import random
+import re
+import zlib
+
+from utils.stringutil import closest_match_sentence, cut_msg
+
+SHINGLE_SIZE = 4
+NUM_HASHES = 32
+NUM_BANDS = 8
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_MAX_CLUSTERS = 1000
+DEFAULT_MAX_EXEMPLARS = 5
+# Characters of a message used for its signature. Error bodies that differ only after this are one cluster.
+SIGNATURE_LENGTH = 512
+EXACT_CACHE_SIZE = 10000
+
+_MERSENNE_PRIME = (1 << 61) - 1
+# Fixed seed, so that every worker process computes the same signatures and clusters merge across processes.
+_random = random.Random(0x5eed)
+_HASH_COEFFICIENTS = [(_random.randrange(1, _MERSENNE_PRIME), _random.randrange(0, _MERSENNE_PRIME))
+                      for _ in range(NUM_HASHES)]
+_ROWS_PER_BAND = NUM_HASHES // NUM_BANDS
+# Words with a digit in them, e.g. IDs, counters and hex trace IDs, are variable parts of a message.
+_VARIABLE_WORDS = re.compile(r"\w*[0-9]\w*")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(message):
+    # type: (str) -> str
+    """
+    :return: The message with whitespace runs collapsed and every word with a digit replaced by 0
+    """
+    return _VARIABLE_WORDS.sub("0", _SPACES.sub(" ", message).strip())
+
+
+def minhash(text):
+    # type: (str) -> tuple
+    """
+    :return: The MinHash signature of the character n-grams of the text
+    """
+    data = text[:SIGNATURE_LENGTH].encode("utf-8")
+    shingles = {zlib.crc32(data[i:i + SHINGLE_SIZE]) for i in range(max(1, len(data) - SHINGLE_SIZE + 1))}
+    return tuple(min((a * shingle + b) % _MERSENNE_PRIME for shingle in shingles) for a, b in _HASH_COEFFICIENTS)
+
+
+def similarity(left, right):
+    # type: (tuple, tuple) -> float
+    """
+    :return: The Jaccard similarity estimated from two MinHash signatures
+    """
+    return sum(1 for a, b in zip(left, right) if a == b) / float(len(left))
+
+
+class ErrorCluster:
+    """
+    Similar errors of one status code
+    """
+
+    def __init__(self, status, signature, first_iteration=None):
+        # type: (int, tuple, int) -> None
+        self.status = status
+        self.signature = signature
+        self.count = 0
+        self.first_iteration = first_iteration
+        self.exemplars = []
+
+    def add(self, message, count=1, max_exemplars=DEFAULT_MAX_EXEMPLARS):
+        # type: (str, int, int) -> None
+        self.count += count
+        if len(self.exemplars) < max_exemplars and message not in self.exemplars:
+            self.exemplars.append(message)
+
+    def pattern(self):
+        # type: () -> str
+        """
+        :return: The common pattern of the exemplars, with asterisks for the parts that differ and for digits
+        """
+        lines = [_SPACES.sub(" ", exemplar).strip() for exemplar in self.exemplars]
+        return closest_match_sentence(lines, " ")
+
+
+class ErrorClusterer:
+    """
+    Groups errors as they arrive into a bounded number of clusters
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, max_clusters=DEFAULT_MAX_CLUSTERS,
+                 max_exemplars=DEFAULT_MAX_EXEMPLARS):
+        # type: (float, int, int) -> None
+        """
+        Creates ErrorClusterer instance.
+        :param threshold: Estimated Jaccard similarity of the n-grams from which a message joins a cluster
+        :param max_clusters: Errors that would open a cluster beyond this are only counted as overflow
+        :param max_exemplars: Number of distinct messages kept per cluster
+        """
+        self.threshold = threshold
+        self.max_clusters = max_clusters
+        self.max_exemplars = max_exemplars
+        self.clusters = []
+        self.count = 0
+        self.overflow = 0
+        self._index = {}
+        self._exact = {}
+
+    def __len__(self):
+        return self.count
+
+    def _bands(self, status, signature):
+        # type: (int, tuple) -> list
+        return [(status, band, signature[band * _ROWS_PER_BAND:(band + 1) * _ROWS_PER_BAND])
+                for band in range(NUM_BANDS)]
+
+    def _find(self, status, signature):
+        # type: (int, tuple) -> ErrorCluster
+        best, best_similarity = None, self.threshold
+        seen = set()
+        for key in self._bands(status, signature):
+            for cluster in self._index.get(key, ()):
+                if id(cluster) in seen:
+                    continue
+                seen.add(id(cluster))
+                value = similarity(signature, cluster.signature)
+                if value >= best_similarity:
+                    best, best_similarity = cluster, value
+        return best
+
+    def add(self, status, message, iteration=None, count=1):
+        # type: (int, str, int, int) -> ErrorCluster
+        """
+        Adds an error.
+
+        :param status: HTTP status code, 0 for requests without a response
+        :param message: The error message or response body
+        :param iteration: The iteration the error happened in
+        :param count: Number of times the error happened
+
+        :return: The cluster of the error, None if it was counted as overflow
+        """
+        self.count += count
+        normalized = normalize(message)
+        # Repeated bodies skip the signature.
+        cluster = self._exact.get((status, normalized))
+        if cluster is None:
+            signature = minhash(normalized)
+            cluster = self._find(status, signature)
+            if cluster is None:
+                if len(self.clusters) >= self.max_clusters:
+                    self.overflow += count
+                    return None
+                cluster = ErrorCluster(status, signature, iteration)
+                self.clusters.append(cluster)
+                for key in self._bands(status, signature):
+                    self._index.setdefault(key, []).append(cluster)
+            if len(self._exact) >= EXACT_CACHE_SIZE:
+                self._exact.clear()
+            self._exact[(status, normalized)] = cluster
+        cluster.add(message, count, self.max_exemplars)
+        return cluster
+
+    def merge(self, other):
+        # type: (ErrorClusterer) -> ErrorClusterer
+        """
+        Adds the clusters of another clusterer, e.g. of another worker.
+
+        :return: self
+        """
+        for cluster in other.clusters:
+            self._add_cluster(cluster.status, cluster.count, cluster.first_iteration, cluster.exemplars)
+        self.count += other.overflow
+        self.overflow += other.overflow
+        return self
+
+    def _add_cluster(self, status, count, first_iteration, exemplars):
+        # type: (int, int, int, list) -> None
+        merged = self.add(status, exemplars[0], first_iteration, count)
+        if merged is not None:
+            for exemplar in exemplars[1:]:
+                merged.add(exemplar, 0, self.max_exemplars)
+
+    def most_common(self):
+        # type: () -> list
+        """
+        :return: The clusters, the biggest first
+        """
+        return sorted(self.clusters, key=lambda cluster: -cluster.count)
+
+    def to_dict(self):
+        # type: () -> dict
+        return {
+            "clusters": [{"status": cluster.status, "count": cluster.count, "first_iteration": cluster.first_iteration,
+                          "exemplars": cluster.exemplars} for cluster in self.clusters],
+            "overflow": self.overflow
+        }
+
+    @classmethod
+    def from_dict(cls, info, **kwargs):
+        # type: (dict, Any) -> ErrorClusterer
+        clusterer = cls(**kwargs)
+        for cluster in info["clusters"]:
+            clusterer._add_cluster(cluster["status"], cluster["count"], cluster["first_iteration"], cluster["exemplars"])
+        clusterer.count += info["overflow"]
+        clusterer.overflow += info["overflow"]
+        return clusterer
+
+
+def summarize(clusterer, limit=80):
+    # type: (ErrorClusterer, int) -> list
+    """
+    :param clusterer: The clusterer
+    :param limit: Maximum length of the patterns
+
+    :return: (count, status, first iteration, pattern) rows, the biggest cluster first
+    """
+    return [(cluster.count, cluster.status, cluster.first_iteration, cut_msg(cluster.pattern(), limit))
+            for cluster in clusterer.most_common()]
@@ -0,0 +1,416 @@
+"""
+Variable extraction from JSON responses.
+A "variables" descriptor of a Scenario step is compiled once into a path of keys and indexes.
+The path can be applied to a parsed document, or to the raw response byte stream,
+in which case only the referenced fields are decoded and reading stops once all of them are found.
+"""
+
+import json
+import re
+
+_PATH_TOKEN = re.compile(r'\.([A-Za-z_$][\w$-]*)|\[(-?\d+)\]|\[\'((?:[^\'\\]|\\.)*)\'\]|\["((?:[^"\\]|\\.)*)"\]')
+# Runs over plain characters and complete strings up to the next bracket or comma.
+# A lone quote in the group means the string continues in the next chunk.
+_SKIP_TOKEN = re.compile(rb'[^"\[\]{},]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{},]*)*([\[\]{},]|")')
+_STRING_END = re.compile(rb'["\\]')
+_SCALAR_END = re.compile(rb'[,\]}\s]')
+_WHITESPACE = b" \t\r\n"
+
+
+class ExtractionError(KeyError):
+    """
+    Raised when a variable cannot be found in the response.
+    """
+
+
+def parse_path(expression):
+    # type: (str) -> tuple
+    """
+    Parses a compact JSONPath-like expression into a path.
+    e.g. "$.devices[0].id" or "devices[0].id" gives ("devices", 0, "id").
+
+    :param expression: The path expression
+
+    :return: The tuple of keys (str) and indexes (int)
+    """
+    expression = expression.strip()
+    if expression.startswith("$"):
+        expression = expression[1:]
+    if expression and expression[0] not in ".[":
+        expression = "." + expression
+    path = []
+    position = 0
+    while position < len(expression):
+        match = _PATH_TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError("Invalid variable path %r at position %d" % (expression, position))
+        key, index, single_quoted, double_quoted = match.groups()
+        if index is not None:
+            path.append(int(index))
+        else:
+            quoted = single_quoted if single_quoted is not None else double_quoted
+            path.append(key if quoted is None else re.sub(r"\\(.)", r"\1", quoted))
+        position = match.end()
+    return tuple(path)
+
+
+def compile_descriptor(descriptor):
+    # type: (Any) -> tuple
+    """
+    Compiles a variable descriptor into a path. The descriptor is either a path expression
+    or the nested {"type": "dict"/"list"/"str", ...} object.
+
+    :param descriptor: The descriptor
+
+    :return: The tuple of keys (str) and indexes (int)
+    """
+    if isinstance(descriptor, str):
+        return parse_path(descriptor)
+    path = []
+    key_info = descriptor
+    while True:
+        if key_info["type"] == "dict":
+            path.append(key_info["key"])
+            key_info = key_info["child"]
+        elif key_info["type"] == "list":
+            path.append(int(key_info["index"]))
+            key_info = key_info["child"]
+        else:
+            path.append(key_info["key"])
+            return tuple(path)
+
+
+def format_path(path):
+    # type: (tuple) -> str
+    """
+    :param path: The compiled path
+
+    :return: The path expression, e.g. "$.devices[0].id"
+    """
+    return "$" + "".join("[%d]" % item if isinstance(item, int) else ".%s" % item for item in path)
+
+
+class Extractor:
+    """
+    Compiled set of variables of a Scenario step
+    """
+
+    def __init__(self, variables):
+        # type: (dict) -> None
+        """
+        Creates Extractor instance.
+        :param variables: Dictionary of variable name to descriptor
+        """
+        self.paths = tuple((name, compile_descriptor(descriptor)) for name, descriptor in variables.items())
+
+    def extract(self, document):
+        # type: (Any) -> dict
+        """
+        Extracts the variables from a parsed document.
+
+        :param document: The parsed JSON document
+
+        :return: Dictionary of variable name to value
+        """
+        values = {}
+        for name, path in self.paths:
+            point = document
+            try:
+                for item in path:
+                    point = point[item]
+            except (KeyError, IndexError, TypeError):
+                raise ExtractionError("Variable %s is not found at %s" % (name, format_path(path)))
+            values[name] = point
+        return values
+
+    def extract_bytes(self, content):
+        # type: (bytes) -> dict
+        """
+        Parses the whole body and extracts the variables.
+
+        :param content: The response body
+
+        :return: Dictionary of variable name to value
+        """
+        return self.extract(json.loads(content))
+
+    def stream(self):
+        # type: () -> StreamingExtraction
+        """
+        :return: A new streaming extraction to feed the response body to
+        """
+        return StreamingExtraction(self.paths)
+
+    def extract_stream(self, chunks):
+        # type: (Iterable[bytes]) -> dict
+        """
+        Extracts the variables from an iterable of body chunks, and stops consuming it once every variable is found.
+
+        :param chunks: The body chunks
+
+        :return: Dictionary of variable name to value
+        """
+        extraction = self.stream()
+        for chunk in chunks:
+            if extraction.feed(chunk):
+                break
+        else:
+            extraction.feed(None)
+        return extraction.result()
+
+
+class _EndOfInput(Exception):
+    pass
+
+
+class StreamingExtraction:
+    """
+    Incremental JSON scanner that decodes only the values on the requested paths.
+    Everything else is skipped over without being decoded, and bytes that were scanned are dropped.
+    """
+
+    def __init__(self, paths):
+        # type: (tuple) -> None
+        """
+        Creates StreamingExtraction instance.
+        :param paths: Tuple of (variable name, path)
+        """
+        self.targets = {}
+        self.prefixes = set()
+        for name, path in paths:
+            if any(isinstance(item, int) and item < 0 for item in path):
+                raise ValueError("Negative indexes cannot be streamed: %s" % name)
+            self.targets.setdefault(path, []).append(name)
+            for length in range(len(path)):
+                self.prefixes.add(path[:length])
+        # Array indexes worth visiting under each path, so that the other elements can be skipped in bulk.
+        self.indexes = {}
+        for path in self.targets:
+            for length in range(len(path)):
+                if isinstance(path[length], int):
+                    self.indexes.setdefault(path[:length], set()).add(path[length])
+        self.indexes = {path: sorted(indexes) for path, indexes in self.indexes.items()}
+        self.values = {}
+        self.found = set()
+        self.remaining = len(self.targets)
+        self.buffer = b""
+        self.position = 0
+        self.mark = None
+        self.bytes_read = 0
+        self.finished = False
+        self._parser = self._parse()
+        next(self._parser)
+
+    def feed(self, chunk):
+        # type: (bytes) -> bool
+        """
+        Feeds the next body chunk.
+
+        :param chunk: The chunk. Empty bytes or None at the end of the body.
+
+        :return: True once every variable is found or the document ended
+        """
+        if self.finished:
+            return True
+        if chunk:
+            self.bytes_read += len(chunk)
+        try:
+            self._parser.send(chunk or None)
+        except StopIteration:
+            self.finished = True
+        return self.finished
+
+    def result(self):
+        # type: () -> dict
+        """
+        :return: Dictionary of variable name to value
+
+        :raises ExtractionError: If any variable is missing
+        """
+        if self.remaining:
+            missing = [name for path, names in self.targets.items() if path not in self.found for name in names]
+            raise ExtractionError("Variables %s are not found in the response" % ", ".join(sorted(missing)))
+        return dict(self.values)
+
+    def _store(self, path, value):
+        # The captured value may also hold targets nested under it.
+        for target, names in self.targets.items():
+            if target in self.found or target[:len(path)] != path:
+                continue
+            point = value
+            try:
+                for item in target[len(path):]:
+                    point = point[item]
+            except (KeyError, IndexError, TypeError):
+                continue
+            self.found.add(target)
+            self.remaining -= 1
+            for name in names:
+                self.values[name] = point
+
+    # Parser internals. The generators yield whenever the buffer runs dry and resume with the next chunk.
+
+    def _more(self):
+        chunk = yield
+        if chunk is None:
+            raise _EndOfInput()
+        keep = self.position if self.mark is None else min(self.mark, self.position)
+        if keep:
+            self.buffer = self.buffer[keep:]
+            self.position -= keep
+            if self.mark is not None:
+                self.mark -= keep
+        self.buffer += chunk
+
+    def _parse(self):
+        chunk = yield
+        if chunk is None:
+            return
+        self.buffer = chunk
+        try:
+            yield from self._value(())
+        except _EndOfInput:
+            pass
+
+    def _skip_whitespace(self):
+        while True:
+            buffer = self.buffer
+            position = self.position
+            length = len(buffer)
+            while position < length and buffer[position] in _WHITESPACE:
+                position += 1
+            self.position = position
+            if position < length:
+                return buffer[position]
+            yield from self._more()
+
+    def _value(self, path):
+        character = yield from self._skip_whitespace()
+        if path in self.targets:
+            self.mark = self.position
+            yield from self._skip_value(character)
+            raw = self.buffer[self.mark:self.position]
+            self.mark = None
+            self._store(path, json.loads(raw))
+        elif path in self.prefixes and character == 0x7b:
+            yield from self._object(path)
+        elif path in self.prefixes and character == 0x5b:
+            yield from self._array(path)
+        else:
+            yield from self._skip_value(character)
+
+    def _object(self, path):
+        self.position += 1
+        while True:
+            character = yield from self._skip_whitespace()
+            if character == 0x7d:
+                self.position += 1
+                return
+            if character == 0x2c:
+                self.position += 1
+                continue
+            self.mark = self.position
+            yield from self._skip_string()
+            raw = self.buffer[self.mark + 1:self.position - 1]
+            self.mark = None
+            key = raw.decode("utf-8") if b"\\" not in raw else json.loads(b'"' + raw + b'"')
+            yield from self._skip_whitespace()
+            self.position += 1
+            yield from self._value(path + (key,))
+            if not self.remaining:
+                return
+
+    def _array(self, path):
+        self.position += 1
+        character = yield from self._skip_whitespace()
+        if character == 0x5d:
+            self.position += 1
+            return
+        index = 0
+        for wanted in self.indexes.get(path, ()):
+            if wanted > index:
+                if not (yield from self._skip_container(1, wanted - index)):
+                    return
+                index = wanted
+            yield from self._value(path + (index,))
+            if not self.remaining:
+                return
+            character = yield from self._skip_whitespace()
+            self.position += 1
+            if character == 0x5d:
+                return
+            index += 1
+        yield from self._skip_container(1)
+
+    def _skip_string(self):
+        # Starts at the opening quote and stops right after the closing quote.
+        self.position += 1
+        while True:
+            match = _STRING_END.search(self.buffer, self.position)
+            if match is None:
+                self.position = len(self.buffer)
+                yield from self._more()
+            elif match.group() == b"\\":
+                if match.start() + 1 >= len(self.buffer):
+                    self.position = match.start()
+                    yield from self._more()
+                else:
+                    self.position = match.start() + 2
+            else:
+                self.position = match.end()
+                return
+
+    def _skip_value(self, character):
+        if character == 0x22:
+            yield from self._skip_string()
+        elif character in (0x7b, 0x5b):
+            yield from self._skip_container(0)
+        else:
+            while True:
+                match = _SCALAR_END.search(self.buffer, self.position)
+                if match is not None:
+                    self.position = match.start()
+                    return
+                self.position = len(self.buffer)
+                try:
+                    yield from self._more()
+                except _EndOfInput:
+                    # A bare scalar can be the whole document.
+                    return
+
+    def _skip_container(self, depth, commas=0):
+        """
+        Skips until the container that is depth levels deep closes, or until the given number of commas
+        directly inside it went by.
+
+        :return: True if it stopped after the commas, False if the container closed
+        """
+        match_token = _SKIP_TOKEN.match
+        while True:
+            buffer = self.buffer
+            position = self.position
+            while True:
+                match = match_token(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    break
+                character = buffer[match.start(1)]
+                position = match.end()
+                if character == 0x22:
+                    position = match.start(1)
+                    break
+                elif character == 0x2c:
+                    if depth == 1 and commas:
+                        commas -= 1
+                        if not commas:
+                            self.position = position
+                            return True
+                elif character == 0x5b or character == 0x7b:
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        self.position = position
+                        return False
+            self.position = position
+            yield from self._more()
@@ -0,0 +1,167 @@
+"""
+External TestData rows for load tests.
+A CSV (with a header row) or JSON Lines file is indexed once by the byte offset of every record, and rows are read
+from disk when a virtual user draws one, so a worker holds 8 bytes per row instead of the rows themselves.
+The index and a shared cursor are created before the workers are forked, so every worker draws from the same sequence.
+"""
+
+import csv
+import io
+import json
+import multiprocessing
+import os
+import random
+from array import array
+
+POLICIES = ["circular", "unique", "random", "sharded"]
+# Rows a process takes from the shared cursor at once, so that the cursor lock is taken once per lease.
+LEASE_SIZE = 64
+
+
+class FeederExhausted(Exception):
+    """
+    Raised when a unique feeder has handed out every row
+    """
+
+
+def index_records(filepath, quoted=False):
+    # type: (str, bool) -> array
+    """
+    Finds where every record of a file starts. Blank lines are skipped.
+
+    :param filepath: The file path
+    :param quoted: True for CSV, where a quoted field can span several lines
+
+    :return: The byte offsets of the records
+    """
+    offsets = array("q")
+    offset = 0
+    start = None
+    quotes = 0
+    with open(filepath, "rb") as datafile:
+        for line in datafile:
+            if start is None and line.strip():
+                start = offset
+                quotes = 0
+            if start is not None:
+                if quoted:
+                    quotes += line.count(b'"')
+                if quotes % 2 == 0:
+                    offsets.append(start)
+                    start = None
+            offset += len(line)
+    if start is not None:
+        offsets.append(start)
+    return offsets
+
+
+class DataFeeder:
+    """
+    Hands out the rows of a CSV or JSON Lines file to virtual users, one row per iteration
+    """
+
+    def __init__(self, filepath, policy="circular", users=1, partition=(0, 1), seed=None):
+        # type: (str, str, int, tuple, int) -> None
+        """
+        Creates DataFeeder instance. Create it before the workers are forked.
+        :param filepath: A ".csv" file with a header row, or a JSON Lines file of objects
+        :param policy: "circular" (every user takes the next row, starting over at the end), "unique" (every row is
+                       used once, then the users stop), "random" (rows drawn at random with repetition) or
+                       "sharded" (user k of n cycles through rows k, k + n, k + 2n...)
+        :param users: Number of users, for the sharded policy
+        :param partition: (index, count) to use only the rows index, index + count... e.g. the share of one agent
+        :param seed: Seed of the random policy. Every process draws a different sequence from it.
+        :raises ValueError: On an unknown policy, or a file without rows
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown feeder policy %s, expected one of %s" % (policy, ", ".join(POLICIES)))
+        self.filepath = filepath
+        self.policy = policy
+        self.users = max(1, users)
+        self.seed = seed
+        self.csv = filepath.lower().endswith(".csv")
+        offsets = index_records(filepath, self.csv)
+        self.header = None
+        if self.csv and offsets:
+            with open(filepath, "rb") as datafile:
+                self.header = self._parse(self._read_record(datafile, offsets[0]).decode("utf-8-sig"))
+            offsets = offsets[1:]
+        index, count = partition
+        self.offsets = offsets[index::count]
+        if not self.offsets:
+            raise ValueError("Feeder file %s has no rows" % filepath)
+        if policy == "sharded" and len(self.offsets) < self.users:
+            raise ValueError("Feeder file %s has %d row(s), fewer than the %d user(s) to shard them among"
+                             % (filepath, len(self.offsets), self.users))
+        self.lease_size = max(1, min(LEASE_SIZE, len(self.offsets) // 100))
+        self.cursor = multiprocessing.Value("q", 0)
+        self._pid = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _check_process(self):
+        # File handles, leases and random generators are per process.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._file = open(self.filepath, "rb")
+        self._lease_next = self._lease_end = 0
+        self._positions = {}
+        self._random = random.Random(None if self.seed is None else self.seed * 1000003 + self._pid)
+
+    def _next_index(self):
+        # type: () -> int
+        if self._lease_next >= self._lease_end:
+            with self.cursor.get_lock():
+                self._lease_next = self.cursor.value
+                self.cursor.value += self.lease_size
+            self._lease_end = self._lease_next + self.lease_size
+        index = self._lease_next
+        self._lease_next += 1
+        return index
+
+    def _read_record(self, datafile, offset):
+        # type: (io.BufferedReader, int) -> bytes
+        datafile.seek(offset)
+        record = datafile.readline()
+        while self.csv and record.count(b'"') % 2:
+            line = datafile.readline()
+            if not line:
+                break
+            record += line
+        return record
+
+    def _parse(self, text):
+        # type: (str) -> Any
+        if self.csv:
+            return next(csv.reader(io.StringIO(text)))
+        return json.loads(text)
+
+    def next_row(self, user_index=0):
+        # type: (int) -> dict
+        """
+        :param user_index: Index of the user drawing the row, for the sharded policy
+
+        :return: The next row for the user
+        :raises FeederExhausted: If the policy is unique and every row has been handed out
+        """
+        self._check_process()
+        count = len(self.offsets)
+        if self.policy == "circular":
+            index = self._next_index() % count
+        elif self.policy == "unique":
+            index = self._next_index()
+            if index >= count:
+                raise FeederExhausted("Every row of %s has been used" % self.filepath)
+        elif self.policy == "random":
+            index = self._random.randrange(count)
+        else:
+            shard = user_index % self.users
+            position = self._positions.get(user_index, 0)
+            self._positions[user_index] = position + 1
+            index = shard + position % len(range(shard, count, self.users)) * self.users
+        row = self._parse(self._read_record(self._file, self.offsets[index]).decode("utf-8"))
+        if self.csv:
+            return dict(zip(self.header, row))
+        return row
@@ -0,0 +1,219 @@
+"""
+HDR-style latency histogram.
+Values are bucketed logarithmically with a fixed number of linear sub-buckets per power of two,
+so the memory is fixed up front while every recorded value keeps a bounded relative error.
+"""
+
+import math
+from array import array
+
+# One hour in microseconds
+DEFAULT_MAX_VALUE = 3600 * 1000 * 1000
+
+
+class LatencyHistogram:
+    """
+    Fixed-memory histogram of integer values (microseconds by convention)
+    """
+
+    def __init__(self, max_value=DEFAULT_MAX_VALUE, significant_figures=3):
+        # type: (int, int) -> None
+        """
+        Creates LatencyHistogram instance.
+        :param max_value: The highest value that can be told apart. Higher values are clamped to it.
+        :param significant_figures: Number of significant decimal digits kept for every value (1 to 5)
+        """
+        if not 1 <= significant_figures <= 5:
+            raise ValueError("significant_figures must be between 1 and 5")
+        self.max_value = int(max_value)
+        self.significant_figures = significant_figures
+        self.sub_bucket_bits = int(math.ceil(math.log(2 * 10 ** significant_figures, 2)))
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.sub_bucket_half_count = self.sub_bucket_count >> 1
+        self.counts = array("q", [0]) * (self._index_of(self.max_value) + 1)
+        self.total_count = 0
+        self.total_sum = 0
+        self.min_value = None
+        self.max_recorded = 0
+
+    def _index_of(self, value):
+        # type: (int) -> int
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.sub_bucket_half_count + (value >> shift) - self.sub_bucket_half_count
+
+    def _highest_equivalent(self, index):
+        # type: (int) -> int
+        if index < self.sub_bucket_count:
+            return index
+        shift = (index - self.sub_bucket_count) // self.sub_bucket_half_count + 1
+        top = (index - self.sub_bucket_count) % self.sub_bucket_half_count + self.sub_bucket_half_count
+        return ((top + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        # type: (int, int) -> None
+        """
+        Records a value.
+
+        :param value: The value. Negative values count as 0, values over max_value as max_value.
+        :param count: How many times the value occurred
+        """
+        value = min(max(int(value), 0), self.max_value)
+        self.counts[self._index_of(value)] += count
+        self.total_count += count
+        self.total_sum += value * count
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if value > self.max_recorded:
+            self.max_recorded = value
+
+    def record_seconds(self, seconds, count=1):
+        # type: (float, int) -> None
+        """
+        Records a duration in seconds as microseconds.
+
+        :param seconds: The duration
+        :param count: How many times the duration occurred
+        """
+        self.record(int(seconds * 1000000), count)
+
+    def record_corrected(self, value, expected_interval, count=1):
+        # type: (int, int, int) -> int
+        """
+        Records a value, and when it is longer than the expected interval between two samples, the samples a stall
+        of that length kept from being taken: value - interval, value - 2 * interval and so on down to the interval.
+        This is the coordinated omission correction of HdrHistogram.
+
+        :param value: The value
+        :param expected_interval: The expected interval between two samples, in the unit of the values
+        :param count: How many times the value occurred
+
+        :return: The number of back-filled values
+        """
+        self.record(value, count)
+        filled = 0
+        if expected_interval <= 0:
+            return filled
+        missing = value - expected_interval
+        while missing >= expected_interval:
+            self.record(missing, count)
+            filled += count
+            missing -= expected_interval
+        return filled
+
+    def copy_corrected(self, expected_interval):
+        # type: (int) -> (LatencyHistogram, int)
+        """
+        :param expected_interval: The expected interval between two samples, in the unit of the values
+
+        :return: A copy with every recorded value corrected as by record_corrected, and the number of back-filled values
+        """
+        corrected = LatencyHistogram(self.max_value, self.significant_figures)
+        filled = 0
+        for index, count in enumerate(self.counts):
+            if count:
+                value = min(self._highest_equivalent(index), self.max_recorded)
+                filled += corrected.record_corrected(value, expected_interval, count)
+        return corrected, filled
+
+    def merge(self, other):
+        # type: (LatencyHistogram) -> LatencyHistogram
+        """
+        Adds the counts of the other histogram, which must have the same layout.
+
+        :param other: The histogram to merge
+
+        :return: self
+        """
+        if (other.max_value, other.significant_figures) != (self.max_value, self.significant_figures):
+            raise ValueError("Cannot merge histograms with different layouts")
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.total_count += other.total_count
+        self.total_sum += other.total_sum
+        if other.min_value is not None and (self.min_value is None or other.min_value < self.min_value):
+            self.min_value = other.min_value
+        self.max_recorded = max(self.max_recorded, other.max_recorded)
+        return self
+
+    def value_at_percentile(self, percentile):
+        # type: (float) -> int
+        """
+        :param percentile: The percentile between 0 and 100
+
+        :return: The highest value equivalent to the one at the percentile, 0 if empty
+        """
+        if self.total_count == 0:
+            return 0
+        target = max(1, int(math.ceil(percentile / 100.0 * self.total_count)))
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return min(self._highest_equivalent(index), self.max_recorded)
+        return self.max_recorded
+
+    def percentiles(self, percentiles):
+        # type: (list) -> dict
+        """
+        Looks up several percentiles in one pass.
+
+        :param percentiles: The list of percentiles between 0 and 100
+
+        :return: Dictionary of percentile to value
+        """
+        result = {}
+        if self.total_count == 0:
+            return {percentile: 0 for percentile in percentiles}
+        targets = sorted((max(1, int(math.ceil(p / 100.0 * self.total_count))), p) for p in percentiles)
+        running = 0
+        position = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            running += count
+            while position < len(targets) and running >= targets[position][0]:
+                result[targets[position][1]] = min(self._highest_equivalent(index), self.max_recorded)
+                position += 1
+            if position == len(targets):
+                break
+        for _, percentile in targets[position:]:
+            result[percentile] = self.max_recorded
+        return result
+
+    def mean(self):
+        # type: () -> float
+        """
+        :return: The mean of the recorded values
+        """
+        return self.total_sum / self.total_count if self.total_count else 0.0
+
+    def to_dict(self):
+        # type: () -> dict
+        """
+        :return: JSON friendly representation. Only non-empty buckets are kept.
+        """
+        return {
+            "max_value": self.max_value,
+            "significant_figures": self.significant_figures,
+            "total_count": self.total_count,
+            "total_sum": self.total_sum,
+            "min": self.min_value,
+            "max": self.max_recorded,
+            "counts": {str(index): count for index, count in enumerate(self.counts) if count}
+        }
+
+    @classmethod
+    def from_dict(cls, info):
+        # type: (dict) -> LatencyHistogram
+        histogram = cls(info["max_value"], info["significant_figures"])
+        for index, count in info["counts"].items():
+            histogram.counts[int(index)] = count
+        histogram.total_count = info["total_count"]
+        histogram.total_sum = info["total_sum"]
+        histogram.min_value = info["min"]
+        histogram.max_recorded = info["max"]
+        return histogram
@@ -0,0 +1,194 @@
+"""
+Open-model load profiles.
+A profile is a list of stages that gives the target arrival rate (scenario iterations started per second)
+at any point of the run, independent of how fast the server responds.
+"""
+
+import math
+
+
+class Stage:
+    """
+    One stage of a load profile.
+
+    "constant": {"rate": R, "duration": D}
+    "ramp": {"from": R1, "to": R2, "duration": D} - linear ramp
+    "step": {"from": R1, "to": R2, "steps": N, "duration": D} - N equal plateaus from R1 to R2
+    "spike": {"rate": R, "peak": P, "spikeAt": S, "spikeDuration": SD, "duration": D} - R with a burst of P
+    """
+
+    TYPES = ("constant", "ramp", "step", "spike")
+
+    def __init__(self, info):
+        # type: (dict) -> None
+        """
+        Creates Stage instance.
+        :param info: The stage object from the scenario file
+        """
+        self.type = info.get("type", "constant")
+        if self.type not in self.TYPES:
+            raise ValueError("Unknown load profile stage type: %s" % self.type)
+        self.duration = float(info["duration"])
+        self.rate = float(info.get("rate", 0))
+        self.start_rate = float(info.get("from", self.rate))
+        self.end_rate = float(info.get("to", self.start_rate))
+        self.steps = max(1, int(info.get("steps", 1)))
+        self.peak = float(info.get("peak", self.rate))
+        self.spike_at = float(info.get("spikeAt", 0))
+        self.spike_duration = float(info.get("spikeDuration", 0))
+
+    def rate_at(self, t):
+        # type: (float) -> float
+        """
+        :param t: Seconds since the start of this stage
+
+        :return: The target arrival rate at t
+        """
+        if self.type == "constant":
+            return self.rate
+        elif self.type == "ramp":
+            return self.start_rate + (self.end_rate - self.start_rate) * min(t / self.duration, 1.0)
+        elif self.type == "step":
+            if self.steps == 1:
+                return self.start_rate
+            step = min(int(t / (self.duration / self.steps)), self.steps - 1)
+            return self.start_rate + (self.end_rate - self.start_rate) * step / (self.steps - 1)
+        else:
+            if self.spike_at <= t < self.spike_at + self.spike_duration:
+                return self.peak
+            return self.rate
+
+    def segments(self):
+        # type: () -> list
+        """
+        :return: The (duration, start rate, end rate) pieces of the stage, over which the rate changes linearly.
+                 Steps and spikes are split at every rate change.
+        """
+        if self.type == "constant":
+            return [(self.duration, self.rate, self.rate)]
+        elif self.type == "ramp":
+            return [(self.duration, self.start_rate, self.end_rate)]
+        elif self.type == "step":
+            width = self.duration / self.steps
+            return [(width, rate, rate) for rate in (self.rate_at(index * width) for index in range(self.steps))]
+        spike_start = min(max(self.spike_at, 0.0), self.duration)
+        spike_end = min(max(self.spike_at + self.spike_duration, spike_start), self.duration)
+        return [(spike_start, self.rate, self.rate), (spike_end - spike_start, self.peak, self.peak),
+                (self.duration - spike_end, self.rate, self.rate)]
+
+    def scaled(self, factor):
+        # type: (float) -> Stage
+        """
+        :param factor: Multiplier for every rate of the stage
+
+        :return: A copy of the stage with scaled rates
+        """
+        stage = Stage.__new__(Stage)
+        stage.__dict__.update(self.__dict__)
+        stage.rate *= factor
+        stage.start_rate *= factor
+        stage.end_rate *= factor
+        stage.peak *= factor
+        return stage
+
+
+class LoadProfile:
+    """
+    Sequence of stages run one after another
+    """
+
+    def __init__(self, stages, max_in_flight=0, phase=0.0):
+        # type: (list, int, float) -> None
+        """
+        Creates LoadProfile instance.
+        :param stages: The list of Stage
+        :param max_in_flight: Maximum number of iterations running at once. 0 for no limit.
+        :param phase: Fraction of an arrival the schedule is shifted by, in [0, 1)
+        """
+        self.stages = stages
+        self.max_in_flight = max_in_flight
+        self.phase = phase
+        self.duration = sum(stage.duration for stage in stages)
+
+    @classmethod
+    def parse(cls, info):
+        # type: (Any) -> LoadProfile
+        """
+        Parses the "LoadProfile" object of the scenario file. Either a single stage, a list of stages,
+        or {"stages": [...], "maxInFlight": N}.
+
+        :param info: The "LoadProfile" object
+
+        :return: The parsed profile
+        """
+        max_in_flight = 0
+        if isinstance(info, dict) and "stages" in info:
+            max_in_flight = int(info.get("maxInFlight", 0))
+            info = info["stages"]
+        if isinstance(info, dict):
+            info = [info]
+        return cls([Stage(stage) for stage in info], max_in_flight)
+
+    def rate_at(self, t):
+        # type: (float) -> float
+        """
+        :param t: Seconds since the start of the run
+
+        :return: The target arrival rate at t. 0 after the profile ended.
+        """
+        for stage in self.stages:
+            if t < stage.duration:
+                return stage.rate_at(t)
+            t -= stage.duration
+        return 0.0
+
+    def scaled(self, factor, phase=0.0):
+        # type: (float, float) -> LoadProfile
+        """
+        Scales every rate, e.g. to split the profile across worker processes.
+        Worker k of n gets phase k / n, so that together the workers start every arrival of the unscaled profile
+        instead of all starting their first one at the same moment.
+
+        :param factor: Multiplier for the rates
+        :param phase: Fraction of an arrival the scaled schedule is shifted by
+
+        :return: The scaled profile
+        """
+        max_in_flight = int(math.ceil(self.max_in_flight * factor)) if self.max_in_flight else 0
+        return LoadProfile([stage.scaled(factor) for stage in self.stages], max_in_flight, phase)
+
+    def expected_arrivals(self):
+        # type: () -> float
+        """
+        :return: Number of arrivals the rates add up to over the whole profile
+        """
+        return sum(duration * (start_rate + end_rate) / 2.0
+                   for stage in self.stages for duration, start_rate, end_rate in stage.segments())
+
+    def arrival_times(self):
+        # type: () -> Iterator[float]
+        """
+        Generates the intended start offsets of the iterations, in seconds since the start of the run.
+        Arrival n starts when the integral of the rate since the start reaches n + phase, so short spikes,
+        plateaus and stage switches get the number of arrivals their rates add up to.
+
+        :return: Generator of arrival offsets
+        """
+        start = 0.0
+        count = 0.0
+        target = self.phase
+        for stage in self.stages:
+            for duration, start_rate, end_rate in stage.segments():
+                if duration <= 0:
+                    continue
+                slope = (end_rate - start_rate) / duration
+                segment_count = duration * (start_rate + end_rate) / 2.0
+                while target < count + segment_count:
+                    # Solves start_rate * t + slope * t^2 / 2 = target - count, in a form that stays exact for
+                    # constant rates and ramps starting from 0.
+                    needed = target - count
+                    root = math.sqrt(max(start_rate * start_rate + 2.0 * slope * needed, 0.0))
+                    yield start + min(2.0 * needed / (start_rate + root), duration) if needed > 0 else start
+                    target += 1.0
+                start += duration
+                count += segment_count
@@ -0,0 +1,168 @@
+"""
+Logging pipeline for the load generator.
+Every process formats its log records and puts them on one multiprocessing queue without blocking, and a single
+listener thread in the parent process writes them to the real handlers (console, file).
+Per-request lines can be sampled, and response bodies are only decoded, up to a size cap, for the lines that are
+formatted: lines below the log level, sampled out or dropped never decode them.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+DEFAULT_QUEUE_SIZE = 100000
+DEFAULT_BODY_LIMIT = 2048
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that drops records instead of blocking when the writer falls behind
+    """
+
+    def __init__(self, log_queue, dropped):
+        # type: (multiprocessing.Queue, multiprocessing.RawValue) -> None
+        """
+        Creates DroppingQueueHandler instance.
+        :param log_queue: The queue read by the listener
+        :param dropped: Shared counter of dropped records
+        """
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = dropped
+
+    def emit(self, record):
+        # prepare() formats the record in this process, which is wasted on a record that would be dropped.
+        if self.queue.full():
+            self.dropped.value += 1
+            return
+        QueueHandler.emit(self, record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped.value += 1
+
+
+class LogPipeline:
+    """
+    Moves the handlers of a logger behind a queue with a single writer
+    """
+
+    def __init__(self, logger, queue_size=DEFAULT_QUEUE_SIZE):
+        # type: (logging.Logger, int) -> None
+        """
+        Creates LogPipeline instance. Must be created and started before the worker processes are forked.
+        :param logger: The logger whose handlers are moved to the writer
+        :param queue_size: Number of records that can wait for the writer before new ones are dropped
+        """
+        self.logger = logger
+        self.handlers = list(logger.handlers)
+        self.queue = multiprocessing.Queue(queue_size)
+        self.dropped = multiprocessing.RawValue("l", 0)
+        self.handler = DroppingQueueHandler(self.queue, self.dropped)
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.pid = None
+
+    def start(self):
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+        self.pid = os.getpid()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Writes the records still in the queue and gives the handlers back to the logger.
+        Only the process that started the pipeline can stop it.
+        """
+        if self.pid != os.getpid():
+            return
+        self.pid = None
+        self.listener.stop()
+        self.logger.removeHandler(self.handler)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        if self.dropped.value:
+            self.logger.warning("%d log record(s) were dropped because the log writer fell behind", self.dropped.value)
+
+
+class RequestSampler:
+    """
+    Decides which requests get their per-request log lines. Errors are logged regardless.
+    """
+
+    def __init__(self, every=1, errors_only=False):
+        # type: (int, bool) -> None
+        """
+        Creates RequestSampler instance.
+        :param every: Logs 1 request in every N
+        :param errors_only: Logs no request, only errors
+        """
+        self.every = max(1, every)
+        self.errors_only = errors_only
+        self.count = 0
+
+    def sample(self):
+        # type: () -> bool
+        """
+        :return: True if the next request is logged
+        """
+        if self.errors_only:
+            return False
+        self.count += 1
+        return self.count % self.every == 0
+
+
+class LazyBody:
+    """
+    Log argument that decodes at most limit bytes of a response body, and only when the record is formatted
+    """
+    __slots__ = ("content", "limit")
+
+    def __init__(self, content, limit=DEFAULT_BODY_LIMIT):
+        # type: (bytes, int) -> None
+        self.content = content
+        self.limit = limit
+
+    def __str__(self):
+        return cap_body(self.content, self.limit)
+
+
+class LazyCall:
+    """
+    Log argument that is computed only when the record is formatted
+    """
+    __slots__ = ("function", "args")
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+def cap_body(content, limit=DEFAULT_BODY_LIMIT):
+    # type: (Any, int) -> str
+    """
+    Cuts a body for logging.
+
+    :param content: The body, bytes or str
+    :param limit: Maximum number of bytes or characters kept. 0 for no limit.
+
+    :return: The decoded body, with the number of bytes cut off at the end
+    """
+    if content is None:
+        return ""
+    size = len(content)
+    if limit and size > limit:
+        content = content[:limit]
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    if limit and size > limit:
+        return "%s... (%d more)" % (content, size - limit)
+    return content
@@ -0,0 +1,391 @@
+"""
+Live per-second metrics of a load test run.
+Every worker process counts its requests into the bucket of the current second and sends the bucket to the parent
+over a multiprocessing queue once the second is over. The parent merges the buckets of every worker by second and
+hands each finished second to the writers: a CSV/JSON Lines time series, a Prometheus textfile and a console line.
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from utils.histogram import LatencyHistogram
+from utils.resultsink import open_sink
+
+DEFAULT_INTERVAL = 1.0
+# Seconds the aggregator waits for late buckets of slow workers before it writes a second out.
+DEFAULT_GRACE = 2.0
+STATUS_CLASSES = ["2xx", "3xx", "4xx", "5xx", "failed"]
+SERIES_QUANTILES = [50, 90, 99]
+# Precision of the per-second latencies. Every worker allocates and sends a bucket each second, and 1% is plenty for
+# a time series, so they are kept at 2 significant figures (26 KB) instead of the 3 (186 KB) of the run report.
+SERIES_SIGNIFICANT_FIGURES = 2
+SERIES_FIELDS = ["timestamp", "elapsed", "requests", "rps", "errors"] + STATUS_CLASSES \
+    + ["p%d_ms" % quantile for quantile in SERIES_QUANTILES] + ["max_ms", "in_flight", "users"]
+
+
+def status_class(status):
+    # type: (int) -> str
+    """
+    :return: The class of an HTTP status code, "failed" for requests without a response
+    """
+    if 200 <= status < 600:
+        return "%dxx" % (status // 100)
+    return "failed"
+
+
+class MetricsBucket:
+    """
+    Requests of one worker, or of every worker, during one interval
+    """
+
+    def __init__(self, timestamp):
+        # type: (int) -> None
+        """
+        Creates MetricsBucket instance.
+        :param timestamp: Epoch second the interval starts at
+        """
+        self.timestamp = timestamp
+        self.requests = 0
+        self.status_classes = dict.fromkeys(STATUS_CLASSES, 0)
+        self.histogram = LatencyHistogram(significant_figures=SERIES_SIGNIFICANT_FIGURES)
+        self.in_flight = 0
+        self.users = 0
+
+    def record(self, status, latency):
+        # type: (int, float) -> None
+        self.requests += 1
+        self.status_classes[status_class(status)] += 1
+        if latency is not None:
+            self.histogram.record_seconds(latency)
+
+    def merge(self, other):
+        # type: (MetricsBucket) -> MetricsBucket
+        """
+        Adds the bucket of another worker for the same interval. Gauges are summed as well.
+
+        :return: self
+        """
+        self.requests += other.requests
+        for name, count in other.status_classes.items():
+            self.status_classes[name] += count
+        self.histogram.merge(other.histogram)
+        self.in_flight += other.in_flight
+        self.users += other.users
+        return self
+
+    def errors(self):
+        # type: () -> int
+        return self.requests - self.status_classes["2xx"] - self.status_classes["3xx"]
+
+    def to_dict(self):
+        # type: () -> dict
+        return {
+            "timestamp": self.timestamp,
+            "requests": self.requests,
+            "status_classes": self.status_classes,
+            "histogram": self.histogram.to_dict(),
+            "in_flight": self.in_flight,
+            "users": self.users
+        }
+
+    @classmethod
+    def from_dict(cls, info):
+        # type: (dict) -> MetricsBucket
+        bucket = cls(info["timestamp"])
+        bucket.requests = info["requests"]
+        bucket.status_classes = info["status_classes"]
+        bucket.histogram = LatencyHistogram.from_dict(info["histogram"])
+        bucket.in_flight = info["in_flight"]
+        bucket.users = info["users"]
+        return bucket
+
+    def to_row(self, start, interval=DEFAULT_INTERVAL):
+        # type: (float, float) -> dict
+        """
+        :param start: Epoch time the run started at
+        :param interval: Length of the interval in seconds
+
+        :return: The time series row of the bucket, latencies in milliseconds
+        """
+        row = {
+            "timestamp": self.timestamp,
+            "elapsed": round(max(0.0, self.timestamp + interval - start), 3),
+            "requests": self.requests,
+            "rps": round(self.requests / interval, 1),
+            "errors": self.errors()
+        }
+        row.update(self.status_classes)
+        quantiles = self.histogram.percentiles(SERIES_QUANTILES)
+        for quantile in SERIES_QUANTILES:
+            row["p%d_ms" % quantile] = round(quantiles[quantile] / 1000.0, 3)
+        row["max_ms"] = round(self.histogram.max_recorded / 1000.0, 3)
+        row["in_flight"] = self.in_flight
+        row["users"] = self.users
+        return row
+
+
+class MetricsReporter:
+    """
+    Counts the requests of a worker and sends a bucket to the aggregator at the end of every interval
+    """
+
+    def __init__(self, channel, worker, interval=DEFAULT_INTERVAL):
+        # type: (multiprocessing.Queue, str, float) -> None
+        """
+        Creates MetricsReporter instance. Create it in the worker process, after the fork.
+        :param channel: The queue read by the MetricsAggregator
+        :param worker: Name of the worker
+        :param interval: Length of an interval in seconds
+        """
+        self.channel = channel
+        self.worker = worker
+        self.interval = interval
+        self.in_flight = 0
+        self.users = 0
+        self._bucket = MetricsBucket(self._interval_start(time.time()))
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+
+    def _interval_start(self, now):
+        # type: (float) -> int
+        return int(now - now % self.interval)
+
+    def start(self):
+        # type: () -> MetricsReporter
+        self._thread.start()
+        return self
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def record(self, status, latency):
+        # type: (int, float) -> None
+        """
+        Records a finished request that was announced with request_started.
+
+        :param status: HTTP status code. 0 if the request failed without a response.
+        :param latency: Latency of the request in seconds
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self._bucket.record(status, latency)
+
+    def user_started(self):
+        with self._lock:
+            self.users += 1
+
+    def user_finished(self):
+        with self._lock:
+            self.users -= 1
+
+    def flush(self):
+        # Gauges are sampled when the interval ends, so every worker sends a bucket even without requests.
+        next_bucket = MetricsBucket(self._interval_start(time.time()))
+        with self._lock:
+            bucket = self._bucket
+            bucket.in_flight = self.in_flight
+            bucket.users = self.users
+            self._bucket = next_bucket
+        self.channel.put(bucket.to_dict())
+
+    def _run(self):
+        while not self._stopped.wait(self.interval - time.time() % self.interval):
+            self.flush()
+
+    def stop(self):
+        """
+        Stops the reporter thread and sends the bucket of the interval in progress.
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+
+class NullReporter:
+    """
+    Stands in for the MetricsReporter when live metrics are off
+    """
+
+    def request_started(self):
+        pass
+
+    def record(self, status, latency):
+        pass
+
+    def user_started(self):
+        pass
+
+    def user_finished(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class SeriesWriter:
+    """
+    Writes every second as a CSV row or a JSON line
+    """
+
+    def __init__(self, filepath):
+        # type: (str) -> None
+        self.sink = open_sink(filepath, SERIES_FIELDS)
+
+    def write(self, bucket, row):
+        # type: (MetricsBucket, dict) -> None
+        self.sink.write(row)
+
+    def close(self):
+        self.sink.close()
+
+
+class PrometheusWriter:
+    """
+    Rewrites a Prometheus textfile (for the node exporter textfile collector) after every second
+    """
+
+    def __init__(self, filepath, interval=DEFAULT_INTERVAL):
+        # type: (str, float) -> None
+        self.filepath = filepath
+        self.interval = interval
+        self.requests = 0
+        self.status_classes = dict.fromkeys(STATUS_CLASSES, 0)
+
+    def write(self, bucket, row):
+        # type: (MetricsBucket, dict) -> None
+        self.requests += bucket.requests
+        for name, count in bucket.status_classes.items():
+            self.status_classes[name] += count
+        lines = [
+            "# HELP load_test_requests_total Requests finished since the start of the run.",
+            "# TYPE load_test_requests_total counter",
+        ]
+        for name in STATUS_CLASSES:
+            lines.append('load_test_requests_total{status_class="%s"} %d' % (name, self.status_classes[name]))
+        lines += [
+            "# HELP load_test_requests_per_second Requests finished during the last second.",
+            "# TYPE load_test_requests_per_second gauge",
+            "load_test_requests_per_second %s" % row["rps"],
+            "# HELP load_test_latency_seconds Request latency quantiles of the last second.",
+            "# TYPE load_test_latency_seconds gauge",
+        ]
+        for quantile in SERIES_QUANTILES:
+            lines.append('load_test_latency_seconds{quantile="%s"} %s' % (quantile / 100.0, round(row["p%d_ms" % quantile] / 1000.0, 6)))
+        lines += [
+            "# HELP load_test_in_flight_requests Requests waiting for a response.",
+            "# TYPE load_test_in_flight_requests gauge",
+            "load_test_in_flight_requests %d" % row["in_flight"],
+            "# HELP load_test_active_users Virtual users running.",
+            "# TYPE load_test_active_users gauge",
+            "load_test_active_users %d" % row["users"],
+            "# HELP load_test_last_update_seconds Epoch time of the last second written.",
+            "# TYPE load_test_last_update_seconds gauge",
+            "load_test_last_update_seconds %d" % (bucket.timestamp + self.interval),
+        ]
+        # The collector may read at any moment, so the file is replaced atomically.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filepath)), prefix=".metrics_", suffix=".tmp")
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write("\n".join(lines))
+            temp_file.write("\n")
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, self.filepath)
+
+    def close(self):
+        pass
+
+
+class ConsoleWriter:
+    """
+    Logs one compact line per second
+    """
+
+    def __init__(self, logger):
+        # type: (logging.Logger) -> None
+        self.logger = logger
+
+    def write(self, bucket, row):
+        # type: (MetricsBucket, dict) -> None
+        self.logger.info("[%6.0fs] %7.1f req/s | errors 4xx=%d 5xx=%d failed=%d | p50 %.1f ms p99 %.1f ms max %.1f ms"
+                         " | in flight %d | users %d",
+                         row["elapsed"], row["rps"], row["4xx"], row["5xx"], row["failed"], row["p50_ms"],
+                         row["p99_ms"], row["max_ms"], row["in_flight"], row["users"])
+
+    def close(self):
+        pass
+
+
+class MetricsAggregator:
+    """
+    Merges the buckets of every worker by second in the parent process and writes out every finished second
+    """
+
+    def __init__(self, channel, writers, interval=DEFAULT_INTERVAL, grace=DEFAULT_GRACE):
+        # type: (multiprocessing.Queue, list, float, float) -> None
+        """
+        Creates MetricsAggregator instance.
+        :param channel: The queue the MetricsReporter of every worker writes to
+        :param writers: Objects with write(bucket, row) and close()
+        :param interval: Length of an interval in seconds
+        :param grace: Seconds to wait for late buckets before a second is written
+        """
+        self.channel = channel
+        self.writers = writers
+        self.interval = interval
+        self.grace = grace
+        self.start_time = time.time()
+        self.pending = {}
+        self.last_written = None
+        self._thread = threading.Thread(target=self._run, name="metrics-aggregator", daemon=True)
+
+    def start(self):
+        # type: () -> MetricsAggregator
+        self.start_time = time.time()
+        self._thread.start()
+        return self
+
+    def _add(self, bucket):
+        # type: (MetricsBucket) -> None
+        if self.last_written is not None and bucket.timestamp <= self.last_written:
+            # Too late for its own second, so it counts for the next one.
+            bucket.timestamp = self.last_written + self.interval
+        pending = self.pending.get(bucket.timestamp)
+        if pending is None:
+            self.pending[bucket.timestamp] = bucket
+        else:
+            pending.merge(bucket)
+
+    def _write_until(self, timestamp):
+        # type: (float) -> None
+        for key in sorted(key for key in self.pending if key <= timestamp):
+            bucket = self.pending.pop(key)
+            row = bucket.to_row(self.start_time, self.interval)
+            for writer in self.writers:
+                writer.write(bucket, row)
+            self.last_written = key
+
+    def _run(self):
+        while True:
+            try:
+                info = self.channel.get(timeout=self.interval)
+            except queue.Empty:
+                info = {}
+            if info is None:
+                break
+            if info:
+                self._add(MetricsBucket.from_dict(info))
+            self._write_until(time.time() - self.interval - self.grace)
+
+    def stop(self):
+        """
+        Writes every second still pending and closes the writers. Call after the workers have stopped.
+        """
+        self.channel.put(None)
+        self._thread.join()
+        self._write_until(float("inf"))
+        for writer in self.writers:
+            writer.close()
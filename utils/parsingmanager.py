@@ -1,11 +1,11 @@
 from optparse import OptionParser
 
-def parse_options():
-  # type: () -> (str, str, bool)
+def create_parser():
+  # type: () -> OptionParser
   """
-  Parses options from arguments
+  Creates the option parser with the options shared by every script
 
-  :return config_filepath: The parsed file path
+  :return parser: The option parser
   """
   parser = OptionParser()
   parser.add_option("-c", "--configfile", dest="filename", help="File for configuration. config.conf by default.",
@@ -13,9 +13,89 @@ def parse_options():
   parser.add_option("-t", "--testcase", dest="testcase", help="File for test case. Required.",
                     metavar="FILE")
   parser.add_option("-d", "--detail", dest="detail", action="store_true", help="Prints test result in detail", default=False)
+  return parser
+
+
+def parse_options():
+  # type: () -> (str, str, bool)
+  """
+  Parses options from arguments
+
+  :return config_filepath: The parsed file path
+  """
+  parser = create_parser()
   options, args = parser.parse_args()
   config_filepath = options.filename
   test_filepath = options.testcase
   detail_flag = options.detail
   return config_filepath, test_filepath, detail_flag
 
+
+def parse_auto_test_options():
+  # type: () -> Values
+  """
+  Parses options for automatic rest testing from arguments
+
+  :return options: The parsed options
+  """
+  parser = create_parser()
+  parser.add_option("-n", "--concurrency", dest="concurrency", type="int", metavar="N", default=1,
+                    help="Number of test cases run at once. Cases share the authenticated client. 1 by default.")
+  parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                    help="Streams every result to a file as it finishes. CSV if FILE ends with .csv, JSON Lines otherwise.")
+  options, args = parser.parse_args()
+  return options
+
+
+def parse_load_test_options():
+  # type: () -> Values
+  """
+  Parses options for load testing from arguments
+
+  :return options: The parsed options
+  """
+  parser = create_parser()
+  parser.add_option("-e", "--engine", dest="engine", choices=["process", "async"], default="process",
+                    help="Load engine. 'process' runs one process per TestData, "
+                         "'async' runs every TestData as a coroutine virtual user. process by default.")
+  parser.add_option("-w", "--workers", dest="workers", type="int", metavar="N",
+                    help="Number of worker processes for the async engine. TestData is sharded across them. "
+                         "One per CPU core by default.")
+  parser.add_option("-H", "--histogram-file", dest="histogram_file", metavar="FILE",
+                    help="Exports the merged latency histogram of every scenario step to a JSON file.")
+  parser.add_option("--credentials", dest="credentials", metavar="FILE",
+                    help="CSV (username,password) or JSON file of users. TestData rows without a \"username\" "
+                         "are assigned these users round-robin.")
+  parser.add_option("--auth-parallelism", dest="auth_parallelism", type="int", metavar="N", default=8,
+                    help="Number of users logged in at once before the run. 0 logs every user in lazily, "
+                         "when the worker first needs it. 8 by default.")
+  parser.add_option("--coordinator", dest="coordinator", metavar="[HOST:]PORT",
+                    help="Runs as the coordinator of a distributed run: waits for --agents agents on PORT, splits "
+                         "TestData among them, starts them together and merges their results. Needs no settings file.")
+  parser.add_option("--agents", dest="agents", type="int", metavar="N", default=1,
+                    help="Number of agents the coordinator waits for. 1 by default.")
+  parser.add_option("--agent", dest="agent", metavar="HOST:PORT",
+                    help="Runs as an agent of the coordinator at HOST:PORT, with the settings file and engine "
+                         "options of this machine. The test file comes from the coordinator.")
+  parser.add_option("--start-delay", dest="start_delay", type="float", metavar="SECONDS", default=2.0,
+                    help="Seconds between the moment every agent is ready and the synchronized start. 2 by default.")
+  parser.add_option("--metrics-file", dest="metrics_file", metavar="FILE",
+                    help="Writes per-second throughput, errors by status class, latency quantiles and active users "
+                         "during the run. CSV if FILE ends with .csv, JSON Lines otherwise.")
+  parser.add_option("--prometheus-file", dest="prometheus_file", metavar="FILE",
+                    help="Rewrites FILE every second with the current metrics in the Prometheus text format, "
+                         "for the node exporter textfile collector.")
+  parser.add_option("--live", dest="live", action="store_true", default=False,
+                    help="Prints one summary line per second instead of the per-request log lines. Errors are still logged.")
+  parser.add_option("--log-sample", dest="log_sample", type="int", metavar="N", default=1,
+                    help="Writes the per-request log lines of 1 request in every N. Errors are always logged. 1 by default.")
+  parser.add_option("--log-errors-only", dest="log_errors_only", action="store_true", default=False,
+                    help="Writes no per-request log lines, only errors and the run report.")
+  parser.add_option("--log-body-limit", dest="log_body_limit", type="int", metavar="BYTES", default=2048,
+                    help="Cuts logged request and response bodies to BYTES. 0 for no limit. 2048 by default.")
+  parser.add_option("--serial-steps", dest="serial_steps", action="store_true", default=False,
+                    help="Runs the steps of every iteration one after another, even the ones that could run concurrently.")
+  parser.add_option("--profile-plan", dest="profile_plan", action="store_true", default=False,
+                    help="Measures request preparation with and without the compiled scenario plan, without sending requests.")
+  options, args = parser.parse_args()
+  return options
@@ -0,0 +1,151 @@
+"""
+Per-request phase timing.
+The transports split the time of every request into name lookup, TCP connect, TLS handshake, time to first byte
+(sending the request and waiting for the response headers) and download of the body. A request over a kept-alive
+connection has no lookup, connect or handshake, so the phases show what connection reuse saves.
+"""
+
+import threading
+import time
+
+PHASES = ["dns", "connect", "tls", "ttfb", "download"]
+SETUP_PHASES = ["dns", "connect", "tls"]
+
+_current = threading.local()
+
+
+class PhaseTimings:
+    """
+    Seconds one request spent in each phase
+    """
+    __slots__ = PHASES + ["_mark"]
+
+    def __init__(self):
+        for phase in PHASES:
+            setattr(self, phase, 0.0)
+        self._mark = time.perf_counter()
+
+    def start(self):
+        """
+        Starts the clock of the next phase, e.g. right before the request is sent.
+        """
+        self._mark = time.perf_counter()
+
+    def lap(self, phase):
+        # type: (str) -> None
+        """
+        Adds the time since the last lap to a phase. Retries add up in the same phases.
+        """
+        if self._mark is None:
+            return
+        now = time.perf_counter()
+        setattr(self, phase, getattr(self, phase) + now - self._mark)
+        self._mark = now
+
+    def finish(self):
+        """
+        Ends the download phase once the body was read. Only the first call counts.
+        """
+        self.lap("download")
+        self._mark = None
+
+    def new_connection(self):
+        # type: () -> bool
+        return self.connect > 0.0
+
+    def setup(self):
+        # type: () -> float
+        """
+        :return: Seconds spent opening the connection
+        """
+        return self.dns + self.connect + self.tls
+
+    def to_dict(self):
+        # type: () -> dict
+        return {phase: getattr(self, phase) for phase in PHASES}
+
+
+def begin_timings():
+    # type: () -> PhaseTimings
+    """
+    Starts the timings of a request sent by this thread through a transport that cannot hand them over
+    explicitly, i.e. requests/urllib3. The connection and pool hooks look them up with current_timings().
+    """
+    timings = _current.timings = PhaseTimings()
+    return timings
+
+
+def current_timings():
+    # type: () -> PhaseTimings
+    """
+    :return: The timings of the request this thread is sending, None outside of begin_timings()
+    """
+    return getattr(_current, "timings", None)
+
+
+def end_timings():
+    # type: () -> PhaseTimings
+    """
+    Stops attributing phases to the request of this thread.
+
+    :return: Its timings
+    """
+    timings = current_timings()
+    _current.timings = None
+    return timings
+
+
+class PhaseStats:
+    """
+    Phase times of the requests of one scenario step, added up
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.totals = dict.fromkeys(PHASES, 0.0)
+
+    def record(self, timings):
+        # type: (PhaseTimings) -> None
+        self.requests += 1
+        if timings.new_connection():
+            self.new_connections += 1
+        for phase in PHASES:
+            self.totals[phase] += getattr(timings, phase)
+
+    def merge(self, other):
+        # type: (PhaseStats) -> PhaseStats
+        self.requests += other.requests
+        self.new_connections += other.new_connections
+        for phase in PHASES:
+            self.totals[phase] += other.totals[phase]
+        return self
+
+    def setup(self):
+        # type: () -> float
+        """
+        :return: Seconds spent opening connections
+        """
+        return sum(self.totals[phase] for phase in SETUP_PHASES)
+
+    def mean(self, phase):
+        # type: (str) -> float
+        """
+        :return: Mean seconds of a phase. Setup phases are averaged over the new connections, the others over
+                 every request.
+        """
+        count = self.new_connections if phase in SETUP_PHASES else self.requests
+        return self.totals[phase] / count if count else 0.0
+
+    def to_dict(self):
+        # type: () -> dict
+        return {"requests": self.requests, "new_connections": self.new_connections, "totals": self.totals}
+
+    @classmethod
+    def from_dict(cls, info):
+        # type: (dict) -> PhaseStats
+        stats = cls()
+        stats.requests = info["requests"]
+        stats.new_connections = info["new_connections"]
+        stats.totals.update(info["totals"])
+        return stats
@@ -0,0 +1,93 @@
+"""
+Incremental result output for auto_rest_test.
+Every finished test case is written and flushed right away, so the full responses never pile up in memory.
+"""
+
+import csv
+import json
+from abc import ABC, abstractmethod
+
+from utils.phasetiming import PHASES
+
+RESULT_FIELDS = ["index", "name", "method", "url", "status", "duration_ms"] + ["%s_ms" % phase for phase in PHASES] \
+    + ["result"]
+
+
+class ResultSink(ABC):
+    """
+    Writes one record per finished test case
+    """
+
+    def __init__(self, filepath):
+        # type: (str) -> None
+        """
+        Creates ResultSink instance.
+        :param filepath: The output file path
+        """
+        self.filepath = filepath
+        self.file = open(filepath, "w", newline="")
+        self.count = 0
+
+    @abstractmethod
+    def write(self, record):
+        # type: (dict) -> None
+        """
+        Writes a record with the RESULT_FIELDS keys.
+
+        :param record: The record
+        """
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JSONLinesSink(ResultSink):
+    """
+    Writes one JSON object per line
+    """
+
+    def write(self, record):
+        # type: (dict) -> None
+        self.file.write(json.dumps(record))
+        self.file.write("\n")
+        self.file.flush()
+        self.count += 1
+
+
+class CSVSink(ResultSink):
+    """
+    Writes one CSV row per test case with a header row
+    """
+
+    def __init__(self, filepath, fields=RESULT_FIELDS):
+        # type: (str, list) -> None
+        ResultSink.__init__(self, filepath)
+        self.writer = csv.DictWriter(self.file, fieldnames=fields)
+        self.writer.writeheader()
+
+    def write(self, record):
+        # type: (dict) -> None
+        self.writer.writerow(record)
+        self.file.flush()
+        self.count += 1
+
+
+def open_sink(filepath, fields=RESULT_FIELDS):
+    # type: (str, list) -> ResultSink
+    """
+    Opens the sink matching the file extension. ".csv" gives CSV, anything else JSON Lines.
+
+    :param filepath: The output file path
+    :param fields: The record keys, in CSV column order
+
+    :return: The sink
+    """
+    if filepath.lower().endswith(".csv"):
+        return CSVSink(filepath, fields)
+    return JSONLinesSink(filepath)
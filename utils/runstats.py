@@ -0,0 +1,209 @@
+"""
+Mergeable load test statistics.
+Each worker fills its own RunStats and ships it to the parent as a plain dictionary.
+"""
+
+from utils.errorcluster import ErrorClusterer
+from utils.histogram import LatencyHistogram
+from utils.phasetiming import PhaseStats
+
+
+class RunStats:
+    """
+    Counts requests, errors and status codes of a load test run
+    """
+
+    def __init__(self, name=""):
+        # type: (str) -> None
+        """
+        Creates RunStats instance.
+        :param name: Name of the worker or the run
+        """
+        self.name = name
+        self.users = 0
+        self.requests = 0
+        self.errors = 0
+        self.status_counts = {}
+        self.connections = 0
+        self.elapsed = 0.0
+        self.iterations = 0
+        self.late_starts = 0
+        self.max_lag = 0.0
+        self.dropped = 0
+        self.logins = 0
+        self.login_time = 0.0
+        self.signed = 0
+        self.sign_time = 0.0
+        self.step_histograms = {}
+        # Latency from the intended start of every request, see corrected_histograms()
+        self.step_corrected = {}
+        self.iteration_histogram = LatencyHistogram()
+        self.scheduled = False
+        self.late_requests = 0
+        self.step_phases = {}
+        self.error_clusters = ErrorClusterer()
+
+    def record(self, status, step=None, latency=None, timings=None, lag=0.0):
+        # type: (int, str, float, PhaseTimings, float) -> None
+        """
+        Records a finished request.
+
+        :param status: HTTP status code. 0 if the request failed without a response.
+        :param step: Name of the scenario step
+        :param latency: Latency of the request in seconds
+        :param timings: Phase timings of the request
+        :param lag: Seconds the iteration of the request started after its intended start
+        """
+        if step is not None and latency is not None:
+            histogram = self.step_histograms.get(step)
+            if histogram is None:
+                histogram = self.step_histograms[step] = LatencyHistogram()
+            histogram.record_seconds(latency)
+            corrected = self.step_corrected.get(step)
+            if corrected is None:
+                corrected = self.step_corrected[step] = LatencyHistogram()
+            corrected.record_seconds(latency + lag)
+        if step is not None and timings is not None:
+            phases = self.step_phases.get(step)
+            if phases is None:
+                phases = self.step_phases[step] = PhaseStats()
+            phases.record(timings)
+        self.requests += 1
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+        if status < 200 or status >= 400:
+            self.errors += 1
+
+    def record_iteration(self, duration):
+        # type: (float) -> None
+        """
+        Records the seconds a scenario iteration took, delays included.
+        """
+        self.iteration_histogram.record_seconds(duration)
+
+    def corrected_histograms(self):
+        # type: () -> (dict, int, int)
+        """
+        Latency per step corrected for coordinated omission. With a schedule (pacing or arrival rate), the latency of
+        every request already counts from its intended start. Without one, every user is taken to have meant to start
+        an iteration every median iteration time, and the requests a stall kept from being sent are back-filled.
+
+        :return: The histograms by step, the expected interval in microseconds (None with a schedule) and the number
+                 of back-filled requests
+        """
+        if self.scheduled or self.iteration_histogram.total_count == 0:
+            return self.step_corrected, None, 0
+        expected_interval = self.iteration_histogram.value_at_percentile(50)
+        histograms = {}
+        omitted = 0
+        for step, histogram in self.step_corrected.items():
+            histograms[step], filled = histogram.copy_corrected(expected_interval)
+            omitted += filled
+        return histograms, expected_interval, omitted
+
+    def merge(self, other):
+        # type: (RunStats) -> RunStats
+        """
+        Adds the other stats into this one. Elapsed time is the longest of the two
+        since workers run at the same time.
+
+        :param other: The stats to merge
+
+        :return: self
+        """
+        self.users += other.users
+        self.requests += other.requests
+        self.errors += other.errors
+        for status, count in other.status_counts.items():
+            self.status_counts[status] = self.status_counts.get(status, 0) + count
+        self.connections += other.connections
+        self.elapsed = max(self.elapsed, other.elapsed)
+        self.iterations += other.iterations
+        self.late_starts += other.late_starts
+        self.max_lag = max(self.max_lag, other.max_lag)
+        self.dropped += other.dropped
+        self.logins += other.logins
+        self.login_time += other.login_time
+        self.signed += other.signed
+        self.sign_time += other.sign_time
+        for step, histogram in other.step_histograms.items():
+            if step in self.step_histograms:
+                self.step_histograms[step].merge(histogram)
+            else:
+                self.step_histograms[step] = LatencyHistogram.from_dict(histogram.to_dict())
+        for step, histogram in other.step_corrected.items():
+            if step in self.step_corrected:
+                self.step_corrected[step].merge(histogram)
+            else:
+                self.step_corrected[step] = LatencyHistogram.from_dict(histogram.to_dict())
+        self.iteration_histogram.merge(other.iteration_histogram)
+        self.scheduled = self.scheduled or other.scheduled
+        self.late_requests += other.late_requests
+        for step, phases in other.step_phases.items():
+            self.step_phases.setdefault(step, PhaseStats()).merge(phases)
+        self.error_clusters.merge(other.error_clusters)
+        return self
+
+    def throughput(self):
+        # type: () -> float
+        """
+        :return: Requests per second
+        """
+        return self.requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    def to_dict(self):
+        # type: () -> dict
+        return {
+            "name": self.name,
+            "users": self.users,
+            "requests": self.requests,
+            "errors": self.errors,
+            "status_counts": self.status_counts,
+            "connections": self.connections,
+            "elapsed": self.elapsed,
+            "iterations": self.iterations,
+            "late_starts": self.late_starts,
+            "max_lag": self.max_lag,
+            "dropped": self.dropped,
+            "logins": self.logins,
+            "login_time": self.login_time,
+            "signed": self.signed,
+            "sign_time": self.sign_time,
+            "step_histograms": {step: histogram.to_dict() for step, histogram in self.step_histograms.items()},
+            "step_corrected": {step: histogram.to_dict() for step, histogram in self.step_corrected.items()},
+            "iteration_histogram": self.iteration_histogram.to_dict(),
+            "scheduled": self.scheduled,
+            "late_requests": self.late_requests,
+            "step_phases": {step: phases.to_dict() for step, phases in self.step_phases.items()},
+            "error_clusters": self.error_clusters.to_dict()
+        }
+
+    @classmethod
+    def from_dict(cls, info):
+        # type: (dict) -> RunStats
+        stats = cls(info.get("name", ""))
+        stats.users = info["users"]
+        stats.requests = info["requests"]
+        stats.errors = info["errors"]
+        stats.status_counts = {int(status): count for status, count in info["status_counts"].items()}
+        stats.connections = info["connections"]
+        stats.elapsed = info["elapsed"]
+        stats.iterations = info.get("iterations", 0)
+        stats.late_starts = info.get("late_starts", 0)
+        stats.max_lag = info.get("max_lag", 0.0)
+        stats.dropped = info.get("dropped", 0)
+        stats.logins = info.get("logins", 0)
+        stats.login_time = info.get("login_time", 0.0)
+        stats.signed = info.get("signed", 0)
+        stats.sign_time = info.get("sign_time", 0.0)
+        stats.step_histograms = {step: LatencyHistogram.from_dict(histogram)
+                                 for step, histogram in info.get("step_histograms", {}).items()}
+        stats.step_corrected = {step: LatencyHistogram.from_dict(histogram)
+                                for step, histogram in info.get("step_corrected", {}).items()}
+        if "iteration_histogram" in info:
+            stats.iteration_histogram = LatencyHistogram.from_dict(info["iteration_histogram"])
+        stats.scheduled = info.get("scheduled", False)
+        stats.late_requests = info.get("late_requests", 0)
+        stats.step_phases = {step: PhaseStats.from_dict(phases) for step, phases in info.get("step_phases", {}).items()}
+        if "error_clusters" in info:
+            stats.error_clusters = ErrorClusterer.from_dict(info["error_clusters"])
+        return stats
@@ -32,6 +32,20 @@ def cut_msg(msg, limit=50):
         return msg
 
 
+def _bounded_ratio(matcher, ratio):
+    # type: (SequenceMatcher, float) -> float
+    """
+    Computes the similarity of the matcher's two strings, giving up as soon as it cannot exceed the ratio.
+    real_quick_ratio (lengths only) and quick_ratio (character counts) are upper bounds of ratio.
+
+    :return: The similarity, or 0.0 if it is not above the ratio
+    """
+    if matcher.real_quick_ratio() <= ratio or matcher.quick_ratio() <= ratio:
+        return 0.0
+    value = matcher.ratio()
+    return value if value > ratio else 0.0
+
+
 def is_similar_between(a, b, ratio):
     # type: (str, str, float) -> bool
     """
@@ -43,7 +57,75 @@ def is_similar_between(a, b, ratio):
 
     :return: True if two are similar with the probability, False otherwise.
     """
-    return True if (SequenceMatcher(None, a, b).ratio() > ratio) else False
+    total = len(a) + len(b)
+    if total == 0:
+        return ratio < 1.0
+    # The ratio can never exceed 2 * shorter / total length, so very different lengths need no matcher.
+    if 2.0 * min(len(a), len(b)) / total <= ratio:
+        return False
+    return _bounded_ratio(SequenceMatcher(None, a, b), ratio) > 0.0
+
+
+def similar_candidates(text, candidates, ratio):
+    # type: (str, list, float) -> list
+    """
+    Scores one string against many candidates at once. The string is indexed once,
+    and only the candidates that pass the length and character count bounds are fully compared.
+
+    :param text: The string to compare
+    :param candidates: The list of candidate strings
+    :param ratio: The ratio or probability if two strings are similar.
+
+    :return: The list of (index, ratio) of the candidates more similar than the ratio, the most similar first
+    """
+    matcher = SequenceMatcher(None)
+    # SequenceMatcher caches its index of the second string, so the shared string goes there.
+    matcher.set_seq2(text)
+    length = len(text)
+    result = []
+    for index, candidate in enumerate(candidates):
+        total = length + len(candidate)
+        if total == 0:
+            if ratio < 1.0:
+                result.append((index, 1.0))
+            continue
+        if 2.0 * min(length, len(candidate)) / total <= ratio:
+            continue
+        matcher.set_seq1(candidate)
+        value = _bounded_ratio(matcher, ratio)
+        if value > 0.0:
+            result.append((index, value))
+    result.sort(key=lambda item: -item[1])
+    return result
+
+
+def _last_positions(text):
+    # type: (str) -> dict
+    """
+    :return: Dictionary of every character of the text, except "*", to the index it last occurs at
+    """
+    positions = {character: index for index, character in enumerate(text)}
+    positions.pop("*", None)
+    return positions
+
+
+def _first_common_chars(left, left_start, left_last, right, right_start, right_last):
+    # type: (str, int, dict, str, int, dict) -> (int, int)
+    """
+    find_first_common_char of left[left_start:] and right[right_start:], without copying them.
+    The character of right that occurs first in left is the first one whose last occurrence in left is not
+    before left_start, so each side is scanned only up to its first common character.
+    """
+    first_a = first_b = sys.maxsize
+    for j in range(right_start, len(right)):
+        if left_last.get(right[j], -1) >= left_start:
+            first_a = left.find(right[j], left_start) - left_start
+            break
+    for i in range(left_start, len(left)):
+        if right_last.get(left[i], -1) >= right_start:
+            first_b = right.find(left[i], right_start) - right_start
+            break
+    return first_a, first_b
 
 
 def find_first_common_char(left, right):
@@ -56,25 +138,7 @@ def find_first_common_char(left, right):
 
     :returns: The indexes of two strings which occurs first.
     """
-    first_a = a_occur = sys.maxint
-    first_b = b_occur = sys.maxint
-    for i in range(len(left)):
-        if left[i] == "*":
-            continue
-        if a_occur > right.find(left[i]) >= 0:
-            a_occur = right.find(left[i])
-            first_a = i
-            if a_occur == 0:
-                break
-    for i in range(len(right)):
-        if right[i] == "*":
-            continue
-        if b_occur > left.find(right[i]) >= 0:
-            b_occur = left.find(right[i])
-            first_b = i
-            if b_occur == 0:
-                break
-    return first_a, first_b
+    return _first_common_chars(left, 0, _last_positions(left), right, 0, _last_positions(right))
 
 
 def common_string(left, right):
@@ -89,32 +153,36 @@ def common_string(left, right):
 
     :return: The generated common string
     """
-    logger.debug("Comparing %s and %s" % (left, right))
+    logger.debug("Comparing %s and %s", left, right)
     c = []
-    count_a, count_b = find_first_common_char(left, right)
-    if count_a > len(left) - 1 or count_b > len(right) - 1:
-        return ""
-    if count_a > count_b > 0:
-        count_a = 0
-    elif count_b > count_a > 0:
-        count_b = 0
-    elif count_a == count_b:
-        if left[count_a] != right[count_b]:
-            if len(left) > len(right):
-                count_b = 0
-            else:
-                count_a = 0
-    if count_a > 0 or count_b > 0:
-        c.append("*")
-    logger.debug("Starting from index %d and %d" % (count_a, count_b))
-    while count_a < len(left) and count_b < len(right) and left[count_a] == right[count_b]:
-        c.append(left[count_a])
-        count_a += 1
-        count_b += 1
-    logger.debug("Appended: %s" % "".join(c))
-    next_left = left[count_a:]
-    next_right = right[count_b:]
-    c.append(common_string(next_left, next_right))
+    left_last = _last_positions(left)
+    right_last = _last_positions(right)
+    # Offsets of the parts not compared yet. Every pass skips one mismatch and copies the common run after it.
+    start_a = start_b = 0
+    while True:
+        count_a, count_b = _first_common_chars(left, start_a, left_last, right, start_b, right_last)
+        if count_a > len(left) - start_a - 1 or count_b > len(right) - start_b - 1:
+            break
+        if count_a > count_b > 0:
+            count_a = 0
+        elif count_b > count_a > 0:
+            count_b = 0
+        elif count_a == count_b:
+            if left[start_a + count_a] != right[start_b + count_b]:
+                if len(left) - start_a > len(right) - start_b:
+                    count_b = 0
+                else:
+                    count_a = 0
+        if count_a > 0 or count_b > 0:
+            c.append("*")
+        index_a = start_a + count_a
+        index_b = start_b + count_b
+        logger.debug("Starting from index %d and %d", index_a, index_b)
+        while index_a < len(left) and index_b < len(right) and left[index_a] == right[index_b]:
+            c.append(left[index_a])
+            index_a += 1
+            index_b += 1
+        start_a, start_b = index_a, index_b
     return "".join(c)
 
 
@@ -163,8 +231,9 @@ def closest_match_words(string_list):
     # type: (list) -> str
     """
     Retrieves the closest match words. All string values should start with the same characters,
-    or return all asterisks otherwise.
-    e.g. "abcdefg" and "aacceee" gives "a*c*e**".
+    or return all asterisks otherwise. Words of different lengths keep their common ending,
+    e.g. punctuation after a number.
+    e.g. "abcdefg" and "aacceee" gives "a*c*e**", "abc." and "abcde." gives "abc*.".
 
     :param string_list: The list of string values
 
@@ -174,18 +243,21 @@ def closest_match_words(string_list):
         return ''
     elif len(string_list) == 1:
         return string_list[0]
+    shortest = min(len(string_item) for string_item in string_list)
+    same_length = all(len(string_item) == shortest for string_item in string_list)
+    suffix = 0
+    if not same_length:
+        while suffix < shortest and is_all_characters_same(string_list, -1 - suffix):
+            suffix += 1
     closest = []
-    try:
-        for index in range(len(string_list[0])):
-            if is_all_characters_same(string_list, index):
-                closest.append(string_list[0][index])
-            else:
-                closest.append('*')
-    except IndexError:
-        closest.append('*')
-        return ''.join(closest)
-    if len(string_list[0]) < len(string_list[1]):
+    for index in range(shortest - suffix):
+        if is_all_characters_same(string_list, index):
+            closest.append(string_list[0][index])
+        else:
+            closest.append('*')
+    if not same_length:
         closest.append('*')
+    closest.append(string_list[0][len(string_list[0]) - suffix:])
     return ''.join(closest)
 
 
@@ -226,12 +298,11 @@ def group_by_similar_strings(string_list, ratio):
     :return: The list of groupped string list
     """
 
+    string_list = sorted(a for a in string_list if a.strip() != "")
     if len(string_list) == 0:
         return []
     elif len(string_list) == 1:
-        return string_list
-    string_list = filter(lambda a: (a != "") or (a != " "), string_list)
-    string_list.sort()
+        return [string_list]
     result = []
     group = []
     for index in range(len(string_list) - 1):
@@ -267,12 +338,11 @@ def group_by_similar_values(string_list, key, ratio):
 
     :return: The list of grouped string list
     """
+    string_list = sorted((a for a in string_list if a[key].strip() != ""), key=operator.itemgetter(key))
     if len(string_list) == 0:
         return []
     elif len(string_list) == 1:
-        return string_list
-    string_list = filter(lambda a: (a[key] != "") or (a[key] != " "), string_list)
-    string_list.sort(key=operator.itemgetter(key))
+        return [string_list]
     result = []
     group = []
     for index in range(len(string_list) - 1):
@@ -0,0 +1,54 @@
+"""
+Reads test cases for auto_rest_test.
+A ".jsonl" file holds one test case object per line and is read lazily, one case at a time.
+Any other file is the JSON document with the "TestCases" array.
+"""
+
+import json
+
+JSON_LINES_EXTENSIONS = (".jsonl", ".ndjson")
+
+
+def is_json_lines(filepath):
+    # type: (str) -> bool
+    """
+    :param filepath: The test file path
+
+    :return: True if the file is in JSON Lines format
+    """
+    return filepath.lower().endswith(JSON_LINES_EXTENSIONS)
+
+
+def iter_json_lines(filepath):
+    # type: (str) -> Iterator[dict]
+    """
+    Reads a JSON Lines file one object at a time. Blank lines are skipped.
+
+    :param filepath: The file path
+
+    :return: Generator of the parsed objects
+    """
+    with open(filepath) as data_file:
+        for line_number, line in enumerate(data_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError("%s:%d: %s" % (filepath, line_number, e))
+
+
+def iter_test_cases(filepath):
+    # type: (str) -> Iterator[dict]
+    """
+    Reads the test cases of the test file.
+
+    :param filepath: The test file path
+
+    :return: Iterable of test cases
+    """
+    if is_json_lines(filepath):
+        return iter_json_lines(filepath)
+    with open(filepath) as data_file:
+        return json.load(data_file)["TestCases"]